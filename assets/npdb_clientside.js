@@ -0,0 +1,123 @@
+//clientside callbacks of the NPDB dashboard (used when NPDB_CLIENTSIDE is set): claim counts and payment
+//totals of the selected years are combined in the browser from the per-year prefix sums in the
+//npdb_year_payload store, the same way NpdbYearIndex combines them on the server; practitioner counts,
+//medians and percentiles come from the npdb_server_summary store once the server has answered
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    npdb: (function () {
+
+        var numberFormat = new Intl.NumberFormat("en-US", {maximumFractionDigits: 0});
+
+        //placeholder for values the server has not sent yet for the selected years
+        var pending = "…";
+
+        //(start, end) year codes of the selected years within the data, or null when no year is selected
+        function yearCodes(payload, startYear, endYear) {
+            var startCode = Math.max(Math.ceil(startYear), payload.first_year) - payload.first_year;
+            var endCode = Math.min(Math.floor(endYear), payload.last_year) - payload.first_year;
+
+            return startCode > endCode ? null : [startCode, endCode];
+        }
+
+        //value per group over the selected years from prefix sums over the years (zeros when no year is selected)
+        function rangeValues(prefix, codes) {
+            return prefix.map(function (groupPrefix) {
+                return codes === null ? 0 : groupPrefix[codes[1] + 1] - groupPrefix[codes[0]];
+            });
+        }
+
+        //stop the callback when a year input is empty, as the server callbacks do
+        function checkYears(startYear, endYear) {
+            if ((startYear === null) || (startYear === undefined) || (endYear === null) || (endYear === undefined)) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+        }
+
+        //server summary of the selected years, or null while it is still on its way
+        function serverSummary(summary, startYear, endYear) {
+            return (summary && (summary.start_year === startYear) && (summary.end_year === endYear)) ? summary : null;
+        }
+
+        //copy of a figure with new values for some attributes of its first trace
+        function updateTrace(figure, traceUpdate) {
+            return Object.assign({}, figure, {data: [Object.assign({}, figure.data[0], traceUpdate)]});
+        }
+
+        //bars of the claim counts by code of a group column, sorted by abbreviation and description like the
+        //groupby of the server callbacks
+        function codeBars(payload, groupColumn, startYear, endYear, figure) {
+            checkYears(startYear, endYear);
+
+            var codes = yearCodes(payload, startYear, endYear);
+            var counts = rangeValues(payload.claim_prefix[groupColumn], codes);
+            var codeNames = payload.codes[groupColumn];
+            var bars = [];
+
+            payload.labels[groupColumn].forEach(function (label, groupCode) {
+                if ((counts[groupCode] > 0) && (String(label) in codeNames.abbr)) {
+                    bars.push([codeNames.abbr[String(label)], codeNames.desc[String(label)], counts[groupCode]]);
+                }
+            });
+            bars.sort(function (a, b) {
+                return a[0] < b[0] ? -1 : a[0] > b[0] ? 1 : a[1] < b[1] ? -1 : a[1] > b[1] ? 1 : 0;
+            });
+
+            return updateTrace(figure, {x: bars.map(function (bar) { return bar[0]; }),
+                                        y: bars.map(function (bar) { return bar[2]; }),
+                                        customdata: bars.map(function (bar) { return bar[1]; })});
+        }
+
+        return {
+            //summary table across all US states
+            summaryTable: function (startYear, endYear, summary, payload) {
+                checkYears(startYear, endYear);
+
+                var codes = yearCodes(payload, startYear, endYear);
+                var claims = rangeValues(payload.claim_prefix.ALL, codes)[0];
+                var payments = rangeValues([payload.payment_prefix], codes)[0];
+                var serverValues = serverSummary(summary, startYear, endYear);
+
+                var values = [numberFormat.format(claims),
+                              serverValues ? serverValues.PRACTNUM : pending,
+                              "$" + numberFormat.format(Math.trunc(payments)),
+                              serverValues ? serverValues.AALENGTH : pending];
+
+                return payload.summary_labels.map(function (label, row) {
+                    return {SUMMSTAT: label, SUMMVAL: values[row]};
+                });
+            },
+
+            //allegation type bar chart
+            allegationBars: function (startYear, endYear, payload, figure) {
+                return codeBars(payload, "ALGNNATR", startYear, endYear, figure);
+            },
+
+            //outcome severity type bar chart
+            outcomeBars: function (startYear, endYear, payload, figure) {
+                return codeBars(payload, "OUTCOME", startYear, endYear, figure);
+            },
+
+            //choropleth of claims by US state, with the hover values of the server summary once it arrives
+            choropleth: function (startYear, endYear, summary, payload, figure) {
+                checkYears(startYear, endYear);
+
+                var codes = yearCodes(payload, startYear, endYear);
+                var counts = rangeValues(payload.claim_prefix.WORKSTAT, codes);
+                var serverValues = serverSummary(summary, startYear, endYear);
+                var locations = [];
+                var z = [];
+                var customdata = [];
+
+                payload.labels.WORKSTAT.forEach(function (state, groupCode) {
+                    if (counts[groupCode] > 0) {
+                        locations.push(state);
+                        z.push(counts[groupCode]);
+                        customdata.push(serverValues ? serverValues.states[state] : [pending, pending, pending, pending, pending, pending]);
+                    }
+                });
+
+                return updateTrace(figure, {locations: locations, z: z, customdata: customdata});
+            }
+        };
+    })()
+});
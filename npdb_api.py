@@ -0,0 +1,185 @@
+import json
+import hashlib
+
+import pandas as pd
+from flask import Response, request
+
+from npdb_results import npdb_result_signature
+
+#******************************************************************************
+#SECTION I: API SETTINGS
+#******************************************************************************
+
+#bump whenever the layout of the responses changes, so the etags of earlier responses stop matching
+npdb_api_version = 1
+
+#parts of the year range summary served under /api/v1/<part>
+npdb_api_parts = {"summary": "overall",
+                  "states": "state",
+                  "state-years": "state_year",
+                  "allegations": "ALGNNATR",
+                  "outcomes": "OUTCOME"}
+
+#number of table rows written to the response at a time, so a large export is streamed in pieces instead of
+#being serialized whole in memory
+npdb_api_chunk_rows = 10000
+
+#raised for a request the api cannot answer, with the http status to answer it with
+class NpdbApiError(Exception):
+
+    def __init__(self, message, status = 400):
+
+        super().__init__(message)
+        self.status = status
+
+#******************************************************************************
+#SECTION II: RESPONSE BODIES
+#******************************************************************************
+
+#version of the data a dataset was loaded from (sizes and modification times of the source files and the
+#settings the figures depend on), as a short tag for the etags of its responses
+def npdb_data_tag(npdb_filepath, distinct_error = None):
+
+    return hashlib.sha256(npdb_result_signature(npdb_filepath, distinct_error).encode()).hexdigest()[:16]
+
+
+#pieces of the csv of a table, header first
+def stream_csv(table_df):
+
+    yield table_df.head(0).to_csv(index = False)
+    for chunk_start in range(0, len(table_df), npdb_api_chunk_rows):
+        yield table_df.iloc[chunk_start:chunk_start + npdb_api_chunk_rows].to_csv(index = False, header = False)
+
+
+#pieces of a json object holding the request details and, under "data", the records of a table (or the
+#values of a single record)
+def stream_json(request_details, table_data):
+
+    yield json.dumps(request_details)[:-1] + ', "data": '
+
+    if isinstance(table_data, pd.Series):
+        yield table_data.to_json()
+    else:
+        yield "["
+        for chunk_start in range(0, len(table_data), npdb_api_chunk_rows):
+            yield ("," if chunk_start else "") + table_data.iloc[chunk_start:chunk_start + npdb_api_chunk_rows].to_json(orient = "records")[1:-1]
+        yield "]"
+
+    yield "}"
+
+#******************************************************************************
+#SECTION III: API ROUTES
+#******************************************************************************
+
+#read-only api serving the figures of the dashboard for a year range as json or csv:
+#
+#   GET /api/v1/<part>?start=1990&end=2004[&format=csv][&WORKSTAT=CA,NY&OUTCOME=1,2]
+#
+#where part is summary, states, state-years, allegations or outcomes, the years default to the years of the
+#data and the cross filter columns take comma separated values.  the figures come from the summaries (and
+#summary caches) of the dashboard callbacks.  every response carries an etag derived from the version of the
+#data and the request, so a client repeating a query with If-None-Match gets a 304 without anything being
+#computed, and a Cache-Control max age letting clients and proxies reuse responses for max_age seconds
+class NpdbApi:
+
+    def __init__(self, get_dataset, summarize, code_labels = None, filter_columns = (), max_age = 300):
+
+        self.get_dataset = get_dataset
+        self.summarize = summarize
+        self.code_labels = code_labels or {}
+        self.filter_columns = list(filter_columns)
+        self.max_age = max_age
+
+
+    #year range, cross filter and format of the request
+    def parse_request(self, npdb_dataset):
+
+        try:
+            start_year = int(request.args.get("start", npdb_dataset.index.first_year))
+            end_year = int(request.args.get("end", npdb_dataset.index.last_year))
+        except ValueError:
+            raise NpdbApiError("start and end must be whole years")
+
+        response_format = request.args.get("format", "json")
+        if response_format not in ("json", "csv"):
+            raise NpdbApiError("format must be json or csv")
+
+        #a column may be repeated (WORKSTAT=CA&WORKSTAT=NY) as well as take comma separated values; every
+        #occurrence counts
+        cross_filter = {}
+        for column, column_occurrences in request.args.lists():
+            if column in ("start", "end", "format"):
+                continue
+            if column not in self.filter_columns:
+                raise NpdbApiError("unknown parameter {} (cross filters: {})".format(column, ", ".join(self.filter_columns) or "off"))
+
+            #values are matched to the values found in the records by their text; values not found select nothing
+            known_values = {str(value): value for value in npdb_dataset.bitmap_index.values[column]}
+            column_values = ",".join(column_occurrences).split(",")
+            cross_filter[column] = sorted({known_values.get(value, value) for value in column_values if value}, key = str)
+
+        return start_year, end_year, {column: values for column, values in cross_filter.items() if values}, response_format
+
+
+    #table (or single record) of one part of the year range summary, with the abbreviations and descriptions of
+    #coded columns
+    def build_table(self, npdb_dataset, summary_part, start_year, end_year, cross_filter):
+
+        npdb_summary = self.summarize(npdb_dataset, start_year, end_year, cross_filter)
+        table_data = npdb_summary[summary_part]
+
+        if isinstance(table_data, dict):
+            return pd.Series(table_data, dtype = object)
+
+        if summary_part in self.code_labels:
+            code_columns = {"{}_{}".format(summary_part, label_name): table_data[summary_part].map(label_mapping)
+                            for label_name, label_mapping in self.code_labels[summary_part].items()}
+            table_data = table_data.assign(**code_columns)
+
+        return table_data
+
+
+    def serve_part(self, part):
+
+        npdb_dataset = self.get_dataset()
+
+        try:
+            if part not in npdb_api_parts:
+                raise NpdbApiError("unknown part {} (parts: {})".format(part, ", ".join(npdb_api_parts)), status = 404)
+            start_year, end_year, cross_filter, response_format = self.parse_request(npdb_dataset)
+        except NpdbApiError as api_error:
+            return Response(json.dumps({"error": str(api_error)}), status = api_error.status, mimetype = "application/json")
+
+        request_key = json.dumps([npdb_api_version, npdb_dataset.data_tag, part, start_year, end_year, cross_filter, response_format],
+                                 sort_keys = True, default = str)
+        etag = hashlib.sha256(request_key.encode()).hexdigest()[:32]
+        cache_headers = {"Cache-Control": "public, max-age={}".format(self.max_age)}
+
+        if request.if_none_match.contains(etag):
+            response = Response(status = 304, headers = cache_headers)
+            response.set_etag(etag)
+            return response
+
+        table_data = self.build_table(npdb_dataset, npdb_api_parts[part], start_year, end_year, cross_filter)
+
+        if response_format == "csv":
+            if isinstance(table_data, pd.Series):
+                table_data = table_data.to_frame().T
+            response = Response(stream_csv(table_data), mimetype = "text/csv", headers = cache_headers)
+            response.headers["Content-Disposition"] = "attachment; filename=npdb_{}_{}_{}.csv".format(part, start_year, end_year)
+        else:
+            request_details = {"part": part,
+                               "start_year": start_year,
+                               "end_year": end_year,
+                               "filters": cross_filter,
+                               "approximate_counts": npdb_dataset.index.approximate_counts}
+            response = Response(stream_json(request_details, table_data), mimetype = "application/json", headers = cache_headers)
+
+        response.set_etag(etag)
+        return response
+
+
+    #install the api routes on the flask server of the dashboard
+    def init_app(self, server, route = "/api/v1/<part>"):
+
+        server.add_url_rule(route, "npdb_api", self.serve_part)
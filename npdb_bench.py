@@ -0,0 +1,275 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import argparse
+import datetime
+import statistics
+import subprocess
+
+from npdb_synth import write_npdb_synth
+
+#******************************************************************************
+#SECTION I: BENCHMARK SETTINGS
+#******************************************************************************
+
+#bump whenever the layout of the results file changes
+npdb_bench_version = 2
+
+#dashboard callbacks timed by the benchmark, all taking the starting and ending year
+npdb_bench_callbacks = ["filter_malp_geo_tbl", "calc_tot_allsumm_tbl", "plot_algtyp_barchart", "plot_outc_bartchart", "plot_malp_choropleth"]
+
+#backends the records can be summarized from, with the dashboard settings selecting them: the records held in
+#memory (pandas) or kept in an embedded database file (NPDB_SQL_BACKEND)
+npdb_bench_backends = {"pandas": {},
+                       "sqlite": {"NPDB_SQL_BACKEND": "sqlite"},
+                       "duckdb": {"NPDB_SQL_BACKEND": "duckdb"}}
+
+#******************************************************************************
+#SECTION II: TIMING THE DASHBOARD
+#******************************************************************************
+
+#narrow (middle year), wide (middle half of the years) and full year ranges of the data
+def npdb_bench_year_ranges(first_year, last_year):
+
+    middle_year = (first_year + last_year) // 2
+    quarter_span = (last_year - first_year) // 4
+
+    return {"narrow": (middle_year, middle_year),
+            "wide": (first_year + quarter_span, last_year - quarter_span),
+            "full": (first_year, last_year)}
+
+
+#min, median and max of repeated timings
+def summarize_timings(timings):
+
+    return {"min": min(timings), "median": statistics.median(timings), "max": max(timings), "runs": len(timings)}
+
+
+#time each dashboard callback over each year range, both with the year range summary cache cleared first
+#(the work done on a new year range) and with it warm (the work done when the range was seen before)
+def time_npdb_callbacks(npdb_dashboard, repeats):
+
+    callback_results = []
+
+    for range_name, (start_year, end_year) in npdb_bench_year_ranges(npdb_dashboard.npdb_dataset.index.first_year, npdb_dashboard.npdb_dataset.index.last_year).items():
+        for callback_name in npdb_bench_callbacks:
+            callback = getattr(npdb_dashboard, callback_name)
+            uncached_timings = []
+            cached_timings = []
+
+            for _ in range(repeats):
+                npdb_dashboard.npdb_dataset.year_summaries.cache_clear()
+                callback_start = time.perf_counter()
+                callback(start_year, end_year)
+                uncached_timings.append(time.perf_counter() - callback_start)
+
+                callback_start = time.perf_counter()
+                callback(start_year, end_year)
+                cached_timings.append(time.perf_counter() - callback_start)
+
+            callback_results.append({"callback": callback_name,
+                                     "range": range_name,
+                                     "start_year": start_year,
+                                     "end_year": end_year,
+                                     "uncached_seconds": summarize_timings(uncached_timings),
+                                     "cached_seconds": summarize_timings(cached_timings)})
+
+    return callback_results
+
+
+#digest of the year range summary of each year range (values and types of every part), so the outputs of
+#different backends can be compared without shipping the summaries between processes
+def digest_npdb_summaries(npdb_dashboard):
+
+    summary_digests = {}
+
+    for range_name, (start_year, end_year) in npdb_bench_year_ranges(npdb_dashboard.npdb_dataset.index.first_year, npdb_dashboard.npdb_dataset.index.last_year).items():
+        summary_hash = hashlib.sha256()
+        for part_name, summary_part in npdb_dashboard.summarize_npdb_years(npdb_dashboard.npdb_dataset, start_year, end_year).items():
+            if isinstance(summary_part, dict):
+                part_text = json.dumps({key: [repr(value), type(value).__name__] for key, value in summary_part.items()}, sort_keys = True)
+            else:
+                part_text = summary_part.to_json(orient = "split", double_precision = 15) + str(summary_part.dtypes.to_dict())
+            summary_hash.update("{}:{}\n".format(part_name, part_text).encode())
+        summary_digests[range_name] = summary_hash.hexdigest()
+
+    return summary_digests
+
+
+#run inside a fresh process started by run_npdb_dashboard: import the dashboard (which loads the data and
+#builds the year index), optionally time its callbacks, and print the results as the last line of output
+def npdb_bench_child(repeats):
+
+    from npdb_ingest import peak_memory_bytes
+
+    import_start = time.perf_counter()
+    import npdb_dashboard
+    child_results = {"import_seconds": time.perf_counter() - import_start,
+                     "load_report": npdb_dashboard.npdb_load_report,
+                     "peak_memory_bytes": peak_memory_bytes()}
+
+    if repeats > 0:
+        child_results["callbacks"] = time_npdb_callbacks(npdb_dashboard, repeats)
+        child_results["summary_digests"] = digest_npdb_summaries(npdb_dashboard)
+
+    print(json.dumps(child_results, default = str))
+
+
+#start the dashboard in a new python process with the given environment, returning the child results and
+#the wall time of the whole process (interpreter and library imports included)
+def run_npdb_dashboard(dashboard_env, repeats):
+
+    process_start = time.perf_counter()
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--child-repeats", str(repeats)],
+                               env = dashboard_env, cwd = os.path.dirname(os.path.abspath(__file__)),
+                               capture_output = True, text = True, check = True)
+    process_seconds = time.perf_counter() - process_start
+
+    child_results = json.loads(completed.stdout.strip().splitlines()[-1])
+    child_results["process_seconds"] = process_seconds
+
+    return child_results
+
+#******************************************************************************
+#SECTION III: BENCHMARK RUNS
+#******************************************************************************
+
+#benchmark the dashboard on one input file (or directory of partition files): a cold start that reads the
+#csv file(s) into a fresh cache directory (or database file, for the sql backends), a warm start that reuses
+#it, and the callbacks timed in a third process; a shared snapshot directory (NPDB_SHARED_DIR) is likewise
+#made fresh under work_dir
+def bench_npdb_file(npdb_filepath, work_dir, repeats, extra_env):
+
+    cache_dir = os.path.join(work_dir, "cache")
+    shared_dir = os.path.join(work_dir, "shared")
+    shutil.rmtree(cache_dir, ignore_errors = True)
+    shutil.rmtree(shared_dir, ignore_errors = True)
+
+    dashboard_env = dict(os.environ, NPDB_FILEPATH = npdb_filepath, NPDB_CACHE_DIR = cache_dir, **extra_env)
+    if "NPDB_SHARED_DIR" in extra_env:
+        dashboard_env["NPDB_SHARED_DIR"] = shared_dir
+
+    startup_results = {"cold": run_npdb_dashboard(dashboard_env, 0), "warm": run_npdb_dashboard(dashboard_env, 0)}
+    callback_results = run_npdb_dashboard(dashboard_env, repeats)
+
+    return {"startup": startup_results,
+            "callbacks": callback_results["callbacks"],
+            "summary_digests": callback_results["summary_digests"]}
+
+
+#commit of the code being benchmarked, when run from a git checkout
+def npdb_git_commit():
+
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)),
+                              capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#benchmark the dashboard on synthetic files of each of the row counts (generated once per row count and
+#seed under work_dir) and on any given input files, each with every backend in turn, returning the results as
+#a json serializable dict; the summaries of the backends are compared by their digests
+def run_npdb_bench(row_counts, work_dir, input_paths = (), seed = 0, parts = 1, repeats = 5, extra_env = None, backends = ("pandas",)):
+
+    extra_env = extra_env or {}
+    os.makedirs(work_dir, exist_ok = True)
+    bench_results = {"bench_version": npdb_bench_version,
+                     "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                     "git_commit": npdb_git_commit(),
+                     "python": platform.python_version(),
+                     "platform": platform.platform(),
+                     "cpu_count": os.cpu_count(),
+                     "settings": {"seed": seed, "parts": parts, "repeats": repeats, "env": extra_env, "backends": list(backends)},
+                     "datasets": []}
+
+    datasets = [("synthetic", n_rows) for n_rows in row_counts] + [("input", input_path) for input_path in input_paths]
+
+    for dataset_kind, dataset in datasets:
+        dataset_results = {"kind": dataset_kind}
+
+        if dataset_kind == "synthetic":
+            npdb_filepath = os.path.join(work_dir, "npdb_synth_{}_{}{}".format(dataset, seed, "" if parts > 1 else ".csv"))
+            dataset_results["rows"] = dataset
+
+            if not os.path.exists(npdb_filepath):
+                generate_start = time.perf_counter()
+                write_npdb_synth(npdb_filepath, dataset, seed = seed, parts = parts)
+                dataset_results["generate_seconds"] = time.perf_counter() - generate_start
+        else:
+            npdb_filepath = os.path.abspath(dataset)
+
+        dataset_results["path"] = npdb_filepath
+        dataset_results["backends"] = {backend: bench_npdb_file(npdb_filepath, work_dir, repeats, dict(extra_env, **npdb_bench_backends[backend]))
+                                       for backend in backends}
+        dataset_results["identical_outputs"] = len({json.dumps(backend_results["summary_digests"], sort_keys = True)
+                                                    for backend_results in dataset_results["backends"].values()}) == 1
+        bench_results["datasets"].append(dataset_results)
+
+        print(format_bench_results(dataset_results))
+
+    return bench_results
+
+
+#console table of the results of one dataset: the startup of each backend, then the median callback times of
+#the backends side by side
+def format_bench_results(dataset_results):
+
+    report_lines = ["{}:".format(dataset_results["path"])]
+
+    for backend, backend_results in dataset_results["backends"].items():
+        startup_results = backend_results["startup"]
+        report_lines.append("  {:<8} cold start {:.2f}s (dashboard import {:.2f}s), warm start {:.2f}s (dashboard import {:.2f}s), peak memory {:.0f} MB".format(
+                                backend, startup_results["cold"]["process_seconds"], startup_results["cold"]["import_seconds"],
+                                startup_results["warm"]["process_seconds"], startup_results["warm"]["import_seconds"],
+                                startup_results["cold"]["peak_memory_bytes"] / 1024 ** 2))
+
+    report_lines.append("  {:<22} {:<6} {:<9}  {}".format("callback", "range", "years", "  ".join("{:>27}".format(backend + " uncached / cached ms")
+                                                                                                    for backend in dataset_results["backends"])))
+
+    backend_callbacks = [backend_results["callbacks"] for backend_results in dataset_results["backends"].values()]
+    for callback_results in zip(*backend_callbacks):
+        callback_result = callback_results[0]
+        report_lines.append("  {:<22} {:<6} {:<9}  {}".format(
+                                callback_result["callback"], callback_result["range"], "{}-{}".format(callback_result["start_year"], callback_result["end_year"]),
+                                "  ".join("{:>14.2f} / {:>10.2f}".format(backend_result["uncached_seconds"]["median"] * 1000, backend_result["cached_seconds"]["median"] * 1000)
+                                          for backend_result in callback_results)))
+
+    if len(dataset_results["backends"]) > 1:
+        report_lines.append("  summaries of the backends {}".format("identical" if dataset_results["identical_outputs"] else "DIFFER"))
+
+    return "\n".join(report_lines)
+
+
+#benchmark the dashboard: python npdb_bench.py --rows 100000 1000000 [--input <npdb csv file>] [--backends pandas sqlite]
+#[--output bench.json]
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Time startup and the callbacks of the NPDB dashboard on synthetic or real data")
+    parser.add_argument("--rows", type = int, nargs = "*", default = [100000], help = "row counts of the synthetic files to benchmark")
+    parser.add_argument("--input", nargs = "*", default = [], help = "npdb csv files (or directories of partition files) to benchmark as well")
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed of the synthetic files")
+    parser.add_argument("--parts", type = int, default = 1, help = "number of partition files of each synthetic file")
+    parser.add_argument("--repeats", type = int, default = 5, help = "timed runs of each callback and year range")
+    parser.add_argument("--env", nargs = "*", default = [], help = "extra dashboard settings as NAME=VALUE, e.g. NPDB_APPROX_COUNTS=0.01 or NPDB_SHARED_DIR=1")
+    parser.add_argument("--backends", nargs = "*", default = ["pandas"], choices = list(npdb_bench_backends),
+                        help = "backends to benchmark side by side: records in memory (pandas) or in an embedded database (sqlite, duckdb)")
+    parser.add_argument("--work-dir", default = ".npdb_bench", help = "directory for the synthetic files and caches")
+    parser.add_argument("--output", default = "npdb_bench.json", help = "json file the results are written to")
+    parser.add_argument("--child-repeats", type = int, default = None, help = argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.child_repeats is not None:
+        npdb_bench_child(arguments.child_repeats)
+    else:
+        bench_results = run_npdb_bench(arguments.rows, os.path.abspath(arguments.work_dir), input_paths = arguments.input, seed = arguments.seed,
+                                       parts = arguments.parts, repeats = arguments.repeats,
+                                       extra_env = dict(env_setting.split("=", 1) for env_setting in arguments.env), backends = arguments.backends)
+
+        with open(arguments.output, "w") as output_file:
+            json.dump(bench_results, output_file, indent = 2, default = str)
+        print("Benchmark results written to {}".format(arguments.output))
@@ -0,0 +1,232 @@
+import numpy as np
+import pandas as pd
+
+#******************************************************************************
+#SECTION I: BITMAP SETTINGS
+#******************************************************************************
+
+#coded columns the dashboard can cross filter by
+npdb_cross_filter_columns = ["WORKSTAT", "ALGNNATR", "OUTCOME", "RECTYPE"]
+
+#segments of appended records a bitmap index may gather before a reload rebuilds it, as every selection goes
+#through each segment
+npdb_bitmap_max_segments = 8
+
+#******************************************************************************
+#SECTION II: BIT ARRAYS
+#******************************************************************************
+
+#bitmaps are numpy arrays of bytes holding one bit per record, least significant bit first, so bit p of a
+#bitmap is bit p % 8 of byte p // 8, and and-ing or or-ing bitmaps runs over whole bytes
+
+#number of bits set in each byte value
+npdb_byte_bit_counts = np.unpackbits(np.arange(256, dtype = np.uint8)[:, None], axis = 1).sum(axis = 1)
+
+#bitmap with the bits of a boolean mask set
+def pack_bits(mask):
+
+    return np.packbits(mask, bitorder = "little")
+
+
+#clear the bits before bit start and from bit end onwards of the bytes of a bitmap starting at byte
+#byte_start, in place
+def clip_bits(bitmap_bytes, byte_start, start, end):
+
+    if len(bitmap_bytes) == 0:
+        return bitmap_bytes
+
+    bitmap_bytes[0] &= np.uint8((0xFF << (start - byte_start * 8)) & 0xFF)
+    end_bits = end - (byte_start + len(bitmap_bytes) - 1) * 8
+    if end_bits < 8:
+        bitmap_bytes[-1] &= np.uint8((1 << end_bits) - 1)
+
+    return bitmap_bytes
+
+
+#positions of the set bits of the bytes of a bitmap starting at byte byte_start; only the bytes with a bit
+#set are unpacked, which keeps sparse selections quick
+def bit_positions(bitmap_bytes, byte_start):
+
+    set_bytes = np.flatnonzero(bitmap_bytes)
+    set_bits = np.flatnonzero(np.unpackbits(bitmap_bytes[set_bytes], bitorder = "little"))
+
+    return (set_bytes[set_bits >> 3] + byte_start) * 8 + (set_bits & 7)
+
+#******************************************************************************
+#SECTION III: BITMAP INDEX
+#******************************************************************************
+
+#one bitmap per value of each cross filter column, over the records ordered by year, so the records of a
+#year range are one run of bits and a combination of filters is resolved by or-ing the bitmaps of the
+#selected values of each column and and-ing the columns, over the bytes of that run only
+class BitmapSegment:
+
+    def __init__(self, records_df, filter_columns = npdb_cross_filter_columns):
+
+        record_years = records_df["ORIGYEAR"].to_numpy(dtype = np.int64)
+        self.row_order = np.argsort(record_years, kind = "stable")
+        sorted_years = record_years[self.row_order]
+
+        self.n_rows = len(records_df)
+        self.first_year = int(sorted_years[0]) if self.n_rows else 0
+        self.last_year = int(sorted_years[-1]) if self.n_rows else -1
+        #position of the first record of each year, and of the end of the last year
+        self.year_starts = np.searchsorted(sorted_years, np.arange(self.first_year, self.last_year + 2))
+
+        self.values = {}
+        self.bitmaps = {}
+        for column in filter_columns:
+            value_codes, values = pd.factorize(records_df[column], sort = True)
+            value_codes = value_codes[self.row_order]
+            self.values[column] = values.tolist()
+            self.bitmaps[column] = np.stack([pack_bits(value_codes == value_code) for value_code in range(len(values))]
+                                            or [np.zeros((self.n_rows + 7) // 8, dtype = np.uint8)])
+
+
+    #arrays and settings of the segment
+    def to_arrays(self):
+
+        arrays = {"row_order": self.row_order, "year_starts": self.year_starts}
+        for column, bitmaps in self.bitmaps.items():
+            arrays["bitmaps.{}".format(column)] = bitmaps
+
+        settings = {"n_rows": self.n_rows,
+                    "first_year": self.first_year,
+                    "last_year": self.last_year,
+                    "values": self.values}
+
+        return arrays, settings
+
+
+    #segment over the arrays of to_arrays
+    @classmethod
+    def from_arrays(cls, arrays, settings):
+
+        segment = cls.__new__(cls)
+        segment.row_order = arrays["row_order"]
+        segment.year_starts = arrays["year_starts"]
+        segment.n_rows = settings["n_rows"]
+        segment.first_year = settings["first_year"]
+        segment.last_year = settings["last_year"]
+        segment.values = settings["values"]
+        segment.bitmaps = {column: arrays["bitmaps.{}".format(column)] for column in segment.values}
+
+        return segment
+
+
+    #first and last position (exclusive) of the records between the starting and ending year
+    def year_positions(self, start_year, end_year):
+
+        start_code = min(max(int(np.ceil(start_year)) - self.first_year, 0), len(self.year_starts) - 1)
+        end_code = min(max(int(np.floor(end_year)) - self.first_year + 1, 0), len(self.year_starts) - 1)
+
+        return int(self.year_starts[start_code]), max(int(self.year_starts[end_code]), int(self.year_starts[start_code]))
+
+
+    #bytes of the bitmap of the records between the starting and ending year holding one of the selected values
+    #of every filtered column, from byte byte_start on; filters maps columns to their selected values, and
+    #values not found in the records select nothing
+    def select_bits(self, start_year, end_year, filters):
+
+        start, end = self.year_positions(start_year, end_year)
+        byte_start, byte_end = start // 8, (end + 7) // 8
+        selected = np.full(byte_end - byte_start, 0xFF, dtype = np.uint8)
+
+        for column, column_values in filters.items():
+            value_codes = [self.values[column].index(value) for value in column_values if value in self.values[column]]
+            if not value_codes:
+                return np.zeros(0, dtype = np.uint8), byte_start
+            selected &= np.bitwise_or.reduce(self.bitmaps[column][value_codes, byte_start:byte_end], axis = 0)
+
+        return clip_bits(selected, byte_start, start, end), byte_start
+
+
+    #number of records selected by the year range and filters
+    def count(self, start_year, end_year, filters):
+
+        selected, _ = self.select_bits(start_year, end_year, filters)
+
+        return int(npdb_byte_bit_counts[selected].sum())
+
+
+    #row numbers (positions in records_df) of the records selected by the year range and filters
+    def select(self, start_year, end_year, filters):
+
+        selected, byte_start = self.select_bits(start_year, end_year, filters)
+
+        return self.row_order[bit_positions(selected, byte_start)]
+
+
+#bitmaps of the records for cross filtering (see BitmapSegment), built once at startup (or memory mapped from
+#a shared snapshot) and holding n_values * n_records / 8 bytes.  records appended by a reload get a segment of
+#their own, following the earlier ones in row numbers, so appending never touches the bitmaps already built;
+#appending gives a new index and leaves this one as it is for the requests still using it
+class NpdbBitmapIndex:
+
+    def __init__(self, records_df, filter_columns = npdb_cross_filter_columns):
+
+        self.segments = [BitmapSegment(records_df, filter_columns)]
+        self.row_offsets = [0]
+        self.n_rows = len(records_df)
+        self.values = self.segments[0].values
+
+
+    #index of these records followed by the records of appended_df
+    def append(self, appended_df):
+
+        segment = BitmapSegment(appended_df, list(self.values))
+
+        bitmap_index = self.__class__.__new__(self.__class__)
+        bitmap_index.segments = self.segments + [segment]
+        bitmap_index.row_offsets = self.row_offsets + [self.n_rows]
+        bitmap_index.n_rows = self.n_rows + segment.n_rows
+        bitmap_index.values = {column: sorted(set(column_values) | set(segment.values[column])) for column, column_values in self.values.items()}
+
+        return bitmap_index
+
+
+    #bytes held by the bitmaps
+    @property
+    def nbytes(self):
+
+        return sum(bitmaps.nbytes for segment in self.segments for bitmaps in segment.bitmaps.values())
+
+
+    #arrays and settings of the index, stored as .npy files and json in shared snapshots
+    def to_arrays(self):
+
+        arrays, settings = {}, {"n_rows": self.n_rows, "values": self.values, "row_offsets": self.row_offsets, "segments": []}
+        for segment_number, segment in enumerate(self.segments):
+            segment_arrays, segment_settings = segment.to_arrays()
+            arrays.update({"{}.{}".format(segment_number, name): segment_array for name, segment_array in segment_arrays.items()})
+            settings["segments"].append(segment_settings)
+
+        return arrays, settings
+
+
+    #index over the arrays of to_arrays (which can be memory mapped, as nothing is written to them)
+    @classmethod
+    def from_arrays(cls, arrays, settings):
+
+        bitmap_index = cls.__new__(cls)
+        bitmap_index.segments = [BitmapSegment.from_arrays({name: arrays["{}.{}".format(segment_number, name)] for name in ["row_order", "year_starts"]
+                                                            + ["bitmaps.{}".format(column) for column in segment_settings["values"]]}, segment_settings)
+                                 for segment_number, segment_settings in enumerate(settings["segments"])]
+        bitmap_index.row_offsets = settings["row_offsets"]
+        bitmap_index.n_rows = settings["n_rows"]
+        bitmap_index.values = settings["values"]
+
+        return bitmap_index
+
+
+    #number of records selected by the year range and filters
+    def count(self, start_year, end_year, filters):
+
+        return sum(segment.count(start_year, end_year, filters) for segment in self.segments)
+
+
+    #row numbers (positions in the records) of the records selected by the year range and filters
+    def select(self, start_year, end_year, filters):
+
+        return np.concatenate([segment.select(start_year, end_year, filters) + row_offset
+                               for segment, row_offset in zip(self.segments, self.row_offsets)])
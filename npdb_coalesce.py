@@ -0,0 +1,149 @@
+import threading
+import contextlib
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+#******************************************************************************
+#SECTION I: COALESCING SETTINGS
+#******************************************************************************
+
+#number of sessions whose latest request generations are remembered (the least recently active are forgotten)
+npdb_max_sessions = 10000
+
+#statistics of a summary cache, the counters of functools.lru_cache plus the requests that shared a computation
+#already running and the computations dropped because every request waiting on them had been superseded
+NpdbCacheInfo = collections.namedtuple("NpdbCacheInfo", ["hits", "misses", "maxsize", "currsize", "coalesced", "superseded"])
+
+#raised to a request whose computation was dropped because a newer request of the same session replaced it
+class NpdbSuperseded(Exception):
+    pass
+
+#******************************************************************************
+#SECTION II: SESSION GENERATIONS
+#******************************************************************************
+
+#generation of the latest request of each session and callback: every request advances the generation of its
+#(session, callback) pair, so a request whose generation is no longer the latest has been superseded by a
+#newer one (e.g. by the next digit typed into a year input) and its output would be thrown away
+class NpdbSessionGenerations:
+
+    def __init__(self, max_sessions = npdb_max_sessions):
+
+        self.max_sessions = max_sessions
+        self.generations = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    #advance the generation of a request key and return a function telling whether the request has since
+    #been superseded
+    def advance(self, request_key):
+
+        with self.lock:
+            generation = self.generations.pop(request_key, 0) + 1
+            self.generations[request_key] = generation
+            while len(self.generations) > self.max_sessions:
+                self.generations.popitem(last = False)
+
+        return lambda: self.generations.get(request_key, generation) != generation
+
+#******************************************************************************
+#SECTION III: COALESCING SUMMARY CACHE
+#******************************************************************************
+
+#computation of one summary, shared by every request asking for it while it runs
+class NpdbFlight:
+
+    def __init__(self):
+
+        self.future = None
+        self.waiters = []
+
+
+#least recently used cache of summaries computed on a bounded pool of worker threads, called like the function
+#it caches.  a summary is computed once however many requests ask for it at the same time: requests arriving
+#while it is computed wait on the same computation instead of starting their own.  requests may pass
+#is_stale, a function telling whether their output is no longer wanted; a computation still queued when every
+#request waiting on it has gone stale is dropped and those requests get NpdbSuperseded.  a computation that
+#has started runs to the end (threads cannot be interrupted), and its summary is cached
+class NpdbSummaryCache:
+
+    def __init__(self, compute, maxsize, executor, wait_phase = None):
+
+        self.compute = compute
+        self.maxsize = maxsize
+        self.executor = executor
+        self.wait_phase = wait_phase or contextlib.nullcontext
+
+        self.summaries = collections.OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.coalesced = self.superseded = 0
+
+
+    def __call__(self, *key, is_stale = None):
+
+        with self.lock:
+            if key in self.summaries:
+                self.hits += 1
+                self.summaries.move_to_end(key)
+                return self.summaries[key]
+
+            flight = self.flights.get(key)
+            if flight is None:
+                self.misses += 1
+                flight = self.flights[key] = NpdbFlight()
+                flight.waiters.append(is_stale)
+                flight.future = self.executor.submit(self.run, key, flight)
+            else:
+                self.coalesced += 1
+                flight.waiters.append(is_stale)
+
+        #time spent queued, computing or waiting on another request's computation
+        with self.wait_phase():
+            return flight.future.result()
+
+
+    #compute a summary on a worker thread, unless every request waiting on it has been superseded
+    def run(self, key, flight):
+
+        with self.lock:
+            if all((is_stale is not None) and is_stale() for is_stale in flight.waiters):
+                self.superseded += 1
+                del self.flights[key]
+                raise NpdbSuperseded(key)
+
+        try:
+            summary = self.compute(*key)
+        except BaseException:
+            with self.lock:
+                del self.flights[key]
+            raise
+
+        with self.lock:
+            del self.flights[key]
+            self.summaries[key] = summary
+            while len(self.summaries) > self.maxsize:
+                self.summaries.popitem(last = False)
+
+        return summary
+
+
+    def cache_info(self):
+
+        with self.lock:
+            return NpdbCacheInfo(self.hits, self.misses, self.maxsize, len(self.summaries), self.coalesced, self.superseded)
+
+
+    def cache_clear(self):
+
+        with self.lock:
+            self.summaries.clear()
+            self.hits = self.misses = self.coalesced = self.superseded = 0
+
+
+#bounded pool of threads computing summaries, shared by every session so that one session typing quickly
+#cannot take more than the pool's workers away from the others
+def npdb_summary_executor(max_workers):
+
+    return ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = "npdb-summary")
@@ -1,32 +1,305 @@
+import os
+import time
+import uuid
+import functools
 import pandas as pd
 import numpy as np
 import plotly as pyo
 import plotly.graph_objects as go
 import plotly.express as px
 import dash
-import dash_core_components as dcc
-import dash_html_components as html
+from dash import dcc, html, dash_table, Patch
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 from dash.exceptions import PreventUpdate
-import dash_table
-from dash_table.Format import Format, Symbol, Group
+from flask import jsonify
+from dash.dash_table.Format import Format, Symbol, Group
+from npdb_ingest import load_npdb_df, stream_npdb_index, format_load_report
+from npdb_index import NpdbYearIndex, NpdbIndexBuilder, npdb_percentiles, npdb_percentile_columns, summarize_npdb_records
+from npdb_shared import load_shared_npdb, format_shared_report
+from npdb_sql import load_npdb_sql_index, format_sql_report
+from npdb_metrics import NpdbMetrics
+from npdb_table import query_table_page
+from npdb_results import warm_result_store, format_store_report, lookup_summary
+from npdb_bitmaps import NpdbBitmapIndex, npdb_cross_filter_columns, npdb_bitmap_max_segments
+from npdb_reload import NpdbDataset, NpdbReloader
+from npdb_coalesce import NpdbSummaryCache, NpdbSessionGenerations, NpdbSuperseded, npdb_summary_executor
+from npdb_api import NpdbApi, npdb_data_tag
 
 #******************************************************************************
 #SECTION I: READING AND CLEANING OF INPUT FILES
 #******************************************************************************
 
-#file path to NPD input file
-npdb_filepath = r"C:\Users\tcphan\OneDrive\Documents\kaggle_projects\NpdbPublicUseData\data\NPDB2004.csv"
-#read in input file into dataframe
-npdb_df = pd.read_csv(npdb_filepath, low_memory = False)
+#file path to NPD input file (can be overridden with the NPDB_FILEPATH environment variable); may also be a
+#directory or glob pattern of partition files such as NPDB2004_1.csv to NPDB2004_16.csv
+npdb_filepath = os.environ.get("NPDB_FILEPATH", r"C:\Users\tcphan\OneDrive\Documents\kaggle_projects\NpdbPublicUseData\data\NPDB2004.csv")
+#directory holding the cleaned feather cache of the input file (defaults to .npdb_cache next to the input file)
+npdb_cache_dir = os.environ.get("NPDB_CACHE_DIR")
+#number of processes used to parse partition files (defaults to the number of cpu cores)
+npdb_ingest_workers = int(os.environ["NPDB_INGEST_WORKERS"]) if "NPDB_INGEST_WORKERS" in os.environ else None
+#relative error (e.g. 0.05) of approximate practitioner and claim counts, which bounds the memory of building
+#the index but makes the index larger and slower at small errors; counts are exact when not set
+npdb_approx_counts_error = float(os.environ["NPDB_APPROX_COUNTS"]) if "NPDB_APPROX_COUNTS" in os.environ else None
+#memory budget in megabytes for streaming input files too large to load; when set, the input file(s) are
+#read in chunks straight into the year index and the records are never held in memory
+npdb_stream_memory_mb = float(os.environ["NPDB_STREAM_MEMORY_MB"]) if "NPDB_STREAM_MEMORY_MB" in os.environ else None
+#directory of memory mapped snapshots shared by all worker processes (e.g. under gunicorn); when set, each
+#worker attaches to the snapshot of the input file(s), which is built by the first worker to start
+npdb_shared_dir = os.environ.get("NPDB_SHARED_DIR")
+#embedded database engine (sqlite, or duckdb when installed) keeping the records on disk for data larger than
+#memory; when set, the records are loaded into a database file once and the summaries are queried from it
+npdb_sql_engine = os.environ.get("NPDB_SQL_BACKEND")
+#file path of the database (defaults to the name of the feather cache with the engine as extension, next to it)
+npdb_sql_path = os.environ.get("NPDB_SQL_PATH")
+#seconds between checks of the input file(s) for a new release, which is then loaded in the background and
+#swapped in once ready, without restarting the dashboard (see npdb_reload.py); no checks when not set
+npdb_reload_seconds = float(os.environ["NPDB_RELOAD_SECONDS"]) if "NPDB_RELOAD_SECONDS" in os.environ else None
 
-#remove dollar sign from string
-npdb_df["TOTALPMT"] = npdb_df["TOTALPMT"].str.replace("$", "")
-#convert total payment column to float data type
-npdb_df["TOTALPMT"] = npdb_df["TOTALPMT"].astype(float)
-#convert year value to integer format
-npdb_df["ORIGYEAR"] = npdb_df["ORIGYEAR"].astype(int)
+if (npdb_sql_engine is not None) and (npdb_approx_counts_error is not None):
+    print("NPDB_APPROX_COUNTS ignored: counts queried from NPDB_SQL_BACKEND are exact")
+    npdb_approx_counts_error = None
+
+#memory mapped arrow table of the cleaned records and bitmap index of the cross filters when attached to a
+#shared snapshot
+npdb_table = None
+npdb_bitmap_index = None
+#builder of the year index of records held in memory, kept when reloading so appended records are added to it
+npdb_index_builder = None
+
+if npdb_shared_dir is not None:
+    #attach to the records, per-year aggregates and bitmaps shared by every worker, without copying them
+    npdb_table, npdb_index, npdb_bitmap_index, npdb_load_report = load_shared_npdb(npdb_filepath, npdb_shared_dir, distinct_error = npdb_approx_counts_error,
+                                                                                   cache_dir = npdb_cache_dir, max_workers = npdb_ingest_workers,
+                                                                                   stream_memory_bytes = int(npdb_stream_memory_mb * 1024 ** 2) if npdb_stream_memory_mb is not None else None)
+    print(format_shared_report(npdb_load_report))
+    npdb_df = None
+elif npdb_sql_engine is not None:
+    #open the database of the input file(s), loading the records into it first when the input files changed
+    npdb_index, npdb_load_report = load_npdb_sql_index(npdb_filepath, npdb_sql_engine, db_path = npdb_sql_path, cache_dir = npdb_cache_dir)
+    print(format_sql_report(npdb_load_report))
+    npdb_df = None
+elif npdb_stream_memory_mb is not None:
+    #stream input file(s) in chunks into per-year aggregates answering any year range
+    npdb_index, npdb_load_report = stream_npdb_index(npdb_filepath, int(npdb_stream_memory_mb * 1024 ** 2),
+                                                     distinct_error = npdb_approx_counts_error, spill_dir = npdb_cache_dir)
+    print(format_load_report(npdb_load_report))
+    npdb_df = None
+else:
+    #read in input file(s) into cleaned dataframe, reusing the on-disk cache when the input files are unchanged
+    npdb_df, npdb_load_report = load_npdb_df(npdb_filepath, cache_dir = npdb_cache_dir, max_workers = npdb_ingest_workers)
+    print(format_load_report(npdb_load_report))
+
+    #build per-year aggregates answering any year range without scanning the records
+    npdb_index_start = time.perf_counter()
+    if npdb_reload_seconds is not None:
+        npdb_index_builder = NpdbIndexBuilder(npdb_approx_counts_error, keep_appearances = False).add_chunk(npdb_df)
+        npdb_index = npdb_index_builder.build()
+    else:
+        npdb_index = NpdbYearIndex(npdb_df, distinct_error = npdb_approx_counts_error)
+    print("NPDB year index built in {:.2f}s".format(time.perf_counter() - npdb_index_start))
+
+#labels marking practitioner and claim counts as estimates in approximate mode
+npdb_count_suffix = " (est.)" if npdb_index.approximate_counts else ""
+npdb_count_prefix = "~" if npdb_index.approximate_counts else ""
+npdb_count_note = " (estimated, typically within {:.1%})".format(npdb_index.distinct_error) if npdb_index.approximate_counts else ""
+
+#combine the additive metrics (claim counts and payment totals) of the selected years in the browser from
+#per-year prefix sums sent once with the page, so only practitioner counts, medians and percentiles go to the
+#server when the years change; needs exact claim counts (see NpdbYearIndex.additive_year_payload)
+npdb_clientside_requested = os.environ.get("NPDB_CLIENTSIDE", "0") == "1"
+npdb_clientside_payload = npdb_index.additive_year_payload() if npdb_clientside_requested else None
+npdb_clientside = npdb_clientside_payload is not None
+if npdb_clientside_requested and not npdb_clientside:
+    print("NPDB_CLIENTSIDE ignored: claim counts are approximate or some claims have several records")
+
+#slice every view by state, allegation group, outcome and record type, picked in the filter dropdowns or by
+#clicking a state or bar (each view is filtered by the selections made in the other views); the records
+#selected by a combination of filters are found in a bitmap index of the coded columns, so cross filtering
+#needs the records (in memory or in a shared snapshot) and is off in clientside mode or with NPDB_CROSS_FILTER=0
+npdb_cross_filter_requested = os.environ.get("NPDB_CROSS_FILTER", "1") == "1"
+npdb_cross_filter = npdb_cross_filter_requested and (not npdb_clientside) and ((npdb_df is not None) or (npdb_table is not None))
+
+#number of year ranges whose summaries are kept in memory (least recently used ranges are evicted first)
+npdb_filter_cache_size = int(os.environ.get("NPDB_FILTER_CACHE_SIZE", 32))
+
+#number of threads computing summaries that are not cached yet, shared by every session; requests for a summary
+#being computed wait for it instead of computing it again, and queued computations whose requests have all been
+#superseded by newer requests of their session are dropped (see npdb_coalesce.py)
+npdb_summary_workers = int(os.environ.get("NPDB_SUMMARY_WORKERS", min(4, os.cpu_count() or 1)))
+
+#milliseconds the year inputs wait after the last keystroke before sending their value, so typing a year such
+#as 2004 sends one value instead of 2, 20, 200 and 2004 (sent on every keystroke when 0)
+npdb_year_debounce_ms = int(os.environ.get("NPDB_YEAR_DEBOUNCE_MS", 300))
+
+#file of the summaries of every year range, computed ahead of time (see npdb_results.py); when set, the
+#summaries are all loaded at startup (and after each reload), after rebuilding the file if it is missing or
+#the input files changed
+npdb_result_store_path = os.environ.get("NPDB_RESULT_STORE")
+
+#seconds clients and proxies may reuse responses of the json/csv api at /api/v1 (see npdb_api.py) before
+#checking them again by their etag
+npdb_api_max_age = int(os.environ.get("NPDB_API_MAX_AGE", 300))
+
+#number of rows per page of the state by year table; only the page on screen is sent to the browser, so the
+#size of the response does not grow with the year range
+npdb_geo_page_size = 25
+
+#number of slowest callback requests whose cProfile is kept in NPDB_PROFILE_DIR (no profiling when 0)
+npdb_profile_slowest = int(os.environ.get("NPDB_PROFILE_SLOWEST", 0))
+npdb_profile_dir = os.environ.get("NPDB_PROFILE_DIR", ".npdb_profiles")
+
+#per-callback phase timings, records scanned and response sizes, served at /metrics
+npdb_metrics = NpdbMetrics(profile_slowest = npdb_profile_slowest, profile_dir = npdb_profile_dir)
+
+#pool computing summaries, and the latest request of each page session and callback
+npdb_summary_pool = npdb_summary_executor(npdb_summary_workers)
+npdb_generations = NpdbSessionGenerations()
+
+#summary statistics of the records of a dataset between the starting and ending year specified by user;
+#computed once per year range and shared by all callbacks, so the callbacks must not modify them
+def summarize_npdb_years(npdb_dataset, malp_start_yr, malp_end_yr):
+
+    if npdb_dataset.results is not None:
+        return lookup_summary(npdb_dataset.results, npdb_dataset.index, malp_start_yr, malp_end_yr)
+    return npdb_dataset.index.summarize(malp_start_yr, malp_end_yr)
+
+
+#summary statistics of the records of a dataset between the starting and ending year selected by a cross
+#filter (a tuple of (column, selected values) pairs); the selected records are summarized straight from the
+#records, giving the same figures as the year index of the whole dataset (with exact counts even in
+#approximate mode)
+def summarize_npdb_selection(npdb_dataset, malp_start_yr, malp_end_yr, cross_filter):
+
+    selected_records = npdb_dataset.take_records(npdb_dataset.bitmap_index.select(malp_start_yr, malp_end_yr, dict(cross_filter)))
+    return summarize_npdb_records(selected_records, malp_start_yr, malp_end_yr)
+
+
+#build what the dashboard serves a dataset with besides its year index: the bitmap index of the cross
+#filters, the stored summaries of every year range, the payload of the clientside callbacks and the summary
+#caches (one per dataset, so a reload starts with empty caches while the old dataset keeps its own until
+#every callback using it has returned), whose computations run on the summary pool and are timed as the
+#aggregate phase of the callbacks waiting for them; a dataset that clientside mode cannot serve is refused
+def build_npdb_dataset(npdb_dataset):
+
+    npdb_dataset.data_tag = npdb_data_tag(npdb_filepath, npdb_approx_counts_error)
+
+    #records appended by a reload (see NpdbDataset) extend the bitmap index and result store of the dataset
+    #they were appended to
+    npdb_previous = npdb_dataset.previous
+    npdb_appended_df = npdb_dataset.appended_df
+    npdb_first_appended_year = int(npdb_appended_df["ORIGYEAR"].min()) if (npdb_appended_df is not None) and len(npdb_appended_df) else None
+
+    #attached from a shared snapshot, or built by every process
+    if npdb_cross_filter and (npdb_dataset.bitmap_index is None):
+        npdb_bitmap_start = time.perf_counter()
+        if (npdb_previous is not None) and (npdb_previous.bitmap_index is not None) and (len(npdb_previous.bitmap_index.segments) < npdb_bitmap_max_segments):
+            npdb_dataset.bitmap_index = npdb_previous.bitmap_index.append(npdb_appended_df) if npdb_first_appended_year is not None else npdb_previous.bitmap_index
+        else:
+            npdb_dataset.bitmap_index = NpdbBitmapIndex(npdb_dataset.npdb_df if npdb_dataset.npdb_df is not None
+                                                        else npdb_dataset.npdb_table.select(["ORIGYEAR"] + npdb_cross_filter_columns).to_pandas())
+        print("NPDB bitmap index built in {:.2f}s ({:.1f} MB)".format(time.perf_counter() - npdb_bitmap_start,
+                                                                      npdb_dataset.bitmap_index.nbytes / 1024 ** 2))
+
+    if npdb_result_store_path is not None:
+        npdb_previous_results = None
+        if (npdb_previous is not None) and (npdb_previous.results is not None):
+            npdb_previous_results = (npdb_previous.results, npdb_previous.results_signature, npdb_previous.index.first_year)
+        npdb_dataset.results, npdb_store_report = warm_result_store(npdb_filepath, npdb_dataset.index, npdb_result_store_path,
+                                                                    distinct_error = npdb_approx_counts_error, previous_results = npdb_previous_results,
+                                                                    first_changed_year = npdb_first_appended_year)
+        npdb_dataset.results_signature = npdb_store_report["signature"]
+        print(format_store_report(npdb_store_report))
+
+    if npdb_clientside and (npdb_dataset.clientside_payload is None):
+        npdb_dataset.clientside_payload = npdb_dataset.index.additive_year_payload()
+        if npdb_dataset.clientside_payload is None:
+            raise ValueError("NPDB_CLIENTSIDE cannot serve the new data: some claims have several records")
+
+    aggregate_phase = functools.partial(npdb_metrics.phase, "aggregate")
+    npdb_dataset.year_summaries = NpdbSummaryCache(functools.partial(summarize_npdb_years, npdb_dataset), npdb_filter_cache_size,
+                                                   npdb_summary_pool, wait_phase = aggregate_phase)
+    npdb_dataset.selection_summaries = NpdbSummaryCache(functools.partial(summarize_npdb_selection, npdb_dataset), npdb_filter_cache_size,
+                                                        npdb_summary_pool, wait_phase = aggregate_phase)
+
+    return npdb_dataset
+
+
+#swap in a reloaded dataset; callbacks read the global once, so each of them sees one version of the data
+def swap_npdb_dataset(new_dataset):
+
+    global npdb_dataset
+    npdb_dataset = new_dataset
+
+
+#dataset being served
+npdb_dataset = NpdbDataset(npdb_df, npdb_table, npdb_index, npdb_load_report)
+npdb_dataset.clientside_payload = npdb_clientside_payload
+npdb_dataset.bitmap_index = npdb_bitmap_index
+npdb_dataset = build_npdb_dataset(npdb_dataset)
+
+#drop the startup references, so the records of a replaced dataset can be freed
+del npdb_df, npdb_table, npdb_index, npdb_bitmap_index, npdb_clientside_payload
+
+if npdb_reload_seconds is not None:
+    npdb_reloader = NpdbReloader(npdb_filepath, npdb_dataset, build_npdb_dataset, swap_npdb_dataset, npdb_reload_seconds,
+                                 distinct_error = npdb_approx_counts_error, cache_dir = npdb_cache_dir,
+                                 stream_memory_bytes = int(npdb_stream_memory_mb * 1024 ** 2) if npdb_stream_memory_mb is not None else None,
+                                 shared_dir = npdb_shared_dir, sql_engine = npdb_sql_engine, sql_path = npdb_sql_path,
+                                 index_builder = npdb_index_builder).start()
+del npdb_index_builder
+
+
+#cross filter of the views as a hashable tuple of (column, selected values) pairs, leaving out the column of
+#the view asking for it, which is not filtered by its own selections
+def cross_filter_key(cross_filter, own_column = None):
+
+    return tuple((column, tuple(sorted(values))) for column, values in sorted((cross_filter or {}).items())
+                 if values and (column != own_column))
+
+
+#function telling whether a request of a callback from a page session has been superseded by a newer request
+#of the same callback and session, or None when the callback is called outside a page session
+def track_npdb_request(session_id, callback_name):
+
+    if session_id is None:
+        return None
+
+    return npdb_generations.advance((session_id, callback_name))
+
+
+#summary statistics of the year range and cross filter for a callback (or api request, which passes the
+#dataset it answers from), timed as its filter phase (computing a summary that is not cached yet is timed as the
+#aggregate phase); a callback whose summary was dropped because its session has sent a newer request leaves
+#its output as it is
+def filter_npdb_years(malp_start_yr, malp_end_yr, cross_filter = None, own_column = None, is_stale = None, dataset = None):
+
+    dataset = dataset or npdb_dataset
+    cross_filter = cross_filter_key(cross_filter, own_column) if npdb_cross_filter else ()
+
+    with npdb_metrics.phase("filter"):
+        try:
+            if not cross_filter:
+                npdb_metrics.add_rows(dataset.index.count_records(malp_start_yr, malp_end_yr))
+                return dataset.year_summaries(malp_start_yr, malp_end_yr, is_stale = is_stale)
+
+            npdb_metrics.add_rows(dataset.bitmap_index.count(malp_start_yr, malp_end_yr, dict(cross_filter)))
+            return dataset.selection_summaries(malp_start_yr, malp_end_yr, cross_filter, is_stale = is_stale)
+        except NpdbSuperseded:
+            raise PreventUpdate
+
+
+#hit/miss counters of a summary cache, with the requests that shared a running computation and the queued
+#computations dropped as superseded
+def npdb_filter_cache_stats(summary_cache):
+
+    cache_info = summary_cache.cache_info()
+
+    return {"hits": cache_info.hits,
+            "misses": cache_info.misses,
+            "maxsize": cache_info.maxsize,
+            "currsize": cache_info.currsize,
+            "coalesced": cache_info.coalesced,
+            "superseded": cache_info.superseded}
 
 #******************************************************************************
 #SECTION II: STYLE/FORMATTING PARAMETERS
@@ -43,6 +316,72 @@ danger_color = "rgb(217, 83, 79)"
 light_color = "rgb(248, 245, 240)"
 dark_color = "rgb(62, 63, 58)"
 
+#mapping of allegation group raw values to abbreviated code values
+algtyp_rwab_mapping = {1: "DR",
+                       10: "AR",
+                       20: "SR",
+                       30: "MR",
+                       40: "IVB",
+                       50: "OR",
+                       60: "TR",
+                       70: "MR",
+                       80: "EPR",
+                       90: "OM",
+                       100: "BHR"}
+
+#mapping of allegation group raw values to full description
+algtyp_rwds_mapping = {1: "Diagnosis Related",
+                       10: "Anesthesia Related",
+                       20: "Surgery Related",
+                       30: "Medication Related",
+                       40: "IV & Blood Products Related",
+                       50: "Obstetrics Related",
+                       60: "Treatment Related",
+                       70: "Monitoring Related",
+                       80: "Equipment/Product Related",
+                       90: "Other Miscellaneous",
+                       100: "Behavioral Health Related"}
+
+#mapping of outcome raw value to abbreviate code
+outc_rwab_mapping = {1: "EM",
+                     2: "INS",
+                     3: "MIT",
+                     4: "MAT",
+                     5: "MIP",
+                     6: "SP",
+                     7: "MAP",
+                     8: "QBL",
+                     9: "DE",
+                     10: "CBD"}
+
+#mapping of outcome raw value to full code description
+outc_rwds_mapping = {1: "Emotional",
+                     2: "Insignificant",
+                     3: "Minor Temporary",
+                     4: "Major Temporary",
+                     5: "Minor Permanent",
+                     6: "Significant Permanent",
+                     7: "Major Permanent",
+                     8: "Quadriplegic/Brain Damage/Lifelong Care",
+                     9: "Death",
+                     10: "Cannot Be Determined"}
+
+#mapping of record type raw values to full description
+rectype_rwds_mapping = {"A": "Adverse Action (Old Format)",
+                        "C": "Adverse Action",
+                        "M": "Malpractice Payment (Old Format)",
+                        "P": "Malpractice Payment"}
+
+#descriptions of the values of each cross filter column shown in its dropdown, and the dropdown placeholders
+npdb_filter_value_labels = {"WORKSTAT": {},
+                            "ALGNNATR": algtyp_rwds_mapping,
+                            "OUTCOME": outc_rwds_mapping,
+                            "RECTYPE": rectype_rwds_mapping}
+npdb_filter_placeholders = {"WORKSTAT": "All States",
+                            "ALGNNATR": "All Allegation Types",
+                            "OUTCOME": "All Outcomes",
+                            "RECTYPE": "All Record Types"}
+
 #******************************************************************************
 #SECTION III: DEFINE APP DASHBOARD
 #******************************************************************************
@@ -50,8 +389,142 @@ dark_color = "rgb(62, 63, 58)"
 #initialize dash application
 app = dash.Dash(__name__, external_stylesheets = [dbc.themes.SANDSTONE])
 
-#define the layout for the dashboard
-app.layout = html.Div(style = {"backgroundColor": tertiary_color},
+#flask server behind the app, for serving with several worker processes (e.g. gunicorn npdb_dashboard:server)
+server = app.server
+
+#labels of the rows of the summary table across all US states
+tot_allsumm_labels = ["# OF MALPRACTICE CLAIMS" + npdb_count_suffix.upper() + ":",
+                      "# OF LIABLE PRACTITIONERS" + npdb_count_suffix.upper() + ":",
+                      "TOTAL MALPRACTICE PAYMENT:",
+                      "MEDIAN ADVERSE EVENT LENGTH:"]
+
+#figure skeletons (layout, colors and hover templates) built once at startup; the callbacks only send the
+#data arrays of their traces as partial updates
+def build_algtyp_skeleton():
+
+    algtyp_fig = px.bar(data_frame = pd.DataFrame({"ALGNNATR_ABBR": pd.Series(dtype = object), "SEQNO": pd.Series(dtype = np.int64)}),
+                        x = "ALGNNATR_ABBR", y = "SEQNO", color_discrete_sequence = ["rgb(87, 167, 113)"])
+    algtyp_fig.update_layout(yaxis = {"title": "", "gridcolor": dark_color},
+                             xaxis = {"title": "", "showline": True, "linecolor": dark_color},
+                             title= {"text": "<b># OF MALPRACTICE CLAIMS" + npdb_count_suffix.upper() + " BY ALLEGATION TYPE:</b>",
+                                     "font": dict(size=10),
+                                     "xanchor": "left"},
+                             font = {"size": 8},
+                             margin = dict(l=0, b=0),
+                             width = 480,
+                             height = 250,
+                             paper_bgcolor = tertiary_color,
+                             plot_bgcolor = tertiary_color,
+                             hoverlabel = {"bgcolor": "rgb(99, 198, 132)", "font": dict(size=8)})
+    algtyp_fig.update_traces(hovertemplate = "<b>Allegation Type:</b> %{customdata}<br>" +
+                                             "<b># of Claims" + npdb_count_suffix + ":</b> %{y:,}")
+
+    return algtyp_fig
+
+
+def build_outc_skeleton():
+
+    outc_fig = px.bar(data_frame = pd.DataFrame({"OUTCOME_ABBR": pd.Series(dtype = object), "SEQNO": pd.Series(dtype = np.int64)}),
+                      x = "OUTCOME_ABBR", y = "SEQNO", color_discrete_sequence = ["rgb(160, 56, 43)"])
+    outc_fig.update_layout(yaxis = {"title": "", "gridcolor": dark_color},
+                           xaxis = {"title": "", "showline": True, "linecolor": dark_color},
+                           title = {"text": "<b># OF MALPRACTICE CLAIMS" + npdb_count_suffix.upper() + " BY SEVERITY OF INJURY:</b>",
+                                    "font": dict(size = 10),
+                                    "xanchor": "left"},
+                           font = {"size": 8},
+                           margin = dict(l=0, b=0),
+                           width = 480,
+                           height = 250,
+                           paper_bgcolor = tertiary_color,
+                           plot_bgcolor = tertiary_color,
+                           hoverlabel = {"bgcolor": "rgb(223, 98, 83)", "font": dict(size=8)})
+    outc_fig.update_traces(hovertemplate = "<b>Outcome Type:</b> %{customdata}<br>" +
+                                           "<b># of Claims" + npdb_count_suffix + ":</b> %{y:,}")
+
+    return outc_fig
+
+
+def build_malp_choropleth_skeleton():
+
+    #plot choropleth of malpractice cases by US state
+    malp_chorodata = [go.Choropleth(locationmode = "USA-states",
+                         locations = [],
+                         z = [],
+                         colorscale = "Redor",
+                         colorbar = dict(title = dict(text = "<b># of Records" + npdb_count_suffix + "</b>", side = "right"),
+                                         x = 0.95,
+                                         separatethousands = True,
+                                         showticklabels = True,
+                                         thickness = 10,
+                                         tickfont = dict(size = 8)),
+                         hovertemplate = "<b>%{location}</b><br>" +
+                                         "# of Practitioners" + npdb_count_suffix + ": %{customdata[0]: ,}<br>" +
+                                         "# of Records" + npdb_count_suffix + ": %{z: ,}<br>" +
+                                         "Median Payment: $%{customdata[1]: ,}<br>" +
+                                         "Payment P25-P75: $%{customdata[3]: ,} - $%{customdata[4]: ,}<br>" +
+                                         "Payment P90: $%{customdata[5]: ,}<br>" +
+                                         "Median Length: %{customdata[2]: ,}" +
+                                         "<extra></extra>",
+                         marker_line_width = 0 #removes border bolding from states in choropleth map
+                                   )]
+
+    malp_chorolayout = go.Layout(geo = dict(bgcolor = tertiary_color,
+                                            lakecolor = tertiary_color,
+                                            landcolor = tertiary_color),
+                                 geo_scope = "usa",
+                                 paper_bgcolor = tertiary_color,
+                                 plot_bgcolor = tertiary_color,
+                                 margin = dict(l=10, r=10, b=10, t=10),
+                                 hoverlabel = {"font": {"size": 10}} #set the font size for text in hoverlabel
+                                 )
+
+    return go.Figure(data = malp_chorodata, layout = malp_chorolayout)
+
+
+#row of cross filter dropdowns, one per filterable column with the values found in the records of a dataset,
+#and a button clearing every filter
+def build_cross_filter_row(npdb_dataset):
+
+    filter_cols = [dbc.Col(width = {"size": 2},
+                           children = [dcc.Dropdown(id = "npdb_filter_" + column,
+                                                    options = [{"label": npdb_filter_value_labels[column].get(value, str(value)), "value": value}
+                                                               for value in npdb_dataset.bitmap_index.values[column]],
+                                                    value = [],
+                                                    multi = True,
+                                                    placeholder = npdb_filter_placeholders[column],
+                                                    style = {"fontSize": "12px"})])
+                   for column in npdb_cross_filter_columns]
+
+    clear_col = dbc.Col(width = {"size": 1},
+                        children = [dbc.Button("CLEAR", id = "npdb_clear_filters", color = "secondary", size = "sm")])
+
+    return dbc.Row(justify = "end", style = {"paddingBottom": "10px"}, children = filter_cols + [clear_col])
+
+
+algtyp_skeleton_fig = build_algtyp_skeleton()
+outc_skeleton_fig = build_outc_skeleton()
+malp_choropleth_skeleton_fig = build_malp_choropleth_skeleton()
+
+#per-year prefix sums of a dataset with the labels and code descriptions the clientside callbacks
+#(assets/npdb_clientside.js) need, or None outside clientside mode
+def build_year_payload(npdb_dataset):
+
+    if npdb_dataset.clientside_payload is None:
+        return None
+
+    return dict(npdb_dataset.clientside_payload,
+                codes = {"ALGNNATR": {"abbr": algtyp_rwab_mapping, "desc": algtyp_rwds_mapping},
+                         "OUTCOME": {"abbr": outc_rwab_mapping, "desc": outc_rwds_mapping}},
+                summary_labels = tot_allsumm_labels)
+
+
+#define the layout for the dashboard; it is served by a function, so each page load gets the years, filter
+#values and payload of the dataset served at that moment
+def serve_layout():
+
+    dataset = npdb_dataset
+
+    return html.Div(style = {"backgroundColor": tertiary_color},
                       children = [
         
         
@@ -66,11 +539,12 @@ app.layout = html.Div(style = {"backgroundColor": tertiary_color},
                        dbc.Col(width = {"size": "auto", "order": 2}, style = {"width": "150px"},
                                children = [dbc.Input(id = "malp_start_year",
                                                      type = "number", 
-                                                     min = npdb_df["ORIGYEAR"].min(),
-                                                     max = npdb_df["ORIGYEAR"].max(), 
+                                                     min = dataset.index.first_year,
+                                                     max = dataset.index.last_year, 
                                                      step = 1,
+                                                     debounce = npdb_year_debounce_ms or False,
                                                      style = {"textAlign": "center"},
-                                                     value = npdb_df["ORIGYEAR"].min())]),
+                                                     value = dataset.index.first_year)]),
                                
                        dbc.Col(width = {"size": "auto", "order": 3},
                                children = [html.H3("AND", style = {"fontWeight": "bold", "color": primary_color})]),
@@ -78,14 +552,18 @@ app.layout = html.Div(style = {"backgroundColor": tertiary_color},
                        dbc.Col(width = {"size": "auto", "order": 4}, style = {"width": "150px"},
                                children = [dbc.Input(id = "malp_end_year",
                                                      type = "number", 
-                                                     min = npdb_df["ORIGYEAR"].min(),
-                                                     max = npdb_df["ORIGYEAR"].max(),
+                                                     min = dataset.index.first_year,
+                                                     max = dataset.index.last_year,
                                                      step = 1,
+                                                     debounce = npdb_year_debounce_ms or False,
                                                      style = {"textAlign": "center"},
-                                                     value = npdb_df["ORIGYEAR"].max())])
+                                                     value = dataset.index.last_year)])
                                
                             
                        ]), #end of row 1
+
+                #cross filter dropdowns (left out when cross filtering is off)
+                build_cross_filter_row(dataset) if npdb_cross_filter else html.Div(),
         
                 #row 2
                 dbc.Row(justify = "end",
@@ -126,6 +604,9 @@ app.layout = html.Div(style = {"backgroundColor": tertiary_color},
                                                                                    Enter the starting and ending year of interest under the ___U.S Malpractice Cases Between___ header
                                                                                    located on the right-hand side of the dashboard to query data and summary statistics for the
                                                                                    specified study period. 
+                                                                                   
+                                                                                   Click a state on the map or a bar of the bar charts, or pick values in the filter boxes, to filter
+                                                                                   the other charts and tables; click it again to remove the filter.
                                                                                    """,
                                                                                    style = {"color": light_color}),
                                                                     
@@ -180,9 +661,9 @@ app.layout = html.Div(style = {"backgroundColor": tertiary_color},
                                                                     ]),
                                                                      
                                                 
-                                                dcc.Graph(id = "algtyp_barchart"),
+                                                dcc.Graph(id = "algtyp_barchart", figure = algtyp_skeleton_fig),
                                                 
-                                                dcc.Graph(id = "outc_barchart")
+                                                dcc.Graph(id = "outc_barchart", figure = outc_skeleton_fig)
                                             
                                             
                                                ]),
@@ -194,17 +675,25 @@ app.layout = html.Div(style = {"backgroundColor": tertiary_color},
                                                 html.Div(children = [
                                                                  
                                                                     #choropleth map of malpractice claims across US
-                                                                    dcc.Graph(id = "malp_geo_map"),
+                                                                    dcc.Graph(id = "malp_geo_map", figure = malp_choropleth_skeleton_fig),
                                                 
                                                                     #data table contain summary statistics on malpractice claims across US
                                                                     dash_table.DataTable(id = "malp_geo_tbl", 
                                                          
                                                                                          columns = [{"name": "Year", "id": "ORIGYEAR"},
                                                                                                     {"name": "State", "id": "WORKSTAT"}, 
-                                                                                                    {"name": "# of Practitioners", "id": "PRACTNUM", "type": "numeric", "format": Format(nully = "None", group = Group.yes)}, 
-                                                                                                    {"name": "# of Records", "id": "SEQNO", "type": "numeric", "format": Format(nully = "None", group = Group.yes)}, 
+                                                                                                    {"name": "# of Practitioners" + npdb_count_suffix, "id": "PRACTNUM", "type": "numeric", "format": Format(nully = "None", group = Group.yes)}, 
+                                                                                                    {"name": "# of Records" + npdb_count_suffix, "id": "SEQNO", "type": "numeric", "format": Format(nully = "None", group = Group.yes)}, 
                                                                                                     {"name": "Median Payment", "id": "TOTALPMT", "type": "numeric", "format": Format(nully = "None", symbol = Symbol.yes, symbol_prefix = "$", group = Group.yes)}, 
-                                                                                                    {"name": "Median Length", "id": "AALENGTH", "type": "numeric", "format": Format(nully = "None", group = Group.yes)}],
+                                                                                                    {"name": "Median Length", "id": "AALENGTH", "type": "numeric", "format": Format(nully = "None", group = Group.yes)}] +
+                                                                                                   
+                                                                                                   #payment and length percentiles, hidden until toggled on
+                                                                                                   [{"name": "P{} Payment".format(percentile), "id": "TOTALPMT_P{}".format(percentile), "type": "numeric", "hideable": True, "format": Format(nully = "None", symbol = Symbol.yes, symbol_prefix = "$", group = Group.yes)}
+                                                                                                    for percentile in npdb_percentiles] +
+                                                                                                   [{"name": "P{} Length".format(percentile), "id": "AALENGTH_P{}".format(percentile), "type": "numeric", "hideable": True, "format": Format(nully = "None", group = Group.yes)}
+                                                                                                    for percentile in npdb_percentiles],
+                                                                                         
+                                                                                         hidden_columns = npdb_percentile_columns,
                                                                                          
                                                                                          #style formatting for table
                                                                                          style_table = {"height": "270px", "overflowY": "auto"},
@@ -213,10 +702,22 @@ app.layout = html.Div(style = {"backgroundColor": tertiary_color},
                                                                                          
                                                                                          fixed_rows = {"headers": True}, #keeps header fixed when scrolling vertically through table
                                                                                          
-                                                                                         sort_action = "native", #allow for sorting of columns in table
+                                                                                         page_action = "custom", #pages are cut on the server, which only sends the page on screen
+                                                                                         
+                                                                                         page_current = 0,
+                                                                                         
+                                                                                         page_size = npdb_geo_page_size,
+                                                                                         
+                                                                                         sort_action = "custom", #allow for sorting of columns in table (done on the server)
                                                                                          
                                                                                          sort_mode = "multi", #allow for sorting by multiple columns in table
                                                                                          
+                                                                                         sort_by = [],
+                                                                                         
+                                                                                         filter_action = "custom", #allow for filtering of rows in table (done on the server)
+                                                                                         
+                                                                                         filter_query = "",
+                                                                                         
                                                                                          #style formatting for header
                                                                                          style_header = {"fontWeight": "bold", 
                                                                                                          "font-size": "12px", 
@@ -240,10 +741,14 @@ app.layout = html.Div(style = {"backgroundColor": tertiary_color},
                                                                                          #tooltip for table headers
                                                                                          tooltip = {"ORIGYEAR": {"value": "Year that malpractice/adverse action case record was reported", "use_with": "header"},
                                                                                                     "WORKSTAT": {"value": "Practitioners' work state", "use_with": "header"},
-                                                                                                    "PRACTNUM": {"value": "Total number of unique practitioners with an associated malpractice claim", "use_with": "header"},
-                                                                                                    "SEQNO": {"value": "Total number of malpractice claims", "use_with": "header"},                                                       
+                                                                                                    "PRACTNUM": {"value": "Total number of unique practitioners with an associated malpractice claim" + npdb_count_note, "use_with": "header"},
+                                                                                                    "SEQNO": {"value": "Total number of malpractice claims" + npdb_count_note, "use_with": "header"},                                                       
                                                                                                     "TOTALPMT": {"value": "Median amount paid by malpractice insurer for practitioner's claim", "use_with": "header"},
-                                                                                                    "AALENGTH": {"value": "Median length of adverse action penalty in years", "use_with": "header"}},
+                                                                                                    "AALENGTH": {"value": "Median length of adverse action penalty in years", "use_with": "header"},
+                                                                                                    **{"TOTALPMT_P{}".format(percentile): {"value": "{}th percentile of amounts paid by malpractice insurers for practitioners' claims".format(percentile), "use_with": "header"}
+                                                                                                       for percentile in npdb_percentiles},
+                                                                                                    **{"AALENGTH_P{}".format(percentile): {"value": "{}th percentile of adverse action penalty lengths in years".format(percentile), "use_with": "header"}
+                                                                                                       for percentile in npdb_percentiles}},
                                                                                                     
                                                                                         tooltip_delay = 0, #amount of delay before showing the tooltip description (measured in milliseconds)
                                                                                         tooltip_duration = 3000, #duration time for displaying the tooltip description (measured in milliseconds)
@@ -256,66 +761,157 @@ app.layout = html.Div(style = {"backgroundColor": tertiary_color},
                                                                     ])
                                                 ]), 
                                                 
-                                ]) 
+                                ]), 
+        
+                #per-year prefix sums for the clientside callbacks, sent once with the page (empty unless
+                #NPDB_CLIENTSIDE is set), and the metrics of the selected years that only the server can compute
+                dcc.Store(id = "npdb_year_payload", data = build_year_payload(dataset)),
+                dcc.Store(id = "npdb_server_summary"),
+
+                #selected values of each cross filter column, read by every server side callback
+                dcc.Store(id = "npdb_cross_filter", data = {}),
+
+                #id of the page session, telling the server which requests a newer request supersedes
+                dcc.Store(id = "npdb_session", data = uuid.uuid4().hex)
         
-                    ]) #end of app.layout
+                    ]) #end of layout
+
+
+app.layout = serve_layout
 
 
 #******************************************************************************
 #SECTION IV: DEFINE APP CALLBACKS
 #******************************************************************************
 
+#hit/miss counters of the shared year range and cross filter summaries
+@app.server.route("/cache-stats")
+def serve_cache_stats():
+
+    dataset = npdb_dataset
+
+    return jsonify({"summarize_npdb_years": npdb_filter_cache_stats(dataset.year_summaries),
+                    "summarize_npdb_selection": npdb_filter_cache_stats(dataset.selection_summaries),
+                    "dataset_version": dataset.version})
+
+
+#prometheus histograms of callback phase timings, records scanned and response sizes at /metrics
+npdb_metrics.init_app(app.server)
+
+
+#json/csv api of the summary, state, state by year, allegation and outcome figures of a year range at
+#/api/v1/<part>, answered from the same summaries as the callbacks
+npdb_api = NpdbApi(lambda: npdb_dataset,
+                   lambda dataset, malp_start_yr, malp_end_yr, cross_filter: filter_npdb_years(malp_start_yr, malp_end_yr, cross_filter, dataset = dataset),
+                   code_labels = {"ALGNNATR": {"ABBR": algtyp_rwab_mapping, "DESC": algtyp_rwds_mapping},
+                                  "OUTCOME": {"ABBR": outc_rwab_mapping, "DESC": outc_rwds_mapping}},
+                   filter_columns = npdb_cross_filter_columns if npdb_cross_filter else (),
+                   max_age = npdb_api_max_age)
+npdb_api.init_app(app.server)
+
+
+#register a callback whose output clientside mode computes in the browser instead; in that mode the function
+#is left unregistered (it can still be called directly, e.g. by npdb_bench.py)
+def server_side_callback(*callback_args):
+
+    if npdb_clientside:
+        return lambda callback: callback
+
+    return app.callback(*callback_args)
+
+
+#positions of the points of a figure (bars or states) whose key is selected in the cross filter, or None to
+#highlight nothing when nothing is selected
+def selected_points(point_keys, selected_keys):
+
+    if not selected_keys:
+        return None
+
+    selected_keys = set(selected_keys)
+
+    return [point for point, point_key in enumerate(point_keys) if point_key in selected_keys]
+
+
+#codes of a coded column behind a clicked bar, which stands for the codes found in the records that share its
+#abbreviation and description
+def clicked_bar_codes(click_data, column, abbreviations, descriptions):
+
+    clicked_point = click_data["points"][0]
+
+    return [code for code in npdb_dataset.bitmap_index.values[column]
+            if (abbreviations.get(code) == clicked_point.get("x")) and (descriptions.get(code) == clicked_point.get("customdata"))]
+
+
+#selected values with the clicked values taken out when they were all selected already, or added otherwise
+def toggle_values(selected_values, clicked_values):
+
+    if clicked_values and all(value in selected_values for value in clicked_values):
+        return [value for value in selected_values if value not in clicked_values]
+
+    return selected_values + [value for value in clicked_values if value not in selected_values]
+
+
 #callback for malpractice summary table by US states
-@app.callback(Output(component_id = "malp_geo_tbl", component_property = "data"),
+@app.callback([Output(component_id = "malp_geo_tbl", component_property = "data"),
+               Output(component_id = "malp_geo_tbl", component_property = "page_count"),
+               Output(component_id = "malp_geo_tbl", component_property = "page_current")],
               [Input(component_id = "malp_start_year", component_property = "value"),
-               Input(component_id = "malp_end_year", component_property = "value")])
-def filter_malp_geo_tbl(malp_start_yr, malp_end_yr):
+               Input(component_id = "malp_end_year", component_property = "value"),
+               Input(component_id = "malp_geo_tbl", component_property = "page_current"),
+               Input(component_id = "malp_geo_tbl", component_property = "page_size"),
+               Input(component_id = "malp_geo_tbl", component_property = "sort_by"),
+               Input(component_id = "malp_geo_tbl", component_property = "filter_query"),
+               Input(component_id = "npdb_cross_filter", component_property = "data")],
+              [State(component_id = "npdb_session", component_property = "data")])
+@npdb_metrics.instrument
+def filter_malp_geo_tbl(malp_start_yr, malp_end_yr, page_current = 0, page_size = npdb_geo_page_size, sort_by = None, filter_query = "", cross_filter = None, session_id = None):
     
     if (malp_start_yr is None) or (malp_end_yr is None):
         raise PreventUpdate
     else:
     
-       #filter npdb dataset to records between the starting and ending year specified by user
-       filter_malp_df = npdb_df[npdb_df["ORIGYEAR"].between(malp_start_yr, malp_end_yr)] 
+       #summary statistics by year and practitioner's state location of work (count of practitioners, count of
+       #malpractice records, median malpractice payment amount, median adverse action length) for records
+       #between the starting and ending year specified by user, selected by the cross filter
+       malp_by_geo_df = filter_npdb_years(malp_start_yr, malp_end_yr, cross_filter,
+                                          is_stale = track_npdb_request(session_id, "filter_malp_geo_tbl"))["state_year"]
 
-       #summary statistics by year and practitioner's state location of work 
-       malp_by_geo_df = filter_malp_df.groupby(["ORIGYEAR", "WORKSTAT"]).aggregate({"PRACTNUM": "nunique", #count of practitioners
-                                                                                   "SEQNO": "nunique", #count of malpractice records
-                                                                                   "TOTALPMT": "median", #median malpractice payment amount 
-                                                                                   "AALENGTH": "median" #median adverse action length
-                                                                                   }).reset_index()
+       #filter, sort and cut out the page on screen (staying on the last page when there are fewer pages)
+       malp_by_geo_df, page_count, page_current = query_table_page(malp_by_geo_df, page_current, page_size or npdb_geo_page_size,
+                                                                   sort_by = sort_by, filter_query = filter_query)
 
        #round results to two decimal places
-       malp_by_geo_df["TOTALPMT"] = round(malp_by_geo_df["TOTALPMT"], 2)
-       malp_by_geo_df["AALENGTH"] = round(malp_by_geo_df["AALENGTH"], 2)
+       malp_by_geo_df = malp_by_geo_df.round({column: 2 for column in ["TOTALPMT", "AALENGTH"] + npdb_percentile_columns})
 
-       return malp_by_geo_df.to_dict("records")
+       return malp_by_geo_df.to_dict("records"), page_count, page_current
         
 
 #callback for summary table across all US states
-@app.callback(Output(component_id = "tot_allsumm_tbl", component_property = "data"),
-              [Input(component_id = "malp_start_year", component_property = "value"),
-               Input(component_id = "malp_end_year", component_property = "value")])
-def calc_tot_allsumm_tbl(malp_start_yr, malp_end_yr):
+@server_side_callback(Output(component_id = "tot_allsumm_tbl", component_property = "data"),
+                      [Input(component_id = "malp_start_year", component_property = "value"),
+                       Input(component_id = "malp_end_year", component_property = "value"),
+                       Input(component_id = "npdb_cross_filter", component_property = "data")],
+                      [State(component_id = "npdb_session", component_property = "data")])
+@npdb_metrics.instrument
+def calc_tot_allsumm_tbl(malp_start_yr, malp_end_yr, cross_filter = None, session_id = None):
     
     if (malp_start_yr is None) or (malp_end_yr is None):
         raise PreventUpdate
     else:
         
-        #filter npdb dataset to records between the starting and ending year specified by user
-        filter_malp_df = npdb_df[npdb_df["ORIGYEAR"].between(malp_start_yr, malp_end_yr)]
+        #summary statistics across the US for records between the starting and ending year specified by user,
+        #selected by the cross filter
+        tot_summ = filter_npdb_years(malp_start_yr, malp_end_yr, cross_filter,
+                                     is_stale = track_npdb_request(session_id, "calc_tot_allsumm_tbl"))["overall"]
         
         #calculate the total number of malpractice records across the US
-        tot_seqno_all = "{:,}".format(filter_malp_df["SEQNO"].nunique())
-        tot_pract_all = "{:,}".format(filter_malp_df["PRACTNUM"].nunique())
-        tot_pmt_all = "${:,}".format(int(filter_malp_df["TOTALPMT"].sum()))
-        tot_aalen_all = "{:,}".format(filter_malp_df["AALENGTH"].median())
+        tot_seqno_all = npdb_count_prefix + "{:,}".format(tot_summ["SEQNO"])
+        tot_pract_all = npdb_count_prefix + "{:,}".format(tot_summ["PRACTNUM"])
+        tot_pmt_all = "${:,}".format(int(tot_summ["TOTALPMT"]))
+        tot_aalen_all = "{:,}".format(tot_summ["AALENGTH"])
 
         #format summary statistics into dataframe
-        tot_allsumm_df = pd.DataFrame({"SUMMSTAT": ["# OF MALPRACTICE CLAIMS:",
-                                                    "# OF LIABLE PRACTITIONERS:", 
-                                                    "TOTAL MALPRACTICE PAYMENT:",
-                                                    "MEDIAN ADVERSE EVENT LENGTH:"],
+        tot_allsumm_df = pd.DataFrame({"SUMMSTAT": tot_allsumm_labels,
                                        "SUMMVAL":  [tot_seqno_all,
                                                     tot_pract_all,
                                                     tot_pmt_all,
@@ -324,200 +920,198 @@ def calc_tot_allsumm_tbl(malp_start_yr, malp_end_yr):
         return tot_allsumm_df.to_dict("records")
 
 #callback for allegation type bar chart
-@app.callback(Output(component_id = "algtyp_barchart", component_property = "figure"),
-              [Input(component_id = "malp_start_year", component_property = "value"),
-               Input(component_id = "malp_end_year", component_property = "value")])
-def plot_algtyp_barchart(malp_start_yr, malp_end_yr):
+@server_side_callback(Output(component_id = "algtyp_barchart", component_property = "figure"),
+                      [Input(component_id = "malp_start_year", component_property = "value"),
+                       Input(component_id = "malp_end_year", component_property = "value"),
+                       Input(component_id = "npdb_cross_filter", component_property = "data")],
+                      [State(component_id = "npdb_session", component_property = "data")])
+@npdb_metrics.instrument
+def plot_algtyp_barchart(malp_start_yr, malp_end_yr, cross_filter = None, session_id = None):
     
     if (malp_start_yr is None) or (malp_end_yr is None):
         raise PreventUpdate
     else:
 
-        #mapping of allegation group raw values to abbreviated code values 
-        algtyp_rwab_mapping = {1: "DR", 
-                               10: "AR",
-                               20: "SR",
-                               30: "MR",
-                               40: "IVB",
-                               50: "OR",
-                               60: "TR",
-                               70: "MR",
-                               80: "EPR",
-                               90: "OM",
-                               100: "BHR"}  
+        #number of malpractice records by allegation group code between the starting and ending year specified by user,
+        #selected by the cross filters of the other views
+        algtyp_claims_df = filter_npdb_years(malp_start_yr, malp_end_yr, cross_filter, "ALGNNATR",
+                                             is_stale = track_npdb_request(session_id, "plot_algtyp_barchart"))["ALGNNATR"]
         
-        #mapping of allegation group raw values to full description
-        algtyp_rwds_mapping = {1: "Diagnosis Related", 
-                               10: "Anesthesia Related",
-                               20: "Surgery Related",
-                               30: "Medication Related",
-                               40: "IV & Blood Products Related",
-                               50: "Obstetrics Related",
-                               60: "Treatment Related",
-                               70: "Monitoring Related",
-                               80: "Equipment/Product Related",
-                               90: "Other Miscellaneous",
-                               100: "Behavioral Health Related"}
-
-        #filter npdb dataset to records between the starting and ending year specified by user
-        filter_malp_df = npdb_df[npdb_df["ORIGYEAR"].between(malp_start_yr, malp_end_yr)]
-        
-        #map allegation group code to abbreviate code description
-        filter_malp_df["ALGNNATR_ABBR"] = filter_malp_df["ALGNNATR"].map(algtyp_rwab_mapping)
+        #map allegation group code to abbreviate code description (kept out of the shared summary)
+        algtyp_abbr = algtyp_claims_df["ALGNNATR"].map(algtyp_rwab_mapping).rename("ALGNNATR_ABBR")
         #map allegation group code to description
-        filter_malp_df["ALGNNATR_DESC"] = filter_malp_df["ALGNNATR"].map(algtyp_rwds_mapping)
+        algtyp_desc = algtyp_claims_df["ALGNNATR"].map(algtyp_rwds_mapping).rename("ALGNNATR_DESC")
         
         #calculate numbers for bar chart
-        algtyp_df = filter_malp_df.groupby(["ALGNNATR_ABBR", "ALGNNATR_DESC"])["SEQNO"].nunique().reset_index()
-
-        #plot bar chart
-        algtyp_fig = px.bar(data_frame = algtyp_df, x = "ALGNNATR_ABBR", y = "SEQNO", color_discrete_sequence = ["rgb(87, 167, 113)"])
-        algtyp_fig.update_layout(yaxis = {"title": "", "gridcolor": dark_color},
-                                 xaxis = {"title": "", "showline": True, "linecolor": dark_color},
-                                 title= {"text": "<b># OF MALPRACTICE CLAIMS BY ALLEGATION TYPE:</b>",
-                                         "font": dict(size=10),
-                                         "xanchor": "left"},
-                                 font = {"size": 8},
-                                 margin = dict(l=0, b=0),
-                                 width = 480,
-                                 height = 250,
-                                 paper_bgcolor = tertiary_color,
-                                 plot_bgcolor = tertiary_color,
-                                 hoverlabel = {"bgcolor": "rgb(99, 198, 132)", "font": dict(size=8)})
-        algtyp_fig.update_traces(customdata = np.stack((algtyp_df["ALGNNATR_DESC"], algtyp_df["SEQNO"]), axis = -1),
-                                 hovertemplate = "<b>Allegation Type:</b> %{customdata[0]}<br>" + 
-                                                 "<b># of Claims:</b> %{customdata[1]:,}")
+        algtyp_df = algtyp_claims_df.groupby([algtyp_abbr, algtyp_desc])["SEQNO"].sum().reset_index()
+
+        #update the bars of the bar chart skeleton
+        algtyp_fig = Patch()
+        algtyp_fig["data"][0]["x"] = algtyp_df["ALGNNATR_ABBR"].tolist()
+        algtyp_fig["data"][0]["y"] = algtyp_df["SEQNO"].tolist()
+        algtyp_fig["data"][0]["customdata"] = algtyp_df["ALGNNATR_DESC"].tolist()
+        #highlight the bars selected in the cross filter
+        algtyp_fig["data"][0]["selectedpoints"] = selected_points(zip(algtyp_df["ALGNNATR_ABBR"], algtyp_df["ALGNNATR_DESC"]),
+                                                                  [(algtyp_rwab_mapping.get(code), algtyp_rwds_mapping.get(code))
+                                                                   for code in (cross_filter or {}).get("ALGNNATR", [])])
         
         return algtyp_fig
     
 #callback for outcome severity type bar chart
-@app.callback(Output(component_id = "outc_barchart", component_property = "figure"),
-              [Input(component_id = "malp_start_year", component_property = "value"),
-               Input(component_id = "malp_end_year", component_property = "value")])
-def plot_outc_bartchart(malp_start_yr, malp_end_yr):
+@server_side_callback(Output(component_id = "outc_barchart", component_property = "figure"),
+                      [Input(component_id = "malp_start_year", component_property = "value"),
+                       Input(component_id = "malp_end_year", component_property = "value"),
+                       Input(component_id = "npdb_cross_filter", component_property = "data")],
+                      [State(component_id = "npdb_session", component_property = "data")])
+@npdb_metrics.instrument
+def plot_outc_bartchart(malp_start_yr, malp_end_yr, cross_filter = None, session_id = None):
     
     if (malp_start_yr is None) or (malp_end_yr is None):
         raise PreventUpdate
     else:
-        
-        #mapping of outcome raw value to abbreviate code
-        outc_rwab_mapping = {1: "EM",
-                             2: "INS",
-                             3: "MIT",
-                             4: "MAT",
-                             5: "MIP",
-                             6: "SP",
-                             7: "MAP",
-                             8: "QBL",
-                             9: "DE",
-                             10: "CBD"}
-            
-        #mapping of outcome raw value to full code description
-        outc_rwds_mapping = {1: "Emotional",
-                             2: "Insignificant",
-                             3: "Minor Temporary",
-                             4: "Major Temporary",
-                             5: "Minor Permanent",
-                             6: "Significant Permanent",
-                             7: "Major Permanent",
-                             8: "Quadriplegic/Brain Damage/Lifelong Care",
-                             9: "Death",
-                             10: "Cannot Be Determined"}
             
-        #filter npdb dataset to records between the starting and ending year specified by user
-        filter_malp_df = npdb_df[npdb_df["ORIGYEAR"].between(malp_start_yr, malp_end_yr)]
+        #number of malpractice records by outcome raw value between the starting and ending year specified by user,
+        #selected by the cross filters of the other views
+        outc_claims_df = filter_npdb_years(malp_start_yr, malp_end_yr, cross_filter, "OUTCOME",
+                                           is_stale = track_npdb_request(session_id, "plot_outc_bartchart"))["OUTCOME"]
             
-        #map outcome raw value to abbreviated code value
-        filter_malp_df["OUTCOME_ABBR"] = filter_malp_df["OUTCOME"].map(outc_rwab_mapping)
+        #map outcome raw value to abbreviated code value (kept out of the shared summary)
+        outc_abbr = outc_claims_df["OUTCOME"].map(outc_rwab_mapping).rename("OUTCOME_ABBR")
         #map outcome raw value to full code description
-        filter_malp_df["OUTCOME_DESC"] = filter_malp_df["OUTCOME"].map(outc_rwds_mapping)
+        outc_desc = outc_claims_df["OUTCOME"].map(outc_rwds_mapping).rename("OUTCOME_DESC")
    
         #calculate numbers for outcome bar chart
-        outc_df = filter_malp_df.groupby(["OUTCOME_ABBR", "OUTCOME_DESC"])["SEQNO"].nunique().reset_index()
-
-        #plot bar chart
-        outc_fig = px.bar(data_frame = outc_df, x = "OUTCOME_ABBR", y = "SEQNO", color_discrete_sequence = ["rgb(160, 56, 43)"])
-        outc_fig.update_layout(yaxis = {"title": "", "gridcolor": dark_color},
-                               xaxis = {"title": "", "showline": True, "linecolor": dark_color},
-                               title = {"text": "<b># OF MALPRACTICE CLAIMS BY SEVERITY OF INJURY:</b>",
-                                        "font": dict(size = 10),
-                                        "xanchor": "left"},
-                               font = {"size": 8},
-                               margin = dict(l=0, b=0),
-                               width = 480,
-                               height = 250,
-                               paper_bgcolor = tertiary_color,
-                               plot_bgcolor = tertiary_color,
-                               hoverlabel = {"bgcolor": "rgb(223, 98, 83)", "font": dict(size=8)})
-        
-        outc_fig.update_traces(customdata = np.stack((outc_df["OUTCOME_DESC"], outc_df["SEQNO"]), axis = -1),
-                               hovertemplate = "<b>Outcome Type:</b> %{customdata[0]}<br>" + 
-                                               "<b># of Claims:</b> %{customdata[1]:,}")
+        outc_df = outc_claims_df.groupby([outc_abbr, outc_desc])["SEQNO"].sum().reset_index()
+
+        #update the bars of the bar chart skeleton
+        outc_fig = Patch()
+        outc_fig["data"][0]["x"] = outc_df["OUTCOME_ABBR"].tolist()
+        outc_fig["data"][0]["y"] = outc_df["SEQNO"].tolist()
+        outc_fig["data"][0]["customdata"] = outc_df["OUTCOME_DESC"].tolist()
+        #highlight the bars selected in the cross filter
+        outc_fig["data"][0]["selectedpoints"] = selected_points(zip(outc_df["OUTCOME_ABBR"], outc_df["OUTCOME_DESC"]),
+                                                                [(outc_rwab_mapping.get(code), outc_rwds_mapping.get(code))
+                                                                 for code in (cross_filter or {}).get("OUTCOME", [])])
         
         return outc_fig
 
 
 #callback for malpractice choropleth map by US states
-@app.callback(Output(component_id = "malp_geo_map", component_property = "figure"),
-              [Input(component_id = "malp_start_year", component_property = "value"),
-               Input(component_id = "malp_end_year", component_property = "value")])
-def plot_malp_choropleth(malp_start_yr, malp_end_yr):
+@server_side_callback(Output(component_id = "malp_geo_map", component_property = "figure"),
+                      [Input(component_id = "malp_start_year", component_property = "value"),
+                       Input(component_id = "malp_end_year", component_property = "value"),
+                       Input(component_id = "npdb_cross_filter", component_property = "data")],
+                      [State(component_id = "npdb_session", component_property = "data")])
+@npdb_metrics.instrument
+def plot_malp_choropleth(malp_start_yr, malp_end_yr, cross_filter = None, session_id = None):
     
     if (malp_start_yr is None) or (malp_end_yr is None):
         raise PreventUpdate
     else:
         #
-        #filter npdb dataset to records between the starting and ending year specified by user
-        filter_malp_df = npdb_df[npdb_df["ORIGYEAR"].between(malp_start_yr, malp_end_yr)] 
-
-        #summary statistics by year and practitioner's state location of work 
-        malp_by_geo_df = filter_malp_df.groupby(["WORKSTAT"]).aggregate({"PRACTNUM": "nunique", #count of practitioners
-                                                                         "SEQNO": "nunique", #count of malpractice records
-                                                                         "TOTALPMT": "median", #median malpractice payment amount 
-                                                                         "AALENGTH": "median" #median adverse action length
-                                                                                    }).reset_index()
-
-        #plot choropleth of malpractice cases by US state
-        malp_chorodata = [go.Choropleth(locationmode = "USA-states",
-                             locations = malp_by_geo_df["WORKSTAT"],
-                             z = malp_by_geo_df["SEQNO"],
-                             colorscale = "Redor",
-                             colorbar = dict(title = dict(text = "<b># of Records</b>", side = "right"),
-                                             x = 0.95,
-                                             separatethousands = True,
-                                             showticklabels = True,
-                                             thickness = 10,
-                                             tickfont = dict(size = 8))
-                                       )]
-                                                                         
-        malp_chorolayout = go.Layout(geo = dict(bgcolor = tertiary_color,
-                                                lakecolor = tertiary_color,
-                                                landcolor = tertiary_color),
-                                     geo_scope = "usa",
-                                     paper_bgcolor = tertiary_color,
-                                     plot_bgcolor = tertiary_color,
-                                     margin = dict(l=10, r=10, b=10, t=10),
-                                     hoverlabel = {"font": {"size": 10}} #set the font size for text in hoverlabel )          
-                                     )
-        
-        malp_chorofig = go.Figure(data = malp_chorodata, layout = malp_chorolayout)
-        
-        malp_chorofig.update_traces(customdata = np.stack((malp_by_geo_df["WORKSTAT"],\
-                                                           malp_by_geo_df["PRACTNUM"].fillna("None"),\
-                                                           malp_by_geo_df["SEQNO"].fillna("None"),\
-                                                           malp_by_geo_df["TOTALPMT"].fillna("None"),\
-                                                           malp_by_geo_df["AALENGTH"].fillna("None")), axis = -1),
-                                    hovertemplate = "<b>%{customdata[0]}</b><br>" +
-                                                    "# of Practitioners: %{customdata[1]: ,}<br>" +
-                                                    "# of Records: %{customdata[2]: ,}<br>" +
-                                                    "Median Payment: $%{customdata[3]: ,}<br>" +
-                                                    "Median Length: %{customdata[4]: ,}" +
-                                                    "<extra></extra>",
-                                    marker_line_width = 0 #removes border bolding from states in choropleth map
-                                    )
+        #summary statistics by practitioner's state location of work (count of practitioners, count of malpractice
+        #records, median malpractice payment amount, median adverse action length) for records between the
+        #starting and ending year specified by user, selected by the cross filters of the other views
+        malp_by_geo_df = filter_npdb_years(malp_start_yr, malp_end_yr, cross_filter, "WORKSTAT",
+                                           is_stale = track_npdb_request(session_id, "plot_malp_choropleth"))["state"]
+
+        #update the states, colors and hover values of the choropleth skeleton
+        malp_chorofig = Patch()
+        malp_chorofig["data"][0]["locations"] = malp_by_geo_df["WORKSTAT"].tolist()
+        malp_chorofig["data"][0]["z"] = malp_by_geo_df["SEQNO"].tolist()
+        state_hover_df = malp_by_geo_df[["PRACTNUM", "TOTALPMT", "AALENGTH", "TOTALPMT_P25", "TOTALPMT_P75", "TOTALPMT_P90"]]
+        malp_chorofig["data"][0]["customdata"] = state_hover_df.astype(object).where(state_hover_df.notna(), "None").to_numpy().tolist()
+        #highlight the states selected in the cross filter
+        malp_chorofig["data"][0]["selectedpoints"] = selected_points(malp_by_geo_df["WORKSTAT"], (cross_filter or {}).get("WORKSTAT", []))
 
         return malp_chorofig
 
+#callback keeping the cross filter in step with the filter dropdowns and with clicks on the map and bar charts;
+#clicking a state or bar adds it to the filter of its column, or takes it out when it is selected already
+if npdb_cross_filter:
+
+    @app.callback([Output(component_id = "npdb_cross_filter", component_property = "data")] +
+                  [Output(component_id = "npdb_filter_" + column, component_property = "value") for column in npdb_cross_filter_columns],
+                  [Input(component_id = "malp_geo_map", component_property = "clickData"),
+                   Input(component_id = "algtyp_barchart", component_property = "clickData"),
+                   Input(component_id = "outc_barchart", component_property = "clickData"),
+                   Input(component_id = "npdb_clear_filters", component_property = "n_clicks")] +
+                  [Input(component_id = "npdb_filter_" + column, component_property = "value") for column in npdb_cross_filter_columns],
+                  prevent_initial_call = True)
+    def update_cross_filter(malp_geo_click, algtyp_click, outc_click, clear_clicks, *filter_values):
+
+        filter_values = {column: list(values or []) for column, values in zip(npdb_cross_filter_columns, filter_values)}
+        triggered_id = dash.ctx.triggered_id
+
+        if triggered_id == "npdb_clear_filters":
+            filter_values = {column: [] for column in npdb_cross_filter_columns}
+        elif (triggered_id == "malp_geo_map") and malp_geo_click:
+            filter_values["WORKSTAT"] = toggle_values(filter_values["WORKSTAT"], [malp_geo_click["points"][0].get("location")])
+        elif (triggered_id == "algtyp_barchart") and algtyp_click:
+            filter_values["ALGNNATR"] = toggle_values(filter_values["ALGNNATR"], clicked_bar_codes(algtyp_click, "ALGNNATR", algtyp_rwab_mapping, algtyp_rwds_mapping))
+        elif (triggered_id == "outc_barchart") and outc_click:
+            filter_values["OUTCOME"] = toggle_values(filter_values["OUTCOME"], clicked_bar_codes(outc_click, "OUTCOME", outc_rwab_mapping, outc_rwds_mapping))
+
+        return [{column: values for column, values in filter_values.items() if values}] + [filter_values[column] for column in npdb_cross_filter_columns]
+
+#the clientside callbacks below combine claim counts and payment totals of the selected years in the browser
+#(assets/npdb_clientside.js); the metrics that cannot be combined from per-year values come from this callback
+if npdb_clientside:
+
+    #callback for the practitioner counts, medians and percentiles of the selected years
+    @app.callback(Output(component_id = "npdb_server_summary", component_property = "data"),
+                  [Input(component_id = "malp_start_year", component_property = "value"),
+                   Input(component_id = "malp_end_year", component_property = "value")],
+                  [State(component_id = "npdb_session", component_property = "data")])
+    @npdb_metrics.instrument
+    def summarize_server_metrics(malp_start_yr, malp_end_yr, session_id = None):
+
+        if (malp_start_yr is None) or (malp_end_yr is None):
+            raise PreventUpdate
+
+        npdb_summary = filter_npdb_years(malp_start_yr, malp_end_yr, is_stale = track_npdb_request(session_id, "summarize_server_metrics"))
+        malp_by_geo_df = npdb_summary["state"]
+
+        #hover values of each state for the choropleth, in the order the clientside callback expects them
+        state_hover_df = malp_by_geo_df[["PRACTNUM", "TOTALPMT", "AALENGTH", "TOTALPMT_P25", "TOTALPMT_P75", "TOTALPMT_P90"]]
+        state_hover_df = state_hover_df.astype(object).where(state_hover_df.notna(), "None")
+
+        return {"start_year": malp_start_yr,
+                "end_year": malp_end_yr,
+                "PRACTNUM": npdb_count_prefix + "{:,}".format(npdb_summary["overall"]["PRACTNUM"]),
+                "AALENGTH": "{:,}".format(npdb_summary["overall"]["AALENGTH"]),
+                "states": dict(zip(malp_by_geo_df["WORKSTAT"], state_hover_df.to_numpy().tolist()))}
+
+    app.clientside_callback(ClientsideFunction(namespace = "npdb", function_name = "summaryTable"),
+                            Output(component_id = "tot_allsumm_tbl", component_property = "data"),
+                            [Input(component_id = "malp_start_year", component_property = "value"),
+                             Input(component_id = "malp_end_year", component_property = "value"),
+                             Input(component_id = "npdb_server_summary", component_property = "data")],
+                            [State(component_id = "npdb_year_payload", component_property = "data")])
+
+    app.clientside_callback(ClientsideFunction(namespace = "npdb", function_name = "allegationBars"),
+                            Output(component_id = "algtyp_barchart", component_property = "figure"),
+                            [Input(component_id = "malp_start_year", component_property = "value"),
+                             Input(component_id = "malp_end_year", component_property = "value")],
+                            [State(component_id = "npdb_year_payload", component_property = "data"),
+                             State(component_id = "algtyp_barchart", component_property = "figure")])
+
+    app.clientside_callback(ClientsideFunction(namespace = "npdb", function_name = "outcomeBars"),
+                            Output(component_id = "outc_barchart", component_property = "figure"),
+                            [Input(component_id = "malp_start_year", component_property = "value"),
+                             Input(component_id = "malp_end_year", component_property = "value")],
+                            [State(component_id = "npdb_year_payload", component_property = "data"),
+                             State(component_id = "outc_barchart", component_property = "figure")])
+
+    app.clientside_callback(ClientsideFunction(namespace = "npdb", function_name = "choropleth"),
+                            Output(component_id = "malp_geo_map", component_property = "figure"),
+                            [Input(component_id = "malp_start_year", component_property = "value"),
+                             Input(component_id = "malp_end_year", component_property = "value"),
+                             Input(component_id = "npdb_server_summary", component_property = "data")],
+                            [State(component_id = "npdb_year_payload", component_property = "data"),
+                             State(component_id = "malp_geo_map", component_property = "figure")])
+
+
 
        
 if __name__ == '__main__':
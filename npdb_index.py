@@ -0,0 +1,958 @@
+import os
+import math
+
+import numpy as np
+import pandas as pd
+
+from npdb_sketches import hash_ids, hll_precision, hll_relative_error, hll_register_ranks, query_hll_registers
+
+#******************************************************************************
+#SECTION I: INDEX SETTINGS
+#******************************************************************************
+
+#group columns the dashboard summarizes by; "ALL" is a single group holding every record
+npdb_group_columns = ["ALL", "WORKSTAT", "ALGNNATR", "OUTCOME"]
+
+#distinct id counts needed by the callbacks, as (group column, id column)
+npdb_distinct_keys = [("ALL", "SEQNO"), ("ALL", "PRACTNUM"),
+                      ("WORKSTAT", "SEQNO"), ("WORKSTAT", "PRACTNUM"),
+                      ("ALGNNATR", "SEQNO"), ("OUTCOME", "SEQNO")]
+
+#medians and percentiles needed by the callbacks, as (group column, value column)
+npdb_quantile_keys = [("ALL", "AALENGTH"), ("WORKSTAT", "TOTALPMT"), ("WORKSTAT", "AALENGTH")]
+
+#percentiles of payments and adverse action lengths served by state besides the median, as columns named
+#e.g. TOTALPMT_P90
+npdb_percentiles = [10, 25, 75, 90, 99]
+npdb_percentile_columns = ["{}_P{}".format(value_column, percentile) for value_column in ["TOTALPMT", "AALENGTH"] for percentile in npdb_percentiles]
+
+#sums needed by the callbacks, as (group column, value column)
+npdb_sum_keys = [("ALL", "TOTALPMT")]
+
+#largest number of (group, year, distinct value) cells held by a quantile histogram; columns with more
+#distinct values than fit are kept as per-year sorted arrays instead
+npdb_histogram_cell_limit = 20000000
+
+#record layout of the (group, id, year) appearances spilled to disk while streaming
+npdb_spill_dtype = np.dtype([("group", "<i4"), ("id", "<i8"), ("year", "<i2")])
+
+#******************************************************************************
+#SECTION II: BUILDING BLOCKS
+#******************************************************************************
+
+#dense (group, year, inner code) table accumulated over chunks of records, grown as new groups and years
+#turn up; combine is np.add for counts and totals and np.maximum for sketch registers
+class GroupYearTable:
+
+    def __init__(self, dtype, inner_size = 1, combine = np.add):
+
+        self.table = np.zeros((0, 0, inner_size), dtype = dtype)
+        self.first_year = 0
+        self.combine = combine
+
+
+    def add(self, group_codes, years, values, inner_codes = 0):
+
+        if len(group_codes) == 0:
+            return
+
+        n_groups, n_years, inner_size = self.table.shape
+        first_year = min(int(years.min()), self.first_year) if n_years else int(years.min())
+        last_year = max(int(years.max()), self.first_year + n_years - 1) if n_years else int(years.max())
+
+        if (first_year != self.first_year) or (last_year - first_year + 1 != n_years) or (group_codes.max() >= n_groups):
+            grown_table = np.zeros((max(int(group_codes.max()) + 1, n_groups), last_year - first_year + 1, inner_size), dtype = self.table.dtype)
+            grown_table[:n_groups, self.first_year - first_year:self.first_year - first_year + n_years] = self.table
+            self.table, self.first_year = grown_table, first_year
+
+        cell_codes = np.ravel_multi_index((group_codes, years - self.first_year, np.broadcast_to(inner_codes, group_codes.shape)), self.table.shape)
+
+        #bincount is much quicker than np.add.at for adding up many values
+        if self.combine is np.add:
+            cell_totals = np.bincount(cell_codes, weights = None if np.isscalar(values) else values, minlength = self.table.size)
+            self.table += (cell_totals * values if np.isscalar(values) else cell_totals).astype(self.table.dtype).reshape(self.table.shape)
+        else:
+            self.combine.at(self.table.reshape(-1), cell_codes, values)
+
+
+    #the table with groups relabeled and years covering first_year..first_year + n_years - 1
+    def finish(self, relabel, n_groups, first_year, n_years):
+
+        table = np.zeros((n_groups, n_years, self.table.shape[2]), dtype = self.table.dtype)
+        if self.table.size:
+            year_start = self.first_year - first_year
+            table[relabel[:self.table.shape[0]], year_start:year_start + self.table.shape[1]] = self.table
+
+        return table
+
+
+#one int64 key per (group code, year, value code) with 15, 16 and 32 bits for each, used to count the
+#records with each value of a column
+def group_year_value_keys(group_codes, years, value_codes):
+
+    return (group_codes << 48) | (years << 32) | value_codes
+
+
+#prefix sums over years of a (group, year) count or sum table, padded with a leading zero year so the
+#total over years s..e is prefix[:, e + 1] - prefix[:, s]
+def year_prefix(group_year_table):
+
+    prefix = np.zeros((group_year_table.shape[0], group_year_table.shape[1] + 1) + group_year_table.shape[2:],
+                      dtype = group_year_table.dtype)
+    np.cumsum(group_year_table, axis = 1, out = prefix[:, 1:])
+
+    return prefix
+
+
+#exact distinct id counts for any contiguous range of years
+#
+#every (group, id) pair is reduced to the years it appears in; each appearance is tallied under its year
+#and the previous year the same pair appeared (or none), so the number of distinct ids over years s..e
+#is the number of appearances in s..e whose previous appearance is before s.  tallies of disjoint sets of
+#ids add up, so ids can be tallied a partition at a time
+def tally_distinct_years(group_codes, id_values, year_codes, n_groups, n_years):
+
+    if n_years == 0 or len(id_values) == 0:
+        return np.zeros((n_groups, n_years, n_years + 1), dtype = np.int64)
+
+    id_codes, id_labels = pd.factorize(np.asarray(id_values, dtype = np.int64))
+
+    #one key per distinct (group, id, year), sorted by group, id then year
+    pair_keys = np.sort((group_codes * len(id_labels) + id_codes) * n_years + year_codes)
+    pair_keys = pair_keys[np.concatenate([[True], pair_keys[1:] != pair_keys[:-1]])]
+    pair_years = pair_keys % n_years
+    pair_ids = pair_keys // n_years
+
+    #year of the previous appearance of the same (group, id) pair, shifted by one so 0 means none
+    previous_years = np.zeros(len(pair_keys), dtype = np.int64)
+    same_pair = pair_ids[1:] == pair_ids[:-1]
+    previous_years[1:][same_pair] = pair_years[:-1][same_pair] + 1
+
+    pair_groups = pair_ids // len(id_labels)
+
+    return np.bincount((pair_groups * n_years + pair_years) * (n_years + 1) + previous_years,
+                       minlength = n_groups * n_years * (n_years + 1)).reshape(n_groups, n_years, n_years + 1)
+
+
+#the tally stored as a two dimensional prefix sum, making each query a constant number of lookups per group
+def distinct_counter_prefix(tally):
+
+    n_groups, n_years = tally.shape[:2]
+    prefix = np.zeros((n_groups, n_years + 1, n_years + 2), dtype = np.int64)
+    prefix[:, 1:, 1:] = tally.cumsum(axis = 1).cumsum(axis = 2)
+
+    return prefix
+
+
+#number of distinct ids per group over year codes s..e from a distinct counter prefix table
+def query_distinct_counter(prefix, start_code, end_code):
+
+    return prefix[:, end_code + 1, start_code + 1] - prefix[:, start_code, start_code + 1]
+
+
+#exact medians and percentiles for any contiguous range of years
+#
+#values are kept as per (group, year) counts of each distinct value, summed over years with a prefix
+#table, so the counts of a range of years are merged with one subtraction and any percentile is read off
+#the merged counts; payments are coded to range midpoints and lengths take few values, so the counts are
+#small and exact.  when a column has too many distinct values for that, the values are kept sorted by
+#group and year so the values of one group over a range of years are one contiguous block
+class RangeQuantiles:
+
+    #value_counts holds the number of records with each (group, year, value)
+    def __init__(self, group_codes, year_codes, values, value_counts, n_groups, n_years):
+
+        n_years = max(n_years, 1)
+
+        self.n_groups = n_groups
+        self.n_years = n_years
+        self.distinct_values, value_codes = np.unique(values, return_inverse = True)
+
+        if n_groups * n_years * len(self.distinct_values) <= npdb_histogram_cell_limit:
+            histogram = np.bincount((group_codes * n_years + year_codes) * len(self.distinct_values) + value_codes,
+                                    weights = value_counts, minlength = n_groups * n_years * len(self.distinct_values)).astype(np.int64)
+            self.histogram_prefix = year_prefix(histogram.reshape(n_groups, n_years, len(self.distinct_values)))
+            self.sorted_values = None
+        else:
+            order = np.lexsort((values, year_codes, group_codes))
+            self.sorted_values = np.repeat(values[order], value_counts[order])
+            block_sizes = np.bincount(group_codes * n_years + year_codes, weights = value_counts, minlength = n_groups * n_years).astype(np.int64)
+            self.block_starts = np.concatenate([[0], np.cumsum(block_sizes)])
+            self.histogram_prefix = None
+
+
+    #values of one group over year codes s..e, from the sorted arrays
+    def group_values(self, group_code, start_code, end_code):
+
+        return self.sorted_values[self.block_starts[group_code * self.n_years + start_code]:
+                                  self.block_starts[group_code * self.n_years + end_code + 1]]
+
+
+    #values at both sides of the position (n - 1) * quantile of the sorted values of each group, with the
+    #fraction of the way between them and which groups have values; arrays are shaped (groups, quantiles)
+    def bracketing_values(self, start_code, end_code, quantiles):
+
+        value_counts = self.histogram_prefix[:, end_code + 1] - self.histogram_prefix[:, start_code]
+        cumulative_counts = value_counts.cumsum(axis = 1)
+        total_counts = cumulative_counts[:, -1]
+
+        positions = (total_counts[:, None] - 1) * quantiles[None, :]
+        lower_ranks = np.floor(positions)
+        upper_ranks = np.ceil(positions)
+
+        #offset each group's running counts past the previous group's so one sorted search serves all groups
+        n_values = len(self.distinct_values)
+        group_offsets = np.arange(self.n_groups)[:, None] * (int(total_counts.max()) + 1)
+        flat_counts = (cumulative_counts + group_offsets).ravel()
+        lower_codes = np.searchsorted(flat_counts, lower_ranks + group_offsets, side = "right") - np.arange(self.n_groups)[:, None] * n_values
+        upper_codes = np.searchsorted(flat_counts, upper_ranks + group_offsets, side = "right") - np.arange(self.n_groups)[:, None] * n_values
+
+        has_values = total_counts > 0
+        lower_codes = np.where(has_values[:, None], lower_codes, 0)
+        upper_codes = np.where(has_values[:, None], upper_codes, 0)
+
+        return self.distinct_values[lower_codes], self.distinct_values[upper_codes], positions - lower_ranks, has_values
+
+
+    #median per group over year codes s..e (nan for groups without values)
+    def median(self, start_code, end_code):
+
+        medians = np.full(self.n_groups, np.nan)
+
+        if self.sorted_values is not None:
+            for group_code in range(self.n_groups):
+                group_values = self.group_values(group_code, start_code, end_code)
+                if len(group_values):
+                    medians[group_code] = np.median(group_values)
+            return medians
+
+        if len(self.distinct_values) == 0:
+            return medians
+
+        lower_values, upper_values, _, has_values = self.bracketing_values(start_code, end_code, np.array([0.5]))
+        medians[has_values] = (lower_values[has_values, 0] + upper_values[has_values, 0]) / 2
+
+        return medians
+
+
+    #percentiles per group over year codes s..e, linearly interpolated like numpy and pandas, as an array
+    #shaped (groups, percentiles) (nan for groups without values)
+    def percentiles(self, start_code, end_code, percentiles):
+
+        quantiles = np.asarray(percentiles, dtype = np.float64) / 100
+        results = np.full((self.n_groups, len(quantiles)), np.nan)
+
+        if self.sorted_values is not None:
+            for group_code in range(self.n_groups):
+                group_values = self.group_values(group_code, start_code, end_code)
+                if len(group_values):
+                    results[group_code] = np.quantile(group_values, quantiles)
+            return results
+
+        if len(self.distinct_values) == 0:
+            return results
+
+        lower_values, upper_values, fractions, has_values = self.bracketing_values(start_code, end_code, quantiles)
+
+        #same interpolation as numpy, which works from the nearer end for accuracy
+        differences = upper_values - lower_values
+        interpolated = np.where(fractions >= 0.5, upper_values - differences * (1 - fractions), lower_values + differences * fractions)
+        results[has_values] = interpolated[has_values]
+
+        return results
+
+#******************************************************************************
+#SECTION III: INDEX BUILDER
+#******************************************************************************
+
+#accumulates the aggregates of the year index one chunk of records at a time, so the index of a file
+#larger than memory is built without holding its records; everything kept is sized by groups, years and
+#distinct values, except the (group, id, year) appearances behind the exact distinct counts, which are
+#partitioned by id into spill_buckets files under spill_dir when a spill directory is given.  chunks can
+#still be added after building an index, and building again gives the index of every chunk added so far.
+#with keep_appearances = False the appearances are folded into the years each (group, id) pair appears in
+#(one bit per year) and a running tally of the distinct counts, so a chunk added later only changes the
+#tallies of the pairs it appears in, at about (8 + years / 8) bytes per pair instead of 24 bytes per record
+class NpdbIndexBuilder:
+
+    def __init__(self, distinct_error = None, spill_dir = None, spill_buckets = 1, keep_appearances = True):
+
+        self.distinct_error = distinct_error
+        self.keep_appearances = keep_appearances
+        self.precision = hll_precision(distinct_error) if distinct_error is not None else None
+        self.spill_dir = spill_dir
+        self.spill_buckets = spill_buckets
+
+        #group values get a code in order of first appearance, relabeled in sorted order when finished
+        self.group_codes = {group_column: {} for group_column in npdb_group_columns}
+        self.group_dtypes = {group_column: np.dtype(object) for group_column in npdb_group_columns}
+
+        self.first_year = None
+        self.last_year = None
+        self.n_rows = 0
+        self.n_chunks = 0
+
+        self.row_counts = {group_column: GroupYearTable(np.int64) for group_column in npdb_group_columns}
+        self.sums = {sum_key: GroupYearTable(np.float64) for sum_key in npdb_sum_keys}
+        self.value_codes = {quantile_key: {} for quantile_key in npdb_quantile_keys}
+        self.value_counts = dict.fromkeys(npdb_quantile_keys)
+        if self.precision is not None:
+            self.hll_registers = {distinct_key: GroupYearTable(np.uint8, 2 ** self.precision, np.maximum) for distinct_key in npdb_distinct_keys}
+        self.distinct_parts = {distinct_key: [] for distinct_key in npdb_distinct_keys}
+
+        #sorted (group code, id) keys of the pairs with the years each appears in, as bits from pair_first_year,
+        #and the distinct tally by (group code, year, previous year) key
+        self.pair_first_year = None
+        self.pair_keys = {distinct_key: np.zeros(0, dtype = np.int64) for distinct_key in npdb_distinct_keys}
+        self.pair_years = {distinct_key: np.zeros((0, 0), dtype = np.uint8) for distinct_key in npdb_distinct_keys}
+        self.pair_tallies = {distinct_key: pd.Series([], dtype = np.int64) for distinct_key in npdb_distinct_keys}
+
+
+    #whether the exact distinct counts are kept as the years of each (group, id) pair
+    def tallies_pairs(self):
+
+        return (self.precision is None) and (self.spill_dir is None) and not self.keep_appearances
+
+
+    #group code of every record of a chunk (-1 where the group value is blank)
+    def code_groups(self, chunk_df, group_column):
+
+        if group_column == "ALL":
+            self.group_codes["ALL"].setdefault("ALL", 0)
+            return np.zeros(len(chunk_df), dtype = np.int64)
+
+        chunk_codes, chunk_labels = pd.factorize(chunk_df[group_column])
+        chunk_labels = np.asarray(chunk_labels)
+        self.group_dtypes[group_column] = chunk_labels.dtype
+
+        known_codes = self.group_codes[group_column]
+        label_codes = np.array([known_codes.setdefault(label, len(known_codes)) for label in chunk_labels.tolist()] + [-1], dtype = np.int64)
+
+        return label_codes[chunk_codes]
+
+
+    #(group code, id, year) of the records of a chunk with a group and an id
+    def chunk_appearances(self, chunk_df, group_codes, id_column, record_years):
+
+        valid = (group_codes >= 0) & ~pd.isna(chunk_df[id_column].array)
+
+        return group_codes[valid], np.asarray(chunk_df[id_column].array[valid], dtype = np.int64), record_years[valid]
+
+
+    #add the aggregates of a chunk of cleaned records
+    def add_chunk(self, chunk_df):
+
+        if len(chunk_df) == 0:
+            return self
+
+        record_years = chunk_df["ORIGYEAR"].to_numpy(dtype = np.int64)
+        self.first_year = min(int(record_years.min()), self.first_year if self.first_year is not None else math.inf)
+        self.last_year = max(int(record_years.max()), self.last_year if self.last_year is not None else -math.inf)
+        self.n_rows += len(chunk_df)
+        self.n_chunks += 1
+
+        group_codes = {group_column: self.code_groups(chunk_df, group_column) for group_column in npdb_group_columns}
+
+        for group_column in npdb_group_columns:
+            valid = group_codes[group_column] >= 0
+            self.row_counts[group_column].add(group_codes[group_column][valid], record_years[valid], 1)
+
+        for group_column, value_column in npdb_quantile_keys:
+            values = chunk_df[value_column].to_numpy(dtype = np.float64, na_value = np.nan)
+            valid = (group_codes[group_column] >= 0) & ~np.isnan(values)
+
+            chunk_value_codes, chunk_values = pd.factorize(values[valid])
+            known_codes = self.value_codes[(group_column, value_column)]
+            value_codes = np.array([known_codes.setdefault(value, len(known_codes)) for value in chunk_values.tolist()], dtype = np.int64)[chunk_value_codes]
+
+            chunk_counts = pd.Series(group_year_value_keys(group_codes[group_column][valid], record_years[valid], value_codes)).value_counts()
+            if self.value_counts[(group_column, value_column)] is not None:
+                chunk_counts = pd.concat([self.value_counts[(group_column, value_column)], chunk_counts]).groupby(level = 0).sum()
+            self.value_counts[(group_column, value_column)] = chunk_counts
+
+        for group_column, value_column in npdb_sum_keys:
+            valid = group_codes[group_column] >= 0
+            values = np.nan_to_num(chunk_df[value_column].to_numpy(dtype = np.float64, na_value = np.nan)[valid])
+            self.sums[(group_column, value_column)].add(group_codes[group_column][valid], record_years[valid], values)
+
+        if self.tallies_pairs():
+            self.align_pair_years()
+
+        for key_number, (group_column, id_column) in enumerate(npdb_distinct_keys):
+            groups, ids, years = self.chunk_appearances(chunk_df, group_codes[group_column], id_column, record_years)
+
+            if self.tallies_pairs():
+                self.add_pair_years((group_column, id_column), groups, ids, years)
+            elif self.precision is not None:
+                register_codes, ranks = hll_register_ranks(ids, self.precision)
+                self.hll_registers[(group_column, id_column)].add(groups, years, ranks, register_codes)
+            elif self.spill_dir is None:
+                self.distinct_parts[(group_column, id_column)].append((groups, ids, years))
+            else:
+                self.spill_appearances(key_number, groups, ids, years)
+
+        return self
+
+
+    #widen the year bits of the pairs to cover first_year..last_year, shifting them when first_year moved back
+    def align_pair_years(self):
+
+        if self.pair_first_year is None:
+            self.pair_first_year = self.first_year
+        shift = self.pair_first_year - self.first_year
+        n_bytes = (self.last_year - self.first_year) // 8 + 1
+
+        for distinct_key, pair_years in self.pair_years.items():
+            if shift:
+                year_bits = np.unpackbits(pair_years, axis = 1, bitorder = "little")
+                pair_years = np.packbits(np.pad(year_bits, ((0, 0), (shift, 0))), axis = 1, bitorder = "little")
+            if pair_years.shape[1] < n_bytes:
+                pair_years = np.pad(pair_years, ((0, 0), (0, n_bytes - pair_years.shape[1])))
+            self.pair_years[distinct_key] = pair_years
+
+        self.pair_first_year = self.first_year
+
+
+    #distinct tally of pairs with the given year bits, by (group code, year, previous year + 1 or 0) key
+    def tally_pair_years(self, pair_keys, pair_years):
+
+        #positions of the set bits, pair by pair, so the previous bit of the same pair is its previous year;
+        #only the bytes with a bit set are unpacked
+        set_bytes = np.flatnonzero(pair_years)
+        set_bits = np.flatnonzero(np.unpackbits(pair_years.reshape(-1)[set_bytes], bitorder = "little"))
+        pair_rows, year_bits = np.divmod(set_bytes[set_bits >> 3] * 8 + (set_bits & 7), pair_years.shape[1] * 8)
+        years = year_bits + self.pair_first_year
+        previous_years = np.zeros(len(years), dtype = np.int64)
+        same_pair = pair_rows[1:] == pair_rows[:-1]
+        previous_years[1:][same_pair] = years[:-1][same_pair] + 1
+
+        return pd.Series(((pair_keys[pair_rows] >> 32) << 32) | (years << 16) | previous_years).value_counts()
+
+
+    #fold the appearances of a chunk into the years of their pairs, adding the change in the tally of every
+    #pair that appears in a year it did not appear in before
+    def add_pair_years(self, distinct_key, groups, ids, years):
+
+        #ids are 32 bit (see the schema)
+        chunk_keys, pair_codes = np.unique((groups << 32) | (ids & 0xFFFFFFFF), return_inverse = True)
+        known_keys, known_years = self.pair_keys[distinct_key], self.pair_years[distinct_key]
+
+        chunk_bits = np.zeros((len(chunk_keys), known_years.shape[1] * 8), dtype = bool)
+        chunk_bits[pair_codes, years - self.pair_first_year] = True
+        chunk_years = np.packbits(chunk_bits, axis = 1, bitorder = "little")
+        del chunk_bits
+
+        positions = np.searchsorted(known_keys, chunk_keys)
+        known = positions < len(known_keys)
+        known[known] = known_keys[positions[known]] == chunk_keys[known]
+
+        old_years = np.zeros_like(chunk_years)
+        old_years[known] = known_years[positions[known]]
+        new_years = old_years | chunk_years
+        changed = (new_years != old_years).any(axis = 1)
+
+        tally_changes = [self.pair_tallies[distinct_key], self.tally_pair_years(chunk_keys[changed], new_years[changed])]
+        if (changed & known).any():
+            tally_changes.append(-self.tally_pair_years(chunk_keys[changed & known], old_years[changed & known]))
+        pair_tally = pd.concat(tally_changes).groupby(level = 0).sum()
+        self.pair_tallies[distinct_key] = pair_tally[pair_tally != 0]
+
+        if len(known_keys) == 0:
+            self.pair_keys[distinct_key], self.pair_years[distinct_key] = chunk_keys, new_years
+            return
+
+        known_years[positions[known]] = new_years[known]
+        self.pair_keys[distinct_key] = np.insert(known_keys, positions[~known], chunk_keys[~known])
+        self.pair_years[distinct_key] = np.insert(known_years, positions[~known], new_years[~known], axis = 0)
+
+
+    #spill file holding one bucket of the appearances of one distinct key
+    def spill_path(self, key_number, bucket):
+
+        return os.path.join(self.spill_dir, "distinct_{}_{}.bin".format(key_number, bucket))
+
+
+    #append the (group, id, year) appearances of a chunk to the spill files, bucketed by id
+    def spill_appearances(self, key_number, groups, ids, years):
+
+        appearances = np.empty(len(ids), dtype = npdb_spill_dtype)
+        appearances["group"] = groups
+        appearances["id"] = ids
+        appearances["year"] = years
+
+        buckets = (hash_ids(ids) % np.uint64(self.spill_buckets)).astype(np.int64)
+        order = np.argsort(buckets, kind = "stable")
+        bucket_ends = np.searchsorted(buckets[order], np.arange(self.spill_buckets), side = "right")
+
+        for bucket, (bucket_start, bucket_end) in enumerate(zip(np.concatenate([[0], bucket_ends[:-1]]), bucket_ends)):
+            if bucket_end > bucket_start:
+                with open(self.spill_path(key_number, bucket), "ab") as spill_file:
+                    appearances[order[bucket_start:bucket_end]].tofile(spill_file)
+
+
+    #exact distinct counter of one key from the appearances kept in memory or spilled to disk
+    def build_distinct_counter(self, key_number, distinct_key, relabel, n_groups, n_years):
+
+        if self.tallies_pairs():
+            tally_keys = self.pair_tallies[distinct_key].index.to_numpy(dtype = np.int64)
+            previous_years = tally_keys & 0xFFFF
+            tally = np.zeros((n_groups, n_years, n_years + 1), dtype = np.int64)
+            np.add.at(tally, (relabel[tally_keys >> 32], ((tally_keys >> 16) & 0xFFFF) - self.first_year,
+                              np.where(previous_years > 0, previous_years - self.first_year, 0)),
+                      self.pair_tallies[distinct_key].to_numpy(dtype = np.int64))
+            return distinct_counter_prefix(tally)
+
+        if self.spill_dir is None:
+            parts = self.distinct_parts[distinct_key]
+            if not parts:
+                return distinct_counter_prefix(tally_distinct_years(np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64),
+                                                                    np.zeros(0, dtype = np.int64), n_groups, n_years))
+
+            #the parts are kept as one, so records can still be added to a finished builder
+            groups, ids, years = (np.concatenate(part) for part in zip(*parts))
+            self.distinct_parts[distinct_key] = [(groups, ids, years)]
+            return distinct_counter_prefix(tally_distinct_years(relabel[groups], ids, years - self.first_year, n_groups, n_years))
+
+        #ids never share a bucket, so the tallies of the buckets add up
+        tally = np.zeros((n_groups, n_years, n_years + 1), dtype = np.int64)
+        for bucket in range(self.spill_buckets):
+            if os.path.exists(self.spill_path(key_number, bucket)):
+                appearances = np.fromfile(self.spill_path(key_number, bucket), dtype = npdb_spill_dtype)
+                tally += tally_distinct_years(relabel[appearances["group"]], appearances["id"],
+                                              appearances["year"].astype(np.int64) - self.first_year, n_groups, n_years)
+                del appearances
+
+        return distinct_counter_prefix(tally)
+
+
+    #fill in the aggregates of a year index from everything accumulated
+    def finish(self, npdb_index):
+
+        if self.first_year is None:
+            self.first_year, self.last_year = 0, -1
+
+        npdb_index.first_year = self.first_year
+        npdb_index.last_year = self.last_year
+        npdb_index.n_years = n_years = self.last_year - self.first_year + 1
+
+        #group codes follow the sorted group labels
+        npdb_index.group_labels = {}
+        relabel = {}
+        for group_column in npdb_group_columns:
+            first_seen_labels = list(self.group_codes[group_column])
+            sorted_labels = sorted(first_seen_labels)
+            npdb_index.group_labels[group_column] = np.array(sorted_labels, dtype = self.group_dtypes[group_column])
+            relabel[group_column] = np.zeros(len(first_seen_labels), dtype = np.int64)
+            relabel[group_column][[self.group_codes[group_column][label] for label in sorted_labels]] = np.arange(len(sorted_labels))
+
+        n_groups = {group_column: len(npdb_index.group_labels[group_column]) for group_column in npdb_group_columns}
+
+        npdb_index.row_count_prefix = {group_column: year_prefix(self.row_counts[group_column].finish(relabel[group_column], n_groups[group_column],
+                                                                                                     self.first_year, n_years)[:, :, 0])
+                                       for group_column in npdb_group_columns}
+
+        npdb_index.sum_prefix = {(group_column, value_column): year_prefix(self.sums[(group_column, value_column)].finish(relabel[group_column], n_groups[group_column],
+                                                                                                                         self.first_year, n_years)[:, :, 0])
+                                 for group_column, value_column in npdb_sum_keys}
+
+        npdb_index.quantiles = {}
+        for group_column, value_column in npdb_quantile_keys:
+            value_counts = self.value_counts[(group_column, value_column)]
+            value_keys = value_counts.index.to_numpy(dtype = np.int64) if value_counts is not None else np.zeros(0, dtype = np.int64)
+            values_by_code = np.array(list(self.value_codes[(group_column, value_column)]), dtype = np.float64)
+            npdb_index.quantiles[(group_column, value_column)] = RangeQuantiles(relabel[group_column][value_keys >> 48],
+                                                                                ((value_keys >> 32) & 0xFFFF) - self.first_year,
+                                                                                values_by_code[value_keys & 0xFFFFFFFF],
+                                                                                value_counts.to_numpy(dtype = np.int64) if value_counts is not None else np.zeros(0, dtype = np.int64),
+                                                                                n_groups[group_column], n_years)
+
+        npdb_index.approximate_counts = self.precision is not None
+        if npdb_index.approximate_counts:
+            npdb_index.distinct_error = hll_relative_error(self.precision)
+            npdb_index.distinct_registers = {(group_column, id_column): self.hll_registers[(group_column, id_column)].finish(relabel[group_column], n_groups[group_column],
+                                                                                                                             self.first_year, max(n_years, 1))
+                                             for group_column, id_column in npdb_distinct_keys}
+        else:
+            npdb_index.distinct_error = 0.0
+            npdb_index.distinct_prefix = {(group_column, id_column): self.build_distinct_counter(key_number, (group_column, id_column), relabel[group_column],
+                                                                                                 n_groups[group_column], n_years)
+                                          for key_number, (group_column, id_column) in enumerate(npdb_distinct_keys)}
+
+        return npdb_index
+
+
+    #the year index of every chunk added so far
+    def build(self):
+
+        return NpdbYearIndex(builder = self)
+
+#******************************************************************************
+#SECTION IV: YEAR INDEX
+#******************************************************************************
+
+#per-year, per-group partial aggregates of the npdb dataset answering any contiguous year range without
+#scanning records; query cost depends on the number of years and groups only
+#
+#distinct_error switches the distinct id counts to hyperloglog estimates with about that relative standard
+#error.  the only gain is that the build no longer keeps (or, when streaming, spills) the (group, id, year)
+#appearances behind the exact counts, so its memory is bounded by the registers; the index itself is not
+#smaller or quicker: registers take 2 ** precision bytes per group and year (about 8x the exact index at
+#0.01 on 1M records, with about 10x slower queries) and only come close at errors around 0.05.  indexes
+#of data streamed in chunks are built with NpdbIndexBuilder instead of from a dataframe
+class NpdbYearIndex:
+
+    def __init__(self, npdb_df = None, distinct_error = None, builder = None):
+
+        if builder is None:
+            builder = NpdbIndexBuilder(distinct_error).add_chunk(npdb_df)
+        builder.finish(self)
+        self.state_year_df = self.build_state_year_df()
+
+
+    #the state by year table only depends on single years, so it is computed once for every year
+    def build_state_year_df(self):
+
+        state_year_frames = [self.summarize_states(year, year).assign(ORIGYEAR = year) for year in range(self.first_year, self.last_year + 1)]
+        state_year_df = pd.concat(state_year_frames or [self.summarize_states(0, -1).assign(ORIGYEAR = 0)], ignore_index = True)
+
+        return state_year_df[["ORIGYEAR", "WORKSTAT", "PRACTNUM", "SEQNO", "TOTALPMT", "AALENGTH"] + npdb_percentile_columns].astype({"ORIGYEAR": np.int64})
+
+
+    #the arrays of the index by name, along with everything else as a json serializable dict; used to save the
+    #index as files that several processes can memory map
+    def to_arrays(self):
+
+        arrays = {}
+        settings = {"first_year": self.first_year,
+                    "last_year": self.last_year,
+                    "approximate_counts": self.approximate_counts,
+                    "distinct_error": self.distinct_error,
+                    "group_labels": {group_column: {"labels": group_labels.tolist(), "dtype": str(group_labels.dtype)}
+                                     for group_column, group_labels in self.group_labels.items()},
+                    "quantiles": {},
+                    "state_year_columns": self.state_year_df.columns.tolist()}
+
+        for group_column, prefix in self.row_count_prefix.items():
+            arrays["row_count_prefix.{}".format(group_column)] = prefix
+
+        for (group_column, value_column), prefix in self.sum_prefix.items():
+            arrays["sum_prefix.{}.{}".format(group_column, value_column)] = prefix
+
+        for (group_column, value_column), quantiles in self.quantiles.items():
+            settings["quantiles"]["{}.{}".format(group_column, value_column)] = {"n_groups": quantiles.n_groups, "n_years": quantiles.n_years}
+            for array_name in ["distinct_values", "histogram_prefix", "sorted_values", "block_starts"]:
+                if getattr(quantiles, array_name, None) is not None:
+                    arrays["quantiles.{}.{}.{}".format(group_column, value_column, array_name)] = getattr(quantiles, array_name)
+
+        distinct_arrays = self.distinct_registers if self.approximate_counts else self.distinct_prefix
+        for (group_column, id_column), distinct_array in distinct_arrays.items():
+            arrays["distinct.{}.{}".format(group_column, id_column)] = distinct_array
+
+        #states are stored by their code
+        for column in self.state_year_df.columns:
+            if column == "WORKSTAT":
+                arrays["state_year.WORKSTAT"] = pd.Categorical(self.state_year_df["WORKSTAT"], categories = self.group_labels["WORKSTAT"]).codes.astype(np.int64)
+            else:
+                arrays["state_year.{}".format(column)] = self.state_year_df[column].to_numpy()
+
+        return arrays, settings
+
+
+    #an index from the output of to_arrays; the arrays are used as they are, so memory mapped arrays stay
+    #memory mapped
+    @classmethod
+    def from_arrays(cls, arrays, settings):
+
+        npdb_index = cls.__new__(cls)
+        npdb_index.first_year = settings["first_year"]
+        npdb_index.last_year = settings["last_year"]
+        npdb_index.n_years = npdb_index.last_year - npdb_index.first_year + 1
+        npdb_index.approximate_counts = settings["approximate_counts"]
+        npdb_index.distinct_error = settings["distinct_error"]
+
+        npdb_index.group_labels = {group_column: np.array(group_labels["labels"], dtype = group_labels["dtype"])
+                                   for group_column, group_labels in settings["group_labels"].items()}
+
+        npdb_index.row_count_prefix = {group_column: arrays["row_count_prefix.{}".format(group_column)] for group_column in npdb_group_columns}
+        npdb_index.sum_prefix = {(group_column, value_column): arrays["sum_prefix.{}.{}".format(group_column, value_column)]
+                                 for group_column, value_column in npdb_sum_keys}
+
+        npdb_index.quantiles = {}
+        for group_column, value_column in npdb_quantile_keys:
+            quantiles = RangeQuantiles.__new__(RangeQuantiles)
+            quantiles.n_groups = settings["quantiles"]["{}.{}".format(group_column, value_column)]["n_groups"]
+            quantiles.n_years = settings["quantiles"]["{}.{}".format(group_column, value_column)]["n_years"]
+            for array_name in ["distinct_values", "histogram_prefix", "sorted_values", "block_starts"]:
+                setattr(quantiles, array_name, arrays.get("quantiles.{}.{}.{}".format(group_column, value_column, array_name)))
+            npdb_index.quantiles[(group_column, value_column)] = quantiles
+
+        distinct_arrays = {(group_column, id_column): arrays["distinct.{}.{}".format(group_column, id_column)] for group_column, id_column in npdb_distinct_keys}
+        if npdb_index.approximate_counts:
+            npdb_index.distinct_registers = distinct_arrays
+        else:
+            npdb_index.distinct_prefix = distinct_arrays
+
+        npdb_index.state_year_df = pd.DataFrame({column: arrays["state_year.{}".format(column)] for column in settings["state_year_columns"]})
+        npdb_index.state_year_df["WORKSTAT"] = npdb_index.group_labels["WORKSTAT"][npdb_index.state_year_df["WORKSTAT"].to_numpy()]
+
+        return npdb_index
+
+
+    #year codes covering the records between the starting and ending year (inclusive), or None when no year
+    #of the dataset falls in the range
+    def year_range_codes(self, start_year, end_year):
+
+        start_code = max(math.ceil(start_year), self.first_year) - self.first_year
+        end_code = min(math.floor(end_year), self.last_year) - self.first_year
+
+        if start_code > end_code:
+            return None
+
+        return start_code, end_code
+
+
+    #number of records per group
+    def row_counts(self, group_column, year_codes):
+
+        start_code, end_code = year_codes
+
+        return self.row_count_prefix[group_column][:, end_code + 1] - self.row_count_prefix[group_column][:, start_code]
+
+
+    #number of distinct ids per group; estimates are capped at the number of records, which they cannot exceed
+    def distinct_counts(self, group_column, id_column, year_codes):
+
+        if self.approximate_counts:
+            return np.minimum(query_hll_registers(self.distinct_registers[(group_column, id_column)], *year_codes),
+                              self.row_counts(group_column, year_codes))
+
+        return query_distinct_counter(self.distinct_prefix[(group_column, id_column)], *year_codes)
+
+
+    #median value per group
+    def group_medians(self, group_column, value_column, year_codes):
+
+        return self.quantiles[(group_column, value_column)].median(*year_codes)
+
+
+    #percentiles per group, as one array per percentile
+    def group_percentiles(self, group_column, value_column, year_codes, percentiles):
+
+        return self.quantiles[(group_column, value_column)].percentiles(*year_codes, percentiles).T
+
+
+    #summed value per group
+    def group_sums(self, group_column, value_column, year_codes):
+
+        start_code, end_code = year_codes
+
+        return self.sum_prefix[(group_column, value_column)][:, end_code + 1] - self.sum_prefix[(group_column, value_column)][:, start_code]
+
+
+    #practitioner and record counts with median and percentiles of payment and adverse action length by
+    #practitioner's state location of work, for the states with records between the starting and ending year
+    def summarize_states(self, start_year, end_year):
+
+        year_codes = self.year_range_codes(start_year, end_year)
+        if year_codes is None:
+            return pd.DataFrame({"WORKSTAT": pd.Series(dtype = object),
+                                 "PRACTNUM": pd.Series(dtype = np.int64),
+                                 "SEQNO": pd.Series(dtype = np.int64),
+                                 "TOTALPMT": pd.Series(dtype = np.float64),
+                                 "AALENGTH": pd.Series(dtype = np.float64),
+                                 **{column: pd.Series(dtype = np.float64) for column in npdb_percentile_columns}})
+
+        observed = self.row_counts("WORKSTAT", year_codes) > 0
+
+        state_df = pd.DataFrame({"WORKSTAT": self.group_labels["WORKSTAT"][observed],
+                                 "PRACTNUM": self.distinct_counts("WORKSTAT", "PRACTNUM", year_codes)[observed],
+                                 "SEQNO": self.distinct_counts("WORKSTAT", "SEQNO", year_codes)[observed],
+                                 "TOTALPMT": self.group_medians("WORKSTAT", "TOTALPMT", year_codes)[observed],
+                                 "AALENGTH": self.group_medians("WORKSTAT", "AALENGTH", year_codes)[observed]})
+
+        for value_column in ["TOTALPMT", "AALENGTH"]:
+            for percentile, values in zip(npdb_percentiles, self.group_percentiles("WORKSTAT", value_column, year_codes, npdb_percentiles)):
+                state_df["{}_P{}".format(value_column, percentile)] = values[observed]
+
+        return state_df
+
+
+    #the state summary of each year between the starting and ending year
+    def summarize_state_years(self, start_year, end_year):
+
+        year_codes = self.year_range_codes(start_year, end_year)
+        if year_codes is None:
+            return self.state_year_df.iloc[0:0]
+
+        in_range = self.state_year_df["ORIGYEAR"].between(year_codes[0] + self.first_year, year_codes[1] + self.first_year)
+
+        return self.state_year_df[in_range].reset_index(drop = True)
+
+
+    #record and practitioner counts, total payment and median adverse action length across all states
+    def summarize_overall(self, start_year, end_year):
+
+        year_codes = self.year_range_codes(start_year, end_year)
+        if year_codes is None:
+            return {"SEQNO": 0, "PRACTNUM": 0, "TOTALPMT": 0.0, "AALENGTH": np.nan}
+
+        return {"SEQNO": int(self.distinct_counts("ALL", "SEQNO", year_codes)[0]),
+                "PRACTNUM": int(self.distinct_counts("ALL", "PRACTNUM", year_codes)[0]),
+                "TOTALPMT": float(self.group_sums("ALL", "TOTALPMT", year_codes)[0]),
+                "AALENGTH": float(self.group_medians("ALL", "AALENGTH", year_codes)[0])}
+
+
+    #number of records by code of a group column (ALGNNATR or OUTCOME), for the codes with records between
+    #the starting and ending year
+    def summarize_claims(self, group_column, start_year, end_year):
+
+        year_codes = self.year_range_codes(start_year, end_year)
+        if year_codes is None:
+            return pd.DataFrame({group_column: self.group_labels[group_column][:0],
+                                 "SEQNO": pd.Series(dtype = np.int64)})
+
+        observed = self.row_counts(group_column, year_codes) > 0
+
+        return pd.DataFrame({group_column: self.group_labels[group_column][observed],
+                             "SEQNO": self.distinct_counts(group_column, "SEQNO", year_codes)[observed]})
+
+
+    #number of records between the starting and ending year
+    def count_records(self, start_year, end_year):
+
+        year_codes = self.year_range_codes(start_year, end_year)
+        if year_codes is None:
+            return 0
+
+        return int(self.row_counts("ALL", year_codes)[0])
+
+
+    #record counts by state, allegation group and outcome and total payments, as prefix sums over the years in
+    #a json serializable dict from which a browser can combine any year range; record counts are claim counts
+    #only when no claim has several records, so there is nothing to send (None) when a SEQNO repeats or
+    #counts are approximate
+    def additive_year_payload(self):
+
+        if self.approximate_counts or (self.n_years == 0):
+            return None
+
+        full_range = (0, self.n_years - 1)
+        if self.distinct_counts("ALL", "SEQNO", full_range)[0] != self.row_counts("ALL", full_range)[0]:
+            return None
+
+        return {"first_year": self.first_year,
+                "last_year": self.last_year,
+                "labels": {group_column: self.group_labels[group_column].tolist() for group_column in npdb_group_columns},
+                "claim_prefix": {group_column: self.row_count_prefix[group_column].tolist() for group_column in npdb_group_columns},
+                "payment_prefix": self.sum_prefix[("ALL", "TOTALPMT")][0].tolist()}
+
+
+    #every aggregate shown by the dashboard for one year range
+    def summarize(self, start_year, end_year):
+
+        return {"state_year": self.summarize_state_years(start_year, end_year),
+                "state": self.summarize_states(start_year, end_year),
+                "overall": self.summarize_overall(start_year, end_year),
+                "ALGNNATR": self.summarize_claims("ALGNNATR", start_year, end_year),
+                "OUTCOME": self.summarize_claims("OUTCOME", start_year, end_year)}
+
+#******************************************************************************
+#SECTION V: SUMMARIES OF SELECTED RECORDS
+#******************************************************************************
+
+#group code of every record by sorted group label (-1 where the group value is blank), with the labels
+def sorted_group_codes(records_df, group_column):
+
+    group_codes, group_labels = pd.factorize(records_df[group_column], sort = True)
+
+    return group_codes.astype(np.int64), np.asarray(group_labels)
+
+
+#number of distinct ids per group code from the id code of every record (-1 where the id is blank, as given
+#by pd.factorize), leaving out records with a blank group or id; when no id repeats, that is the number of
+#records of each group with an id
+def count_distinct_ids(group_codes, id_codes, n_ids, n_groups):
+
+    valid = (group_codes >= 0) & (id_codes >= 0)
+    if n_ids == np.count_nonzero(id_codes >= 0):
+        return np.bincount(group_codes[valid], minlength = n_groups)
+
+    distinct_pairs = pd.unique(group_codes[valid] * n_ids + id_codes[valid])
+
+    return np.bincount(distinct_pairs // max(n_ids, 1), minlength = n_groups)
+
+
+#medians and percentiles of the values of each group code, combined by the same code as the year index
+def group_quantiles(group_codes, values, n_groups):
+
+    valid = (group_codes >= 0) & ~np.isnan(values)
+
+    return RangeQuantiles(group_codes[valid], np.zeros(valid.sum(), dtype = np.int64), values[valid],
+                          np.ones(valid.sum(), dtype = np.int64), n_groups, 1)
+
+
+#practitioner and record counts with median and percentiles of payment and adverse action length of the
+#records of each group code, for the groups with records; id_codes holds the id codes of the records and
+#the number of distinct ids of each id column
+def summarize_record_groups(records_df, id_codes, group_codes, n_groups):
+
+    observed = np.bincount(group_codes[group_codes >= 0], minlength = n_groups) > 0
+
+    group_df = pd.DataFrame({id_column: count_distinct_ids(group_codes, *id_codes[id_column], n_groups)[observed] for id_column in ["PRACTNUM", "SEQNO"]})
+
+    quantiles = {value_column: group_quantiles(group_codes, records_df[value_column].to_numpy(dtype = np.float64, na_value = np.nan), n_groups)
+                 for value_column in ["TOTALPMT", "AALENGTH"]}
+    for value_column in ["TOTALPMT", "AALENGTH"]:
+        group_df[value_column] = quantiles[value_column].median(0, 0)[observed]
+    for value_column in ["TOTALPMT", "AALENGTH"]:
+        for percentile, values in zip(npdb_percentiles, quantiles[value_column].percentiles(0, 0, npdb_percentiles).T):
+            group_df["{}_P{}".format(value_column, percentile)] = values[observed]
+
+    return group_df, observed
+
+
+#every aggregate shown by the dashboard for the records between the starting and ending year, computed
+#straight from the records with one grouping per figure; the same as the summary of a year index of the
+#records, without building the aggregates of every other year range.  used for the few records selected by
+#a cross filter, whose year index would only ever answer one year range.  distinct counts are always exact
+def summarize_npdb_records(records_df, start_year, end_year):
+
+    record_years = records_df["ORIGYEAR"].to_numpy(dtype = np.int64)
+    in_range = (record_years >= math.ceil(start_year)) & (record_years <= math.floor(end_year))
+    if not in_range.all():
+        records_df, record_years = records_df[in_range], record_years[in_range]
+
+    id_codes = {}
+    for id_column in ["SEQNO", "PRACTNUM"]:
+        record_id_codes, id_labels = pd.factorize(records_df[id_column])
+        id_codes[id_column] = (record_id_codes.astype(np.int64), len(id_labels))
+
+    first_year, last_year = (int(record_years.min()), int(record_years.max())) if len(record_years) else (0, -1)
+    state_codes, state_labels = sorted_group_codes(records_df, "WORKSTAT")
+    n_states = max(len(state_labels), 1)
+    n_years = last_year - first_year + 1
+
+    #(year, state) cells numbered in the order of the state by year table
+    cell_codes = np.where(state_codes >= 0, (record_years - first_year) * n_states + state_codes, -1)
+    state_year_df, observed = summarize_record_groups(records_df, id_codes, cell_codes, n_years * n_states)
+    state_year_df.insert(0, "WORKSTAT", state_labels[np.flatnonzero(observed) % n_states])
+    state_year_df.insert(0, "ORIGYEAR", first_year + np.flatnonzero(observed) // n_states)
+
+    state_df, observed = summarize_record_groups(records_df, id_codes, state_codes, len(state_labels))
+    state_df.insert(0, "WORKSTAT", state_labels[observed])
+
+    #payments are added up year by year, as in the year index, so the totals agree to the last digit
+    all_codes = np.zeros(len(records_df), dtype = np.int64)
+    payments = np.nan_to_num(records_df["TOTALPMT"].to_numpy(dtype = np.float64, na_value = np.nan))
+    overall = {"SEQNO": id_codes["SEQNO"][1],
+               "PRACTNUM": id_codes["PRACTNUM"][1],
+               "TOTALPMT": float(np.bincount(record_years - first_year, weights = payments, minlength = 1).cumsum()[-1]),
+               "AALENGTH": float(group_quantiles(all_codes, records_df["AALENGTH"].to_numpy(dtype = np.float64, na_value = np.nan), 1).median(0, 0)[0])}
+
+    summary = {"state_year": state_year_df, "state": state_df, "overall": overall}
+    for group_column in ["ALGNNATR", "OUTCOME"]:
+        group_codes, group_labels = sorted_group_codes(records_df, group_column)
+        summary[group_column] = pd.DataFrame({group_column: group_labels,
+                                              "SEQNO": count_distinct_ids(group_codes, *id_codes["SEQNO"], len(group_labels))})
+
+    return summary
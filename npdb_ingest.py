@@ -0,0 +1,616 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import math
+import hashlib
+import tempfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
+
+from npdb_schema import npdb_load_columns, npdb_read_dtypes, npdb_required_columns, apply_npdb_schema, apply_npdb_categories
+from npdb_index import NpdbIndexBuilder, npdb_distinct_keys, npdb_spill_dtype
+
+#pyarrow is only needed for the on-disk feather cache and zero-copy stacking of partitions; without it
+#every start reads the csv and partitions are stacked with pandas
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+    feather = None
+
+#the peak memory of a whole process (reported by npdb_bench) is only measured on platforms with the resource
+#module (not on windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#******************************************************************************
+#SECTION I: CACHE SETTINGS
+#******************************************************************************
+
+#bump whenever the cleaning steps change so stale caches are rebuilt
+npdb_cache_version = 5
+
+#files of appended records the cache may gather (see append_npdb_cache) before the next append rewrites it whole
+npdb_cache_max_appended = 8
+
+#size of the blocks read when hashing the source file
+npdb_hash_blocksize = 1024 * 1024
+
+#rough bytes of memory taken per record of a chunk while it is parsed and cleaned, and per csv byte by the
+#spilled appearances of a partition while its distinct counts are tallied; used to size chunks and spill
+#partitions from the memory budget of streaming ingestion
+npdb_stream_row_bytes = 2048
+npdb_stream_spill_ratio = 2
+
+#bytes per record of a chunk taken while its appearances are written to the spill files: for every distinct
+#key, the appearances, their copy ordered by spill partition, and the partition and order of each
+npdb_stream_spill_row_bytes = len(npdb_distinct_keys) * (2 * npdb_spill_dtype.itemsize + 16)
+
+#fewest records per chunk; smaller chunks spend more time in per-chunk overhead than they save in memory, so
+#budgets too small for them are rejected
+npdb_stream_min_chunk_rows = 1000
+
+#******************************************************************************
+#SECTION II: READING AND CLEANING OF INPUT FILES
+#******************************************************************************
+
+#list the csv files making up the input: a single file, a directory of partition files
+#(e.g. NPDB2004_1.csv to NPDB2004_16.csv) or a glob pattern matching the partition files
+def resolve_npdb_sources(npdb_filepath):
+
+    if os.path.isdir(npdb_filepath):
+        npdb_sources = glob.glob(os.path.join(npdb_filepath, "*.csv"))
+    elif glob.has_magic(npdb_filepath):
+        npdb_sources = glob.glob(npdb_filepath)
+    else:
+        return [npdb_filepath]
+
+    if not npdb_sources:
+        raise FileNotFoundError("No NPDB csv files found for {}".format(npdb_filepath))
+
+    #natural sort so NPDB2004_2 comes before NPDB2004_10
+    return sorted(npdb_sources, key = lambda source: [int(part) if part.isdigit() else part
+                                                      for part in re.split(r"(\d+)", os.path.basename(source))])
+
+
+#first line of a csv file, used to tell partitions that repeat the header from those that do not
+def read_header_line(npdb_filepath):
+
+    with open(npdb_filepath, "rb") as npdb_file:
+        return npdb_file.readline().rstrip(b"\r\n")
+
+
+#read_csv arguments reading the columns the dashboard uses, with the data types from the schema
+def npdb_read_options(column_names = None, blank_columns = ()):
+
+    load_columns = npdb_load_columns()
+
+    return {"header": "infer" if column_names is None else None,
+            "names": column_names,
+            "usecols": lambda column: column in load_columns,
+            "dtype": npdb_read_dtypes(blank_columns),
+            "low_memory": False}
+
+
+#whether read_csv failed because a column read as integers has blanks or fractions in it (other errors,
+#such as text in a numeric column, are not retried)
+def is_integer_read_error(read_error):
+
+    return any(message in str(read_error) for message in ["Integer column has NA values", "cannot safely convert"])
+
+
+#always present integer columns with blanks anywhere in a file, found by reading only those columns (in
+#chunks of chunk_rows records when given), so the data types of a file are decided before any of it is read
+def scan_npdb_blank_columns(npdb_filepath, column_names = None, chunk_rows = None):
+
+    blank_columns = set()
+
+    with pd.read_csv(npdb_filepath, header = "infer" if column_names is None else None, names = column_names,
+                     usecols = lambda column: column in npdb_required_columns, dtype = "float64",
+                     iterator = True, chunksize = chunk_rows) as required_chunks:
+        for required_chunk in required_chunks:
+            blank_columns.update(required_chunk.columns[required_chunk.isna().any().to_numpy()])
+
+    return sorted(blank_columns)
+
+
+#read in the columns of a raw npdb csv file the dashboard uses, with the data types from the schema;
+#column_names is passed for partitions without a header row.  a file with blanks in a column that should
+#always be present fails to parse as integers, and is read again with the blank columns as floats
+def read_npdb_csv(npdb_filepath, column_names = None):
+
+    start_position = npdb_filepath.tell() if hasattr(npdb_filepath, "tell") else None
+
+    try:
+        npdb_df = pd.read_csv(npdb_filepath, **npdb_read_options(column_names))
+    except ValueError as read_error:
+        if not is_integer_read_error(read_error):
+            raise
+        if start_position is not None:
+            npdb_filepath.seek(start_position)
+        blank_columns = scan_npdb_blank_columns(npdb_filepath, column_names)
+        if start_position is not None:
+            npdb_filepath.seek(start_position)
+        npdb_df = pd.read_csv(npdb_filepath, **npdb_read_options(column_names, blank_columns))
+
+    check_npdb_columns(npdb_filepath, npdb_df)
+
+    return npdb_df
+
+
+#read in the same columns as read_npdb_csv in chunks of chunk_rows records; the columns that should always be
+#present are scanned for blanks first, so every chunk is read with the same data types
+def read_npdb_csv_chunks(npdb_filepath, chunk_rows, column_names = None):
+
+    blank_columns = scan_npdb_blank_columns(npdb_filepath, column_names, chunk_rows)
+
+    with pd.read_csv(npdb_filepath, chunksize = chunk_rows, **npdb_read_options(column_names, blank_columns)) as npdb_chunks:
+        for npdb_chunk in npdb_chunks:
+            check_npdb_columns(npdb_filepath, npdb_chunk)
+            yield npdb_chunk
+
+
+#raise an error naming the loaded columns missing from a file
+def check_npdb_columns(npdb_filepath, npdb_df):
+
+    missing_columns = [column for column in npdb_load_columns() if column not in npdb_df.columns]
+    if missing_columns:
+        raise ValueError("NPDB file {} is missing columns {}".format(npdb_filepath, missing_columns))
+
+
+#clean the columns used by the dashboard (strips the $ sign from payments and compacts the data types)
+def clean_npdb_df(npdb_df):
+
+    return apply_npdb_schema(npdb_df)
+
+
+#order records by year (keeping file order within a year) so any year range is a contiguous block of rows
+def sort_npdb_df(npdb_df):
+
+    return npdb_df.sort_values("ORIGYEAR", kind = "stable", ignore_index = True)
+
+
+#stack cleaned dataframes, giving their coded columns the union of their categories first (pandas turns
+#categorical columns with different categories into object columns); the dataframes passed are not changed
+def concat_npdb_frames(npdb_frames):
+
+    npdb_frames = [npdb_frame.copy(deep = False) for npdb_frame in npdb_frames]
+
+    for column, dtype in npdb_frames[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            categories = sorted(set().union(*(npdb_frame[column].cat.categories for npdb_frame in npdb_frames)))
+            for npdb_frame in npdb_frames:
+                if list(npdb_frame[column].cat.categories) != categories:
+                    npdb_frame[column] = npdb_frame[column].cat.set_categories(categories)
+
+    return pd.concat(npdb_frames, ignore_index = True)
+
+#******************************************************************************
+#SECTION III: CACHE INVALIDATION
+#******************************************************************************
+
+#content hash of the source file, read block by block to keep memory flat
+def hash_npdb_file(npdb_filepath):
+
+    file_hash = hashlib.sha256()
+
+    with open(npdb_filepath, "rb") as npdb_file:
+        for block in iter(lambda: npdb_file.read(npdb_hash_blocksize), b""):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+#size, modification time and content hash identifying one version of the source files
+def npdb_source_signature(npdb_sources, with_hash = True):
+
+    signature = {"parts": [],
+                 "cache_version": npdb_cache_version}
+
+    for source in npdb_sources:
+        file_stat = os.stat(source)
+        signature["parts"].append({"path": os.path.abspath(source),
+                                   "size": file_stat.st_size,
+                                   "mtime_ns": file_stat.st_mtime_ns})
+
+    if with_hash:
+        add_source_hashes(signature)
+
+    return signature
+
+
+#hash the partition files side by side; hashlib releases the gil on large blocks so threads are enough
+def add_source_hashes(signature):
+
+    part_paths = [part["path"] for part in signature["parts"]]
+
+    with ThreadPoolExecutor(max_workers = min(len(part_paths), os.cpu_count() or 1)) as executor:
+        part_hashes = list(executor.map(hash_npdb_file, part_paths))
+
+    for part, part_hash in zip(signature["parts"], part_hashes):
+        part["sha256"] = part_hash
+
+    return signature
+
+
+#location of the cache files for a given input path
+def npdb_cache_paths(npdb_filepath, npdb_sources, cache_dir = None):
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(npdb_sources[0])), ".npdb_cache")
+
+    if len(npdb_sources) == 1 and npdb_sources[0] == npdb_filepath:
+        cache_name = os.path.splitext(os.path.basename(npdb_filepath))[0]
+    else:
+        #directories and glob patterns are named after the first partition plus a short hash of the input path
+        path_hash = hashlib.sha256(os.path.abspath(npdb_filepath).encode("utf-8")).hexdigest()[:12]
+        cache_name = os.path.splitext(os.path.basename(npdb_sources[0]))[0] + "_parts_" + path_hash
+
+    return (os.path.join(cache_dir, cache_name + ".feather"),
+            os.path.join(cache_dir, cache_name + ".json"))
+
+
+#check the stored signature against the source files; sizes and mtimes are compared first so a changed
+#file is detected without paying for the hash
+def npdb_cache_is_valid(npdb_sources, cache_filepath, meta_filepath):
+
+    if not (os.path.exists(cache_filepath) and os.path.exists(meta_filepath)):
+        return False, None
+
+    with open(meta_filepath) as meta_file:
+        cached_signature = json.load(meta_file)
+
+    signature = npdb_source_signature(npdb_sources, with_hash = False)
+    if cached_signature.get("cache_version") != signature["cache_version"]:
+        return False, None
+    if not all(os.path.exists(appended_filepath) for appended_filepath in npdb_appended_cache_paths(cache_filepath, cached_signature)):
+        return False, None
+
+    cached_parts = [{key: part.get(key) for key in ("path", "size", "mtime_ns")} for part in cached_signature.get("parts", [])]
+    if cached_parts != signature["parts"]:
+        return False, None
+
+    add_source_hashes(signature)
+    if cached_signature["parts"] != signature["parts"]:
+        return False, signature
+
+    return True, signature
+
+
+#files of the records appended to the cache since it was written, listed in its stored signature
+def npdb_appended_cache_paths(cache_filepath, cached_signature):
+
+    return [os.path.join(os.path.dirname(cache_filepath), appended_name) for appended_name in cached_signature.get("appended_files", [])]
+
+
+#write the cleaned dataframe and its source signature, swapping both files in atomically (and removing the
+#files of records appended to the cache it replaces)
+def write_npdb_cache(npdb_df, signature, cache_filepath, meta_filepath):
+
+    os.makedirs(os.path.dirname(cache_filepath), exist_ok = True)
+
+    try:
+        with open(meta_filepath) as meta_file:
+            stale_filepaths = npdb_appended_cache_paths(cache_filepath, json.load(meta_file))
+    except (OSError, ValueError):
+        stale_filepaths = []
+
+    #feather requires a default index
+    feather.write_feather(npdb_df.reset_index(drop = True), cache_filepath + ".tmp")
+    os.replace(cache_filepath + ".tmp", cache_filepath)
+
+    with open(meta_filepath + ".tmp", "w") as meta_file:
+        json.dump(signature, meta_file, indent = 2)
+    os.replace(meta_filepath + ".tmp", meta_filepath)
+
+    for stale_filepath in stale_filepaths:
+        if os.path.exists(stale_filepath):
+            os.remove(stale_filepath)
+
+
+#add the records appended to the source files to the cache as a file of their own, listed in the stored
+#signature, so the cached records are not written again; returns False (leaving the cache alone) when the
+#cache is not the one of previous_signature or already holds npdb_cache_max_appended files of appended
+#records, and the caller writes the whole cache instead
+def append_npdb_cache(appended_df, previous_signature, signature, cache_filepath, meta_filepath):
+
+    try:
+        with open(meta_filepath) as meta_file:
+            cached_signature = json.load(meta_file)
+    except (OSError, ValueError):
+        return False
+
+    appended_files = cached_signature.get("appended_files", [])
+    if (cached_signature.get("parts") != previous_signature["parts"]) or (len(appended_files) >= npdb_cache_max_appended) or not os.path.exists(cache_filepath):
+        return False
+
+    if len(appended_df):
+        #named after the source files it brings the cache up to, so processes appending the same records
+        #write the same file
+        parts_hash = hashlib.sha256(json.dumps(signature["parts"], sort_keys = True).encode("utf-8")).hexdigest()[:12]
+        appended_name = "{}.{}.feather".format(os.path.splitext(os.path.basename(cache_filepath))[0], parts_hash)
+        appended_filepath = os.path.join(os.path.dirname(cache_filepath), appended_name)
+        feather.write_feather(appended_df.reset_index(drop = True), "{}.{}.tmp".format(appended_filepath, os.getpid()))
+        os.replace("{}.{}.tmp".format(appended_filepath, os.getpid()), appended_filepath)
+        appended_files = appended_files + [appended_name]
+
+    with open("{}.{}.tmp".format(meta_filepath, os.getpid()), "w") as meta_file:
+        json.dump(dict(signature, appended_files = appended_files), meta_file, indent = 2)
+    os.replace("{}.{}.tmp".format(meta_filepath, os.getpid()), meta_filepath)
+
+    return True
+
+
+#records of the cache: the cached records and the records appended to it since, ordered by year
+def read_npdb_cache(cache_filepath, meta_filepath):
+
+    with open(meta_filepath) as meta_file:
+        appended_filepaths = npdb_appended_cache_paths(cache_filepath, json.load(meta_file))
+
+    npdb_df = feather.read_feather(cache_filepath)
+    if not appended_filepaths:
+        return npdb_df
+
+    return sort_npdb_df(concat_npdb_frames([npdb_df] + [feather.read_feather(appended_filepath) for appended_filepath in appended_filepaths]))
+
+#******************************************************************************
+#SECTION IV: LOADING
+#******************************************************************************
+
+#read and clean one partition file; runs in the process pool
+def read_npdb_part(part_filepath, column_names = None):
+
+    part_df = clean_npdb_df(read_npdb_csv(part_filepath, column_names))
+    part_schema = [(column, str(dtype)) for column, dtype in part_df.dtypes.items()]
+
+    #arrow tables travel back to the parent as raw buffers and can be stacked without copying
+    if pa is not None:
+        part_df = pa.Table.from_pandas(part_df, preserve_index = False)
+
+    return part_df, part_schema
+
+
+#check that every partition has the same columns and data types as the first one
+def check_npdb_part_schemas(npdb_sources, part_schemas):
+
+    for source, part_schema in zip(npdb_sources[1:], part_schemas[1:]):
+        if part_schema != part_schemas[0]:
+            mismatches = sorted(set(part_schema).symmetric_difference(part_schemas[0]))
+            raise ValueError("NPDB partition {} does not match the schema of {}: {}".format(source, npdb_sources[0], mismatches))
+
+
+#column names to pass when reading each partition: None for partitions starting with the header of the
+#first file, the header's names for headerless partitions
+def npdb_part_column_names(npdb_sources):
+
+    header_line = read_header_line(npdb_sources[0])
+    column_names = pd.read_csv(npdb_sources[0], nrows = 0).columns.tolist()
+
+    return [None if read_header_line(source) == header_line else column_names for source in npdb_sources]
+
+
+#read, clean and stack the partition files, parsing them side by side in a process pool
+def read_npdb_parts(npdb_sources, max_workers = None):
+
+    part_column_names = npdb_part_column_names(npdb_sources)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(npdb_sources))
+
+    #workers are forked so they do not re-run the dashboard module on import; on platforms without fork
+    #the partitions are read one after another in this process
+    if max_workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context("fork")) as executor:
+            part_results = list(executor.map(read_npdb_part, npdb_sources, part_column_names))
+    else:
+        part_results = [read_npdb_part(source, names) for source, names in zip(npdb_sources, part_column_names)]
+
+    part_frames = [part_frame for part_frame, _ in part_results]
+    check_npdb_part_schemas(npdb_sources, [part_schema for _, part_schema in part_results])
+    del part_results
+
+    if pa is not None:
+        #concat_tables only stitches the chunks together; self_destruct releases each arrow column as soon
+        #as it is converted, so the stacked data is never held twice
+        npdb_table = pa.concat_tables(part_frames)
+        del part_frames
+        npdb_df = npdb_table.to_pandas(self_destruct = True, split_blocks = True)
+    else:
+        npdb_df = pd.concat(part_frames, ignore_index = True, copy = False)
+
+    #partitions may have seen different subsets of the coded values
+    return apply_npdb_categories(npdb_df)
+
+
+#load the cleaned npdb dataframe, from the feather cache when it matches the source files and from the
+#csv files otherwise; returns the dataframe along with a report of where it came from and how long it took
+def load_npdb_df(npdb_filepath, cache_dir = None, use_cache = True, max_workers = None):
+
+    load_start = time.perf_counter()
+    npdb_sources = resolve_npdb_sources(npdb_filepath)
+    load_report = {"source": "csv", "parts": len(npdb_sources), "cache_filepath": None}
+
+    use_cache = use_cache and (feather is not None)
+    signature = None
+
+    if use_cache:
+        cache_filepath, meta_filepath = npdb_cache_paths(npdb_filepath, npdb_sources, cache_dir)
+        load_report["cache_filepath"] = cache_filepath
+
+        cache_valid, signature = npdb_cache_is_valid(npdb_sources, cache_filepath, meta_filepath)
+        load_report["validate_seconds"] = time.perf_counter() - load_start
+
+        if cache_valid:
+            npdb_df = read_npdb_cache(cache_filepath, meta_filepath)
+            load_report["source"] = "cache"
+            load_report["seconds"] = time.perf_counter() - load_start
+            load_report["memory_bytes"] = int(npdb_df.memory_usage(index = False, deep = True).sum())
+            return npdb_df, load_report
+
+    #signature is taken before reading so a file replaced mid-read is caught on the next start
+    if use_cache and (signature is None):
+        signature = npdb_source_signature(npdb_sources)
+
+    #cold load from csv
+    if len(npdb_sources) == 1:
+        npdb_df = clean_npdb_df(read_npdb_csv(npdb_sources[0]))
+    else:
+        npdb_df = read_npdb_parts(npdb_sources, max_workers = max_workers)
+    npdb_df = sort_npdb_df(npdb_df)
+    load_report["read_seconds"] = time.perf_counter() - load_start
+
+    if use_cache:
+        write_npdb_cache(npdb_df, signature, cache_filepath, meta_filepath)
+
+    load_report["seconds"] = time.perf_counter() - load_start
+    load_report["memory_bytes"] = int(npdb_df.memory_usage(index = False, deep = True).sum())
+
+    return npdb_df, load_report
+
+
+#one line summary of a load report for the console
+def format_load_report(load_report):
+
+    if load_report["source"] == "stream":
+        return "NPDB data streamed ({} file(s), {:,} records in {} chunk(s) of {:,}, {} spill partition(s)) in {:.2f}s, peak memory added {:.1f} MB (budget {:.1f} MB)".format(
+            load_report["parts"], load_report["rows"], load_report["chunks"], load_report["chunk_rows"], load_report["spill_buckets"],
+            load_report["seconds"], load_report["load_memory_bytes"] / 1024 ** 2, load_report["memory_budget_bytes"] / 1024 ** 2)
+
+    load_kind = "warm" if load_report["source"] == "cache" else "cold"
+
+    return "NPDB data loaded ({}, from {}, {} file(s)) in {:.2f}s, {:.1f} MB in memory".format(load_kind, load_report["source"], load_report["parts"],
+                                                                                             load_report["seconds"], load_report["memory_bytes"] / 1024 ** 2)
+
+#******************************************************************************
+#SECTION V: STREAMING
+#******************************************************************************
+
+#largest resident size of this process so far in bytes, or None where it cannot be measured
+def peak_memory_bytes():
+
+    if resource is None:
+        return None
+
+    #linux reports kilobytes, macos bytes
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_memory if sys.platform == "darwin" else peak_memory * 1024
+
+
+#resident size and peak resident size of this process in bytes, from /proc (linux only)
+def read_proc_memory():
+
+    proc_memory = {}
+    with open("/proc/self/status") as status_file:
+        for status_line in status_file:
+            if status_line.startswith(("VmRSS:", "VmHWM:")):
+                name, value = status_line.split(":")
+                proc_memory[name] = int(value.split()[0]) * 1024
+
+    return proc_memory["VmRSS"], proc_memory["VmHWM"]
+
+
+#measures the memory a load adds on top of what the process already holds, from its creation to finish: the
+#peak resident size during the load less the resident size before it.  on linux the peak of the process is
+#reset at the start, so earlier peaks do not count (loads running at the same time in other threads do);
+#elsewhere the memory allocated through python is traced with tracemalloc instead, which sees the numpy and
+#pandas arrays but not the buffers of the csv parser
+class NpdbLoadMemory:
+
+    def __init__(self):
+
+        self.start_rss = None
+        self.started_tracing = False
+
+        try:
+            with open("/proc/self/clear_refs", "w") as clear_refs_file:
+                clear_refs_file.write("5")
+            self.start_rss, _ = read_proc_memory()
+        except (OSError, KeyError):
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.start_traced, _ = tracemalloc.get_traced_memory()
+
+
+    #peak bytes added since the measurement started
+    def finish(self):
+
+        if self.start_rss is not None:
+            _, peak_rss = read_proc_memory()
+            return max(0, peak_rss - self.start_rss)
+
+        _, peak_traced = tracemalloc.get_traced_memory()
+        if self.started_tracing:
+            tracemalloc.stop()
+
+        return max(0, peak_traced - self.start_traced)
+
+
+#smallest memory budget of streaming ingestion: room for a chunk of npdb_stream_min_chunk_rows records
+def npdb_stream_min_budget_bytes():
+
+    return 2 * npdb_stream_min_chunk_rows * (npdb_stream_row_bytes + npdb_stream_spill_row_bytes)
+
+
+#records per chunk and number of spill partitions fitting a memory budget: half of the budget goes to the
+#chunk being parsed, cleaned and spilled, and the other half to tallying one spill partition
+def npdb_stream_plan(npdb_sources, memory_budget_bytes):
+
+    if memory_budget_bytes < npdb_stream_min_budget_bytes():
+        raise ValueError("NPDB streaming memory budget of {:.1f} MB is below the minimum of {:.1f} MB (chunks of {:,} records)".format(
+            memory_budget_bytes / 1024 ** 2, npdb_stream_min_budget_bytes() / 1024 ** 2, npdb_stream_min_chunk_rows))
+
+    chunk_rows = memory_budget_bytes // 2 // (npdb_stream_row_bytes + npdb_stream_spill_row_bytes)
+    source_bytes = sum(os.path.getsize(source) for source in npdb_sources)
+    spill_buckets = max(1, math.ceil(source_bytes * npdb_stream_spill_ratio / (memory_budget_bytes / 2)))
+
+    return chunk_rows, spill_buckets
+
+
+#build the year index of the npdb csv file(s) without holding the records in memory: the files are read
+#and cleaned in chunks sized to the memory budget, and only the aggregates behind the callbacks are kept,
+#with the record ids behind the exact distinct counts spilled to a temporary directory (under spill_dir
+#when given); returns the index along with a load report
+def stream_npdb_index(npdb_filepath, memory_budget_bytes, distinct_error = None, spill_dir = None):
+
+    load_start = time.perf_counter()
+    npdb_sources = resolve_npdb_sources(npdb_filepath)
+    chunk_rows, spill_buckets = npdb_stream_plan(npdb_sources, memory_budget_bytes)
+    load_memory = NpdbLoadMemory()
+
+    if spill_dir is not None:
+        os.makedirs(spill_dir, exist_ok = True)
+
+    with tempfile.TemporaryDirectory(prefix = "npdb_spill_", dir = spill_dir) as spill_path:
+        index_builder = NpdbIndexBuilder(distinct_error = distinct_error, spill_dir = spill_path, spill_buckets = spill_buckets)
+
+        for source, column_names in zip(npdb_sources, npdb_part_column_names(npdb_sources)):
+            for npdb_chunk in read_npdb_csv_chunks(source, chunk_rows, column_names):
+                index_builder.add_chunk(clean_npdb_df(npdb_chunk))
+                del npdb_chunk
+
+        npdb_index = index_builder.build()
+
+    load_report = {"source": "stream",
+                   "parts": len(npdb_sources),
+                   "rows": index_builder.n_rows,
+                   "chunks": index_builder.n_chunks,
+                   "chunk_rows": chunk_rows,
+                   "spill_buckets": spill_buckets,
+                   "memory_budget_bytes": memory_budget_bytes,
+                   "load_memory_bytes": load_memory.finish(),
+                   "seconds": time.perf_counter() - load_start}
+
+    return npdb_index, load_report
@@ -0,0 +1,278 @@
+import os
+import time
+import heapq
+import bisect
+import cProfile
+import threading
+import functools
+import contextlib
+
+from flask import Response, request, has_request_context
+
+#******************************************************************************
+#SECTION I: METRIC SETTINGS
+#******************************************************************************
+
+#upper bounds of the histogram buckets of phase and callback times in seconds
+npdb_seconds_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+#upper bounds of the histogram buckets of records scanned per callback
+npdb_rows_buckets = [1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000]
+
+#upper bounds of the histogram buckets of callback response sizes in bytes
+npdb_bytes_buckets = [1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216]
+
+#phases of a callback: finding the summary of the year range, computing it when it is not cached yet,
+#building the table or figure from it, and dash serializing the output into the response
+npdb_callback_phases = ["filter", "aggregate", "figure", "serialize"]
+
+#dash route answering callback requests
+npdb_callback_route = "_dash-update-component"
+
+#******************************************************************************
+#SECTION II: HISTOGRAMS
+#******************************************************************************
+
+#cumulative histogram with one series per combination of label values, written in the prometheus text format
+class MetricHistogram:
+
+    def __init__(self, name, help_text, label_names, buckets):
+
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+
+    #record one observation for the given label values
+    def observe(self, label_values, value):
+
+        bucket = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            if label_values not in self.series:
+                self.series[label_values] = {"bucket_counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series = self.series[label_values]
+            series["bucket_counts"][bucket] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+
+    #lines of the prometheus text exposition of the histogram
+    def exposition_lines(self):
+
+        exposition_lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} histogram".format(self.name)]
+
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = ",".join('{}="{}"'.format(label_name, label_value) for label_name, label_value in zip(self.label_names, label_values))
+                cumulative_count = 0
+
+                for upper_bound, bucket_count in zip(self.buckets + ["+Inf"], series["bucket_counts"]):
+                    cumulative_count += bucket_count
+                    exposition_lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(self.name, labels, "," if labels else "", upper_bound, cumulative_count))
+
+                exposition_lines.append("{}_sum{{{}}} {}".format(self.name, labels, series["sum"]))
+                exposition_lines.append("{}_count{{{}}} {}".format(self.name, labels, series["count"]))
+
+        return exposition_lines
+
+#******************************************************************************
+#SECTION III: CALLBACK INSTRUMENTATION
+#******************************************************************************
+
+#per-callback timings split into phases, records scanned and response sizes, served on /metrics; when
+#profile_slowest is set, callback requests are also run under cProfile and the profiles of the slowest
+#profile_slowest requests are kept as .prof files in profile_dir (open them with pstats or snakeviz)
+class NpdbMetrics:
+
+    def __init__(self, profile_slowest = 0, profile_dir = None):
+
+        self.phase_seconds = MetricHistogram("npdb_callback_phase_seconds", "Time spent in each phase of a dashboard callback",
+                                             ("callback", "phase"), npdb_seconds_buckets)
+        self.callback_seconds = MetricHistogram("npdb_callback_seconds", "Total time of a dashboard callback, serialization included when served",
+                                                ("callback",), npdb_seconds_buckets)
+        self.rows_scanned = MetricHistogram("npdb_callback_rows_scanned", "Records in the year range summarized by a dashboard callback",
+                                            ("callback",), npdb_rows_buckets)
+        self.response_bytes = MetricHistogram("npdb_callback_response_bytes", "Size of the response of a dashboard callback",
+                                              ("callback",), npdb_bytes_buckets)
+
+        self.profile_slowest = profile_slowest
+        self.profile_dir = profile_dir
+        self.slowest_profiles = []
+        self.profile_lock = threading.Lock()
+
+        #state of the callback running in each thread
+        self.local = threading.local()
+
+
+    #time the block as one phase of the running callback; time spent in a phase nested inside another
+    #counts towards the inner phase only
+    @contextlib.contextmanager
+    def phase(self, phase_name):
+
+        record = getattr(self.local, "record", None)
+        if record is None:
+            yield
+            return
+
+        phase_start = time.perf_counter()
+        if record["phase_stack"]:
+            outer_phase = record["phase_stack"][-1]
+            record["phases"][outer_phase[0]] = record["phases"].get(outer_phase[0], 0.0) + phase_start - outer_phase[1]
+        record["phase_stack"].append([phase_name, phase_start])
+
+        try:
+            yield
+        finally:
+            phase_end = time.perf_counter()
+            record["phases"][phase_name] = record["phases"].get(phase_name, 0.0) + phase_end - record["phase_stack"].pop()[1]
+            if record["phase_stack"]:
+                record["phase_stack"][-1][1] = phase_end
+
+
+    #count records scanned by the running callback
+    def add_rows(self, n_rows):
+
+        record = getattr(self.local, "record", None)
+        if record is not None:
+            record["rows"] += n_rows
+
+
+    #decorator timing a dash callback; time not spent in the filter or aggregate phases counts as building
+    #the figure, and callbacks that raise (including PreventUpdate) are not recorded
+    def instrument(self, callback):
+
+        @functools.wraps(callback)
+        def instrumented_callback(*args, **kwargs):
+
+            record = {"callback": callback.__name__, "phases": {}, "phase_stack": [], "rows": 0}
+            self.local.record = record
+            callback_start = time.perf_counter()
+
+            try:
+                output = callback(*args, **kwargs)
+            finally:
+                self.local.record = None
+
+            record["seconds"] = time.perf_counter() - callback_start
+            record["phases"]["figure"] = max(record["seconds"] - sum(record["phases"].values()), 0.0)
+
+            #serialization happens in dash after the callback returns, so served callbacks are recorded
+            #when their response is ready
+            if has_request_context():
+                self.local.finished_record = record
+            else:
+                self.observe(record)
+
+            return output
+
+        return instrumented_callback
+
+
+    #record the metrics of a finished callback
+    def observe(self, record, serialize_seconds = None, response_bytes = None):
+
+        total_seconds = record["seconds"]
+        if serialize_seconds is not None:
+            record["phases"]["serialize"] = serialize_seconds
+            total_seconds += serialize_seconds
+
+        for phase_name in npdb_callback_phases:
+            if phase_name in record["phases"]:
+                self.phase_seconds.observe((record["callback"], phase_name), record["phases"][phase_name])
+        self.callback_seconds.observe((record["callback"],), total_seconds)
+        self.rows_scanned.observe((record["callback"],), record["rows"])
+        if response_bytes is not None:
+            self.response_bytes.observe((record["callback"],), response_bytes)
+
+
+    #flask hook run before every request: start timing (and profiling) callback requests
+    def start_request(self):
+
+        self.local.request_start = None
+        if not request.path.endswith(npdb_callback_route):
+            return
+
+        self.local.request_start = time.perf_counter()
+        self.local.finished_record = None
+        self.local.profiler = None
+
+        #only one profiler can be active at a time, so concurrent requests go unprofiled
+        if self.profile_slowest > 0 and self.profile_lock.acquire(blocking = False):
+            self.local.profiler = cProfile.Profile()
+            self.local.profiler.enable()
+
+
+    #flask hook run after every request: record the serialization time and size of callback responses
+    def finish_request(self, response):
+
+        if getattr(self.local, "request_start", None) is None:
+            return response
+
+        request_seconds = time.perf_counter() - self.local.request_start
+        self.local.request_start = None
+        record = self.local.finished_record
+        self.local.finished_record = None
+
+        if self.local.profiler is not None:
+            self.local.profiler.disable()
+            if record is not None:
+                self.keep_profile(self.local.profiler, record["callback"], request_seconds)
+            self.local.profiler = None
+            self.profile_lock.release()
+
+        if record is not None:
+            self.observe(record, serialize_seconds = max(request_seconds - record["seconds"], 0.0),
+                         response_bytes = response.calculate_content_length())
+
+        return response
+
+
+    #flask hook run when every request ends: stop a profiler left running by a request that failed before
+    #its response was ready
+    def end_request(self, exception):
+
+        if getattr(self.local, "profiler", None) is not None:
+            self.local.profiler.disable()
+            self.local.profiler = None
+            self.profile_lock.release()
+        self.local.request_start = None
+
+
+    #write the profile of a request when it is among the slowest seen, removing the one it displaces
+    def keep_profile(self, profiler, callback_name, request_seconds):
+
+        if len(self.slowest_profiles) >= self.profile_slowest and request_seconds <= self.slowest_profiles[0][0]:
+            return
+
+        os.makedirs(self.profile_dir, exist_ok = True)
+        profile_path = os.path.join(self.profile_dir, "{}_{:.0f}ms_{}.prof".format(callback_name, request_seconds * 1000, time.time_ns()))
+        profiler.dump_stats(profile_path)
+        heapq.heappush(self.slowest_profiles, (request_seconds, profile_path))
+
+        if len(self.slowest_profiles) > self.profile_slowest:
+            _, displaced_path = heapq.heappop(self.slowest_profiles)
+            with contextlib.suppress(OSError):
+                os.remove(displaced_path)
+
+
+    #the metrics in the prometheus text format
+    def serve_metrics(self):
+
+        exposition_lines = []
+        for histogram in [self.callback_seconds, self.phase_seconds, self.rows_scanned, self.response_bytes]:
+            exposition_lines += histogram.exposition_lines()
+
+        return Response("\n".join(exposition_lines) + "\n", mimetype = "text/plain; version=0.0.4")
+
+
+    #install the request hooks and the metrics route on the flask server of the dashboard
+    def init_app(self, server, route = "/metrics"):
+
+        server.before_request(self.start_request)
+        server.after_request(self.finish_request)
+        server.teardown_request(self.end_request)
+        server.add_url_rule(route, "npdb_metrics", self.serve_metrics)
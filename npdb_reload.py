@@ -0,0 +1,296 @@
+import os
+import time
+import hashlib
+import threading
+import traceback
+
+import pandas as pd
+
+from npdb_ingest import (resolve_npdb_sources, npdb_source_signature, npdb_part_column_names, npdb_cache_paths, npdb_hash_blocksize,
+                         read_npdb_csv, clean_npdb_df, concat_npdb_frames, load_npdb_df, stream_npdb_index, write_npdb_cache,
+                         append_npdb_cache, feather)
+from npdb_index import NpdbIndexBuilder
+from npdb_shared import load_shared_npdb
+from npdb_sql import load_npdb_sql_index
+
+#******************************************************************************
+#SECTION I: DATASETS
+#******************************************************************************
+
+#one version of the npdb data served by the dashboard: the cleaned records (a dataframe, a memory mapped
+#arrow table when attached to a shared snapshot, or neither when streamed), the year index and the
+#structures the dashboard builds from them (bitmap index, precomputed summaries, summary caches, the tag of
+#the data version in api etags); a reload
+#builds a new dataset and swaps it in whole, so a callback that picked up a dataset sees one version of the
+#data until it returns.  while a dataset that only appends records to the current one is being built,
+#previous and appended_df hold the current dataset and the appended records, so the structures built from
+#the records can be extended rather than built again
+class NpdbDataset:
+
+    def __init__(self, npdb_df, npdb_table, npdb_index, load_report, version = 1):
+
+        self.npdb_df = npdb_df
+        self.npdb_table = npdb_table
+        self.index = npdb_index
+        self.load_report = load_report
+        self.version = version
+
+        self.bitmap_index = None
+        self.results = None
+        self.clientside_payload = None
+        self.data_tag = None
+        self.results_signature = None
+
+        self.previous = None
+        self.appended_df = None
+
+
+    #records of the given row numbers, from the dataframe or the memory mapped snapshot
+    def take_records(self, row_numbers):
+
+        if self.npdb_df is not None:
+            return self.npdb_df.take(row_numbers)
+
+        return self.npdb_table.take(row_numbers).to_pandas()
+
+#******************************************************************************
+#SECTION II: INCREMENTAL LOADING
+#******************************************************************************
+
+#content hash of the first n_bytes of a file, to tell a file that grew by appended records (whose first
+#bytes hash the same as the whole file did before) from one that was rewritten
+def hash_npdb_file_prefix(npdb_filepath, n_bytes):
+
+    file_hash = hashlib.sha256()
+
+    with open(npdb_filepath, "rb") as npdb_file:
+        while n_bytes > 0:
+            block = npdb_file.read(min(npdb_hash_blocksize, n_bytes))
+            if not block:
+                break
+            file_hash.update(block)
+            n_bytes -= len(block)
+
+    return file_hash.hexdigest()
+
+
+#whether the byte before offset is the end of a line, i.e. records appended from offset on start on a new line
+def ends_with_newline(npdb_filepath, offset):
+
+    with open(npdb_filepath, "rb") as npdb_file:
+        npdb_file.seek(offset - 1)
+        return npdb_file.read(1) == b"\n"
+
+
+#records of an npdb csv file from byte offset on (the records appended since the file was offset bytes
+#long), read with the column names of its header
+def read_npdb_tail(npdb_filepath, offset, column_names):
+
+    with open(npdb_filepath, "rb") as npdb_file:
+        npdb_file.seek(offset)
+        return read_npdb_csv(npdb_file, column_names)
+
+
+#the files and offsets to read for the records added between two signatures of the source files (with
+#hashes for the old one), as (path, offset) pairs, or None when a file was rewritten or removed, in which
+#case everything is reloaded
+def appended_npdb_parts(old_signature, new_signature):
+
+    old_parts = {part["path"]: part for part in old_signature["parts"]}
+    if (old_signature["cache_version"] != new_signature["cache_version"]) or \
+       (set(old_parts) - {part["path"] for part in new_signature["parts"]}):
+        return None
+
+    appended_parts = []
+
+    for part in new_signature["parts"]:
+        old_part = old_parts.get(part["path"])
+        if old_part is None:
+            appended_parts.append((part["path"], 0))
+        elif (part["size"], part["mtime_ns"]) == (old_part["size"], old_part["mtime_ns"]):
+            continue
+        elif (part["size"] > old_part["size"]) and ends_with_newline(part["path"], old_part["size"]) and \
+             (hash_npdb_file_prefix(part["path"], old_part["size"]) == old_part["sha256"]):
+            appended_parts.append((part["path"], old_part["size"]))
+        else:
+            return None
+
+    return appended_parts
+
+#******************************************************************************
+#SECTION III: BACKGROUND RELOADING
+#******************************************************************************
+
+#watches the npdb csv file(s) from a background thread and loads each new release into a new dataset
+#while the current one keeps serving, then hands it to on_reload to be swapped in
+#
+#the files are polled every poll_seconds by size and modification time, and a change is only loaded once
+#the files have stayed the same over one more poll, so a file still being written is not read half way.
+#records held in memory are reloaded incrementally: when the change only adds files or appends records to
+#the end of files, only the new records are read and cleaned, added to the builder of the year index kept
+#from startup (index_builder, or built by prepare when not given), appended to the records after the
+#current ones and to the feather cache as a file of their own, and handed to build_dataset along with the
+#current dataset (see NpdbDataset); any other change (and shared, streamed or database backed data) is
+#reloaded in full.  a failed reload is reported and retried on the next change, keeping the current data.
+#reloads read the files in the reloading thread rather than in a pool of forked processes, as forking a
+#process that serves requests from other threads is not safe
+class NpdbReloader:
+
+    def __init__(self, npdb_filepath, dataset, build_dataset, on_reload, poll_seconds, distinct_error = None, cache_dir = None,
+                 stream_memory_bytes = None, shared_dir = None, sql_engine = None, sql_path = None, index_builder = None):
+
+        self.npdb_filepath = npdb_filepath
+        self.dataset = dataset
+        self.build_dataset = build_dataset
+        self.on_reload = on_reload
+        self.poll_seconds = poll_seconds
+        self.distinct_error = distinct_error
+        self.cache_dir = cache_dir
+        self.stream_memory_bytes = stream_memory_bytes
+        self.shared_dir = shared_dir
+        self.sql_engine = sql_engine
+        self.sql_path = sql_path
+
+        self.signature = None
+        self.pending_signature = None
+        self.index_builder = index_builder
+        self.thread = None
+
+
+    #start watching from a daemon thread, which first takes the signature of the loaded files and, for
+    #records in memory, the aggregates that appended records are added to
+    def start(self):
+
+        self.thread = threading.Thread(target = self.run, name = "npdb-reloader", daemon = True)
+        self.thread.start()
+
+        return self
+
+
+    #whether the records are held in memory and can be reloaded incrementally
+    def incremental(self):
+
+        return (self.shared_dir is None) and (self.stream_memory_bytes is None) and (self.sql_engine is None)
+
+
+    #signature of the files the current dataset was loaded from, and the accumulated aggregates of its records
+    #when not passed in (a change made to the files while the dashboard was starting is picked up with the
+    #next change)
+    def prepare(self):
+
+        self.signature = npdb_source_signature(resolve_npdb_sources(self.npdb_filepath), with_hash = self.incremental())
+
+        if self.incremental() and (self.index_builder is None):
+            self.index_builder = NpdbIndexBuilder(self.distinct_error, keep_appearances = False).add_chunk(self.dataset.npdb_df)
+
+
+    def run(self):
+
+        while True:
+            try:
+                if self.signature is None:
+                    self.prepare()
+                else:
+                    self.check()
+            except Exception:
+                #keep serving the current data and try again once the files change again; the accumulated
+                #aggregates may hold part of the failed change, so the next reload is a full one
+                print("NPDB reload failed, keeping the data loaded from {}:\n{}".format(self.npdb_filepath, traceback.format_exc()))
+                self.signature = self.pending_signature
+                self.pending_signature = None
+                self.index_builder = None
+
+            time.sleep(self.poll_seconds)
+
+
+    #load the files when they changed and have settled since the last poll
+    def check(self):
+
+        signature = npdb_source_signature(resolve_npdb_sources(self.npdb_filepath), with_hash = False)
+        known_parts = [{key: part[key] for key in ("path", "size", "mtime_ns")} for part in self.signature["parts"]]
+
+        if (signature["parts"] == known_parts) and (signature["cache_version"] == self.signature["cache_version"]):
+            self.pending_signature = None
+            return
+
+        if signature != self.pending_signature:
+            self.pending_signature = signature
+            return
+
+        self.reload()
+
+
+    #load the new release into a new dataset and swap it in
+    def reload(self):
+
+        reload_start = time.perf_counter()
+        new_signature = npdb_source_signature(resolve_npdb_sources(self.npdb_filepath), with_hash = self.incremental())
+
+        npdb_df = npdb_table = bitmap_index = appended_df = None
+        appended_parts = appended_npdb_parts(self.signature, new_signature) if self.index_builder is not None else None
+
+        if appended_parts is not None:
+            npdb_df, npdb_index, appended_df, load_report = self.append_records(appended_parts, new_signature)
+        elif self.shared_dir is not None:
+            npdb_table, npdb_index, bitmap_index, load_report = load_shared_npdb(self.npdb_filepath, self.shared_dir, distinct_error = self.distinct_error,
+                                                                                 cache_dir = self.cache_dir, max_workers = 1,
+                                                                                 stream_memory_bytes = self.stream_memory_bytes)
+        elif self.sql_engine is not None:
+            npdb_index, load_report = load_npdb_sql_index(self.npdb_filepath, self.sql_engine, db_path = self.sql_path, cache_dir = self.cache_dir)
+        elif self.stream_memory_bytes is not None:
+            npdb_index, load_report = stream_npdb_index(self.npdb_filepath, self.stream_memory_bytes, distinct_error = self.distinct_error,
+                                                        spill_dir = self.cache_dir)
+        else:
+            npdb_df, load_report = load_npdb_df(self.npdb_filepath, cache_dir = self.cache_dir, max_workers = 1)
+            self.index_builder = NpdbIndexBuilder(self.distinct_error, keep_appearances = False).add_chunk(npdb_df)
+            npdb_index = self.index_builder.build()
+
+        dataset = NpdbDataset(npdb_df, npdb_table, npdb_index, load_report, version = self.dataset.version + 1)
+        dataset.bitmap_index = bitmap_index
+        if appended_parts is not None:
+            dataset.previous, dataset.appended_df = self.dataset, appended_df
+        dataset = self.build_dataset(dataset)
+        dataset.previous = dataset.appended_df = None
+        self.on_reload(dataset)
+
+        self.dataset = dataset
+        self.signature = new_signature
+        self.pending_signature = None
+
+        print("NPDB data reloaded from {} ({}) in {:.2f}s, serving version {}".format(
+            self.npdb_filepath, "{:,} record(s) appended".format(load_report["appended_rows"]) if load_report["source"] == "append" else "full reload",
+            time.perf_counter() - reload_start, dataset.version))
+
+
+    #read the records appended to the files, add them to the aggregates of the year index and after the
+    #records of the current dataset (which is left as it is), and add them to the feather cache; returns the
+    #records, the year index, the appended records and a load report
+    def append_records(self, appended_parts, new_signature):
+
+        load_start = time.perf_counter()
+        npdb_sources = resolve_npdb_sources(self.npdb_filepath)
+        column_names = dict(zip(npdb_sources, npdb_part_column_names(npdb_sources)))
+
+        appended_frames = [read_npdb_tail(path, offset, column_names[path] or pd.read_csv(path, nrows = 0).columns.tolist())
+                           if offset > 0 else read_npdb_csv(path, column_names[path])
+                           for path, offset in appended_parts]
+        appended_df = clean_npdb_df(pd.concat(appended_frames, ignore_index = True)) if appended_frames else None
+
+        npdb_df = self.dataset.npdb_df
+        if (appended_df is not None) and len(appended_df):
+            self.index_builder.add_chunk(appended_df)
+            npdb_df = concat_npdb_frames([npdb_df, appended_df])
+        npdb_index = self.index_builder.build()
+
+        if feather is not None:
+            cache_paths = npdb_cache_paths(self.npdb_filepath, npdb_sources, self.cache_dir)
+            if not append_npdb_cache(appended_df if appended_df is not None else npdb_df.head(0), self.signature, new_signature, *cache_paths):
+                write_npdb_cache(npdb_df, new_signature, *cache_paths)
+
+        load_report = {"source": "append",
+                       "parts": len(npdb_sources),
+                       "appended_rows": len(appended_df) if appended_df is not None else 0,
+                       "seconds": time.perf_counter() - load_start,
+                       "memory_bytes": int(npdb_df.memory_usage(index = False, deep = True).sum())}
+
+        return npdb_df, npdb_index, appended_df, load_report
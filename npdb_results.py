@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import functools
+
+import numpy as np
+import pandas as pd
+
+from npdb_ingest import resolve_npdb_sources, npdb_source_signature, load_npdb_df, format_load_report
+from npdb_index import NpdbYearIndex
+
+#******************************************************************************
+#SECTION I: RESULT STORE SETTINGS
+#******************************************************************************
+
+#bump whenever the layout of the stored summaries changes so old stores are rebuilt
+npdb_result_store_version = 2
+
+#parts of the year range summary stored for every year range; the state by year table is a slice of a table
+#the year index keeps for every year, so it is cut out on lookup instead of being stored for every range
+npdb_result_parts = ["state", "overall", "ALGNNATR", "OUTCOME"]
+
+#******************************************************************************
+#SECTION II: BUILDING AND LOADING THE STORE
+#******************************************************************************
+
+#the year inputs only take whole years between the first and last year of the data, and every other value
+#is clamped onto one of them, so the summaries of the n * (n + 1) / 2 valid (start, end) year code pairs
+#answer every query; they are kept in a sqlite file next to the data, keyed by year codes, as json holding the
+#columns of each table along with their data types (python's json writes floats with every digit, so the
+#figures read back are the ones computed)
+
+#version of the source files and settings the store is built from; sizes and modification times identify
+#the version of the source files (as for shared snapshots)
+def npdb_result_signature(npdb_filepath, distinct_error = None):
+
+    signature = npdb_source_signature(resolve_npdb_sources(npdb_filepath), with_hash = False)
+    signature["distinct_error"] = distinct_error
+    signature["result_store_version"] = npdb_result_store_version
+
+    return json.dumps(signature, sort_keys = True)
+
+
+#json text of the stored parts of a summary
+def encode_summary(summary):
+
+    encoded_parts = {}
+
+    for part in npdb_result_parts:
+        if isinstance(summary[part], pd.DataFrame):
+            encoded_parts[part] = {"columns": {column: summary[part][column].tolist() for column in summary[part].columns},
+                                   "dtypes": {column: str(dtype) for column, dtype in summary[part].dtypes.items()}}
+        else:
+            encoded_parts[part] = summary[part]
+
+    return json.dumps(encoded_parts)
+
+
+#data type of a stored column from its name; looking the names up in pandas is slow next to decoding a small
+#table, so each name is only looked up once
+@functools.lru_cache(maxsize = None)
+def stored_dtype(dtype_name):
+
+    return pd.api.types.pandas_dtype(dtype_name)
+
+
+#array of the values of a stored column; numpy types are built straight with numpy, which is several times
+#quicker than going through pandas when loading thousands of summaries
+def decode_column(column_values, dtype_name):
+
+    column_dtype = stored_dtype(dtype_name)
+    if isinstance(column_dtype, np.dtype):
+        return np.array(column_values, dtype = column_dtype)
+
+    return pd.array(column_values, dtype = column_dtype)
+
+
+#stored parts of a summary from their json text
+def decode_summary(summary_json):
+
+    summary = {}
+
+    for part, encoded_part in json.loads(summary_json).items():
+        if isinstance(encoded_part, dict) and ("dtypes" in encoded_part):
+            summary[part] = pd.DataFrame({column: decode_column(column_values, encoded_part["dtypes"][column])
+                                          for column, column_values in encoded_part["columns"].items()}, copy = False)
+        else:
+            summary[part] = encoded_part
+
+    return summary
+
+
+#compute the summary of every valid year range and write them to a new store, swapping it in atomically
+def build_result_store(npdb_index, store_path, signature):
+
+    os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok = True)
+    staging_path = "{}.{}.tmp".format(store_path, os.getpid())
+    if os.path.exists(staging_path):
+        os.remove(staging_path)
+
+    with sqlite3.connect(staging_path) as store:
+        store.execute("CREATE TABLE store_info (signature TEXT)")
+        store.execute("CREATE TABLE summaries (start_code INTEGER, end_code INTEGER, summary TEXT, PRIMARY KEY (start_code, end_code))")
+
+        for start_code in range(npdb_index.n_years):
+            start_year = npdb_index.first_year + start_code
+            summary_rows = []
+
+            for end_code in range(start_code, npdb_index.n_years):
+                summary = npdb_index.summarize(start_year, npdb_index.first_year + end_code)
+                summary_rows.append((start_code, end_code, encode_summary(summary)))
+
+            store.executemany("INSERT INTO summaries VALUES (?, ?, ?)", summary_rows)
+
+        store.execute("INSERT INTO store_info VALUES (?)", (signature,))
+
+    store.close()
+    os.replace(staging_path, store_path)
+
+
+#update a store built for previous_signature after records were appended to the source files: the summaries
+#of the ranges ending before first_changed_year cannot have changed, so only the ranges ending in or after it
+#are computed again; previous_results are the summaries of the store before the update.  returns the updated
+#summaries, or None when the store no longer holds previous_signature (rebuilt or updated by another process
+#in the meantime) and must be loaded or rebuilt instead
+def update_result_store(npdb_results, npdb_index, store_path, previous_signature, signature, first_changed_year):
+
+    first_changed_code = max(first_changed_year - npdb_index.first_year, 0)
+    updated_results = {year_codes: summary for year_codes, summary in npdb_results.items() if year_codes[1] < first_changed_code}
+
+    summary_rows = []
+    for start_code in range(npdb_index.n_years):
+        for end_code in range(max(start_code, first_changed_code), npdb_index.n_years):
+            summary = npdb_index.summarize(npdb_index.first_year + start_code, npdb_index.first_year + end_code)
+            summary_rows.append((start_code, end_code, encode_summary(summary)))
+            updated_results[(start_code, end_code)] = {part: summary[part] for part in npdb_result_parts}
+
+    if not os.path.exists(store_path):
+        return None
+
+    #the signature is checked and replaced in the same write transaction, so workers updating the same store
+    #apply the update once
+    store = sqlite3.connect(store_path, isolation_level = None)
+    try:
+        try:
+            store.execute("BEGIN IMMEDIATE")
+            stored_signature = store.execute("SELECT signature FROM store_info").fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        if (stored_signature is None) or (stored_signature[0] not in (previous_signature, signature)):
+            store.execute("ROLLBACK")
+            return None
+
+        if stored_signature[0] == previous_signature:
+            store.execute("DELETE FROM summaries WHERE end_code >= ?", (first_changed_code,))
+            store.executemany("INSERT INTO summaries VALUES (?, ?, ?)", summary_rows)
+            store.execute("UPDATE store_info SET signature = ?", (signature,))
+        store.execute("COMMIT")
+    finally:
+        store.close()
+
+    return updated_results
+
+
+#summaries by (start, end) year code of a store built for the given signature, or None when there is no
+#store, it cannot be read or it was built from another version of the source files
+def load_result_store(store_path, signature):
+
+    if not os.path.exists(store_path):
+        return None
+
+    store = sqlite3.connect(store_path)
+    try:
+        try:
+            stored_signature = store.execute("SELECT signature FROM store_info").fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        if (stored_signature is None) or (stored_signature[0] != signature):
+            return None
+
+        return {(start_code, end_code): decode_summary(summary)
+                for start_code, end_code, summary in store.execute("SELECT start_code, end_code, summary FROM summaries")}
+    finally:
+        store.close()
+
+
+#load every stored summary into memory, rebuilding the store first when it is missing or stale; returns
+#the summaries by year codes and a load report.  after records were appended to the source files, passing
+#the summaries, signature and first year of the store before (previous_results) and the first year of the
+#appended records updates the store in place instead (see update_result_store)
+def warm_result_store(npdb_filepath, npdb_index, store_path, distinct_error = None, previous_results = None, first_changed_year = None):
+
+    warm_start = time.perf_counter()
+    signature = npdb_result_signature(npdb_filepath, distinct_error)
+    store_report = {"store_path": store_path, "built": False, "updated": None, "signature": signature}
+
+    npdb_results = None
+    if (previous_results is not None) and (previous_results[2] == npdb_index.first_year):
+        previous_summaries, previous_signature, _ = previous_results
+        first_changed_year = first_changed_year if first_changed_year is not None else npdb_index.last_year + 1
+        npdb_results = update_result_store(previous_summaries, npdb_index, store_path, previous_signature, signature, first_changed_year)
+        if npdb_results is not None:
+            store_report["updated"] = len(npdb_results) - sum(year_codes[1] < first_changed_year - npdb_index.first_year for year_codes in npdb_results)
+
+    if npdb_results is None:
+        npdb_results = load_result_store(store_path, signature)
+    if npdb_results is None:
+        build_result_store(npdb_index, store_path, signature)
+        npdb_results = load_result_store(store_path, signature)
+        store_report["built"] = True
+
+    store_report["ranges"] = len(npdb_results)
+    store_report["seconds"] = time.perf_counter() - warm_start
+
+    return npdb_results, store_report
+
+
+#one line summary of a result store report for the console
+def format_store_report(store_report):
+
+    if store_report.get("updated") is not None:
+        store_action = "updated ({:,} year ranges recomputed) in".format(store_report["updated"])
+    else:
+        store_action = "built and loaded from" if store_report["built"] else "loaded from"
+
+    return "NPDB result store {} {} ({:,} year ranges) in {:.2f}s".format(store_action, store_report["store_path"], store_report["ranges"], store_report["seconds"])
+
+
+#summary of the records between the starting and ending year, looked up in the stored summaries
+def lookup_summary(npdb_results, npdb_index, start_year, end_year):
+
+    year_codes = npdb_index.year_range_codes(start_year, end_year)
+    if year_codes not in npdb_results:
+        return npdb_index.summarize(start_year, end_year)
+
+    return {"state_year": npdb_index.summarize_state_years(start_year, end_year), **npdb_results[year_codes]}
+
+
+#build the store ahead of starting the dashboard: python npdb_results.py <npdb csv file> <store file>
+#[relative error of approximate counts]
+if __name__ == "__main__":
+
+    distinct_error = float(sys.argv[3]) if len(sys.argv) > 3 else None
+    npdb_df, load_report = load_npdb_df(sys.argv[1])
+    print(format_load_report(load_report))
+
+    build_start = time.perf_counter()
+    npdb_index = NpdbYearIndex(npdb_df, distinct_error = distinct_error)
+    build_result_store(npdb_index, sys.argv[2], npdb_result_signature(sys.argv[1], distinct_error))
+    print("NPDB result store written to {} in {:.2f}s".format(sys.argv[2], time.perf_counter() - build_start))
@@ -0,0 +1,194 @@
+import sys
+
+import pandas as pd
+
+#******************************************************************************
+#SECTION I: COLUMN SCHEMA
+#******************************************************************************
+
+#column layout of the npdb public use data file (see "Variable Layout" in PublicUseDataFile-Format.pdf)
+#each column maps to (cleaned data type, whether the dashboard loads the column at all); integer sizes
+#follow the field lengths in the layout and nullable types are used because most fields are blank for either
+#malpractice payment or adverse action records (see npdb_read_dtypes for the types the columns are read as)
+npdb_schema = {"SEQNO": ("Int32", True), #sequence number, 8 digits
+               "RECTYPE": ("category", True), #record type, payment or adverse action report and format
+               "REPTYPE": ("Int16", False),
+               "ORIGYEAR": ("Int16", True),
+               "WORKSTAT": ("category", True),
+               "WORKCTRY": ("category", False),
+               "HOMESTAT": ("category", False),
+               "HOMECTRY": ("category", False),
+               "LICNSTAT": ("category", False),
+               "LICNFELD": ("Int16", False),
+               "PRACTAGE": ("Int8", False),
+               "GRAD": ("Int16", False),
+               "ALGNNATR": ("Int8", True),
+               "ALEGATN1": ("Int16", False),
+               "ALEGATN2": ("Int16", False),
+               "OUTCOME": ("Int8", True),
+               "MALYEAR1": ("Int16", False),
+               "MALYEAR2": ("Int16", False),
+               "PAYMENT": ("category", False), #dollar amounts coded to range midpoints, cleaned to float
+               "TOTALPMT": ("category", True), #dollar amounts coded to range midpoints, cleaned to float
+               "PAYNUMBR": ("category", False),
+               "NUMBPRSN": ("Int16", False),
+               "PAYTYPE": ("category", False),
+               "PYRRLTNS": ("category", False),
+               "PTAGE": ("Int8", False),
+               "PTGENDER": ("category", False),
+               "PTTYPE": ("category", False),
+               "AAYEAR": ("Int16", False),
+               "AACLASS1": ("Int16", False),
+               "AACLASS2": ("Int16", False),
+               "AACLASS3": ("Int16", False),
+               "AACLASS4": ("Int16", False),
+               "AACLASS5": ("Int16", False),
+               "BASISCD1": ("category", False),
+               "BASISCD2": ("category", False),
+               "BASISCD3": ("category", False),
+               "BASISCD4": ("category", False),
+               "BASISCD5": ("category", False),
+               "AALENTYP": ("category", False),
+               "AALENGTH": ("float64", True), #years and fractions of years
+               "AAEFYEAR": ("Int16", False),
+               "AASIGYR": ("Int16", False),
+               "TYPE": ("Int16", False),
+               "PRACTNUM": ("Int32", True), #practitioner number, 8 digits
+               "ACCRRPTS": ("Int16", False),
+               "NPMALRPT": ("Int16", False),
+               "NPLICRPT": ("Int16", False),
+               "NPCLPRPT": ("Int16", False),
+               "NPPSMRPT": ("Int16", False),
+               "NPDEARPT": ("Int16", False),
+               "NPEXCRPT": ("Int16", False),
+               "NPGARPT": ("Int16", False),
+               "NPCTMRPT": ("Int16", False),
+               "FUNDPYMT": ("Int8", False)}
+
+#columns holding dollar amounts with an embedded $ sign
+npdb_dollar_columns = ["PAYMENT", "TOTALPMT"]
+
+#state codes used by WORKSTAT, HOMESTAT and LICNSTAT
+npdb_state_codes = ["AA", "AE", "AK", "AL", "AP", "AR", "AS", "AZ", "CA", "CO", "CT", "DC", "DE", "FL", "FM", "GA",
+                    "GU", "HI", "IA", "ID", "IL", "IN", "KS", "KY", "LA", "MA", "MD", "ME", "MH", "MI", "MN", "MO",
+                    "MP", "MS", "MT", "NC", "ND", "NE", "NH", "NJ", "NM", "NV", "NY", "OH", "OK", "OR", "PA", "PR",
+                    "PW", "RI", "SC", "SD", "TN", "TX", "UT", "VA", "VI", "VT", "WA", "WI", "WV", "WY"]
+
+#value vocabularies of the coded string columns; codes found in the data but missing here are kept
+npdb_vocabularies = {"RECTYPE": ["A", "C", "M", "P"],
+                     "WORKSTAT": npdb_state_codes,
+                     "HOMESTAT": npdb_state_codes,
+                     "LICNSTAT": npdb_state_codes,
+                     "PAYNUMBR": ["M", "S", "U"],
+                     "PAYTYPE": ["B", "J", "O", "S", "U"],
+                     "PYRRLTNS": ["1", "2", "3", "4", "E", "G", "M", "O", "P", "S"],
+                     "PTGENDER": ["F", "M", "U"],
+                     "PTTYPE": ["B", "I", "O", "U"],
+                     "AALENTYP": ["I", "P", "S"]}
+
+#integer columns present in every record, read and stored as plain numpy types when they have no blanks
+npdb_required_columns = ["SEQNO", "ORIGYEAR", "PRACTNUM"]
+
+#******************************************************************************
+#SECTION II: APPLYING THE SCHEMA
+#******************************************************************************
+
+#names of the columns the dashboard loads
+def npdb_load_columns():
+
+    return [column for column, (_, load) in npdb_schema.items() if load]
+
+
+#read_csv data types for the loaded columns: parsing into nullable integer types is several times slower
+#than into numpy types, so the always present integer columns are read as numpy integers and the other
+#integer columns as float32 (blanks read as NaN), and apply_npdb_schema casts them once to their cleaned
+#type; blank_columns are always present columns read as float64, for files where they are blank after all
+def npdb_read_dtypes(blank_columns = ()):
+
+    read_dtypes = {}
+
+    for column, (dtype, load) in npdb_schema.items():
+        if not load:
+            continue
+        if dtype.startswith("Int") and (column in npdb_required_columns):
+            dtype = "float64" if column in blank_columns else dtype.lower()
+        elif dtype.startswith("Int"):
+            dtype = "float32"
+        read_dtypes[column] = dtype
+
+    return read_dtypes
+
+
+#set the categories of coded columns to their vocabulary plus any unexpected codes, sorted so grouping
+#orders rows the same way as plain strings
+def apply_npdb_categories(npdb_df):
+
+    for column in npdb_df.columns:
+        if npdb_schema.get(column, (None,))[0] != "category" or column in npdb_dollar_columns:
+            continue
+
+        observed_codes = npdb_df[column].astype("category").cat.categories
+        npdb_df[column] = npdb_df[column].astype(pd.CategoricalDtype(sorted(set(npdb_vocabularies.get(column, [])).union(observed_codes))))
+
+    return npdb_df
+
+
+#convert the raw columns to their compact cleaned form
+def apply_npdb_schema(npdb_df):
+
+    #dollar amounts are read as categories so the $ sign is only stripped once per distinct amount
+    for column in npdb_dollar_columns:
+        if column in npdb_df.columns:
+            dollar_amounts = npdb_df[column].astype("category")
+            dollar_amounts = dollar_amounts.cat.rename_categories(dollar_amounts.cat.categories.str.replace("$", "", regex = False))
+            npdb_df[column] = dollar_amounts.astype(float)
+
+    #integer columns are cast once to their cleaned type; always present integer columns read as integers are
+    #stored without the nullable mask, and those read as floats because the file has blanks in them keep it
+    #(whether or not a given chunk of the file has any, so every chunk gets the same type)
+    for column, (dtype, _) in npdb_schema.items():
+        if (column not in npdb_df.columns) or not dtype.startswith("Int"):
+            continue
+        if (column in npdb_required_columns) and pd.api.types.is_integer_dtype(npdb_df[column]) and \
+           not pd.api.types.is_extension_array_dtype(npdb_df[column]):
+            npdb_df[column] = npdb_df[column].to_numpy(dtype = dtype.lower())
+        elif npdb_df[column].dtype != dtype:
+            npdb_df[column] = npdb_df[column].astype(dtype)
+
+    return apply_npdb_categories(npdb_df)
+
+#******************************************************************************
+#SECTION III: MEMORY FOOTPRINT REPORT
+#******************************************************************************
+
+#resident size of each column before and after applying the schema, in megabytes
+def npdb_memory_report(before_df, after_df):
+
+    before_bytes = before_df.memory_usage(index = False, deep = True)
+    after_bytes = after_df.memory_usage(index = False, deep = True).reindex(before_bytes.index).fillna(0)
+
+    memory_df = pd.DataFrame({"BEFORE_DTYPE": before_df.dtypes.astype(str),
+                              "AFTER_DTYPE": after_df.dtypes.astype(str).reindex(before_bytes.index).fillna("(not loaded)"),
+                              "BEFORE_MB": before_bytes / 1024 ** 2,
+                              "AFTER_MB": after_bytes / 1024 ** 2})
+    memory_df.loc["TOTAL"] = ["", "", memory_df["BEFORE_MB"].sum(), memory_df["AFTER_MB"].sum()]
+    memory_df["RATIO"] = memory_df["BEFORE_MB"] / memory_df["AFTER_MB"].where(memory_df["AFTER_MB"] > 0)
+
+    return memory_df.round(3)
+
+
+#print the memory footprint report for an input file: python npdb_schema.py <npdb csv file>
+if __name__ == "__main__":
+
+    from npdb_ingest import read_npdb_csv, clean_npdb_df
+
+    #before: data types inferred by read_csv, with the dashboard's original cleaning steps
+    before_df = pd.read_csv(sys.argv[1], low_memory = False)
+    before_df["TOTALPMT"] = before_df["TOTALPMT"].str.replace("$", "", regex = False).astype(float)
+    before_df["ORIGYEAR"] = before_df["ORIGYEAR"].astype(int)
+
+    #after: schema driven read
+    after_df = clean_npdb_df(read_npdb_csv(sys.argv[1]))
+
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(npdb_memory_report(before_df, after_df))
@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+from npdb_ingest import resolve_npdb_sources, npdb_source_signature, load_npdb_df, stream_npdb_index
+from npdb_index import NpdbYearIndex
+from npdb_bitmaps import NpdbBitmapIndex
+
+#pyarrow holds the records of a snapshot; without it snapshots only hold the year index
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+#file locks keep several workers starting at once from building the same snapshot; without fcntl (windows)
+#each of them builds it and the first one to finish wins
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#******************************************************************************
+#SECTION I: SNAPSHOT SETTINGS
+#******************************************************************************
+
+#bump whenever the layout of the snapshot files changes so old snapshots are rebuilt
+npdb_snapshot_version = 3
+
+#names of the files inside a snapshot directory: the records, the settings of the year index (whose arrays
+#sit next to it), the directory of the bitmap index (with settings of the same name) and the signature of
+#the source files
+npdb_snapshot_records = "records.arrow"
+npdb_snapshot_settings = "index.json"
+npdb_snapshot_bitmaps = "bitmaps"
+npdb_snapshot_signature = "signature.json"
+
+#******************************************************************************
+#SECTION II: WRITING AND ATTACHING SNAPSHOTS
+#******************************************************************************
+
+#a snapshot is a directory holding the cleaned records as an uncompressed arrow file and the arrays of the
+#year index and of the bitmap index of the cross filters as .npy files; all of them are memory mapped when
+#attached, so every process serving the dashboard shares one copy through the page cache and attaching costs
+#no more than opening the files
+
+#sizes and modification times of the source files, with the settings a snapshot depends on
+def npdb_snapshot_source_signature(npdb_filepath, distinct_error = None):
+
+    signature = npdb_source_signature(resolve_npdb_sources(npdb_filepath), with_hash = False)
+    signature["distinct_error"] = distinct_error
+    signature["snapshot_version"] = npdb_snapshot_version
+
+    return signature
+
+
+#directory of the snapshot of the current version of the source files under snapshot_root; sizes and
+#modification times identify the version, so workers can find the snapshot without reading the sources
+def npdb_snapshot_path(npdb_filepath, snapshot_root, distinct_error = None, signature = None):
+
+    signature = signature or npdb_snapshot_source_signature(npdb_filepath, distinct_error)
+    snapshot_hash = hashlib.sha256(json.dumps(signature, sort_keys = True).encode("utf-8")).hexdigest()[:16]
+
+    return os.path.join(snapshot_root, "npdb_snapshot_" + snapshot_hash)
+
+
+#write the arrays of an index as .npy files into a directory, next to its settings naming them
+def write_snapshot_arrays(array_dir, index_arrays, index_settings):
+
+    os.makedirs(array_dir, exist_ok = True)
+    index_settings["arrays"] = sorted(index_arrays)
+    for array_name, index_array in index_arrays.items():
+        np.save(os.path.join(array_dir, array_name + ".npy"), np.ascontiguousarray(index_array), allow_pickle = False)
+
+    with open(os.path.join(array_dir, npdb_snapshot_settings), "w") as settings_file:
+        json.dump(index_settings, settings_file)
+
+
+#memory map the arrays written by write_snapshot_arrays, returning them along with the settings
+def read_snapshot_arrays(array_dir):
+
+    with open(os.path.join(array_dir, npdb_snapshot_settings)) as settings_file:
+        index_settings = json.load(settings_file)
+
+    index_arrays = {array_name: np.load(os.path.join(array_dir, array_name + ".npy"), mmap_mode = "r", allow_pickle = False)
+                    for array_name in index_settings.pop("arrays")}
+
+    return index_arrays, index_settings
+
+
+#write a snapshot of the records (None when they were streamed), the year index and the bitmap index of the
+#records (None without records), along with the signature of the source files it was built from, swapping the
+#whole directory in atomically
+def write_npdb_snapshot(npdb_df, npdb_index, snapshot_path, bitmap_index = None, signature = None):
+
+    snapshot_root = os.path.dirname(snapshot_path)
+    os.makedirs(snapshot_root, exist_ok = True)
+    staging_path = tempfile.mkdtemp(prefix = ".staging_", dir = snapshot_root)
+
+    if (npdb_df is not None) and (feather is not None):
+        #arrow ipc files without compression can be memory mapped and read without copying
+        feather.write_feather(npdb_df.reset_index(drop = True), os.path.join(staging_path, npdb_snapshot_records), compression = "uncompressed")
+
+    write_snapshot_arrays(staging_path, *npdb_index.to_arrays())
+    if bitmap_index is not None:
+        write_snapshot_arrays(os.path.join(staging_path, npdb_snapshot_bitmaps), *bitmap_index.to_arrays())
+
+    if signature is not None:
+        with open(os.path.join(staging_path, npdb_snapshot_signature), "w") as signature_file:
+            json.dump(signature, signature_file)
+
+    try:
+        os.rename(staging_path, snapshot_path)
+    except OSError:
+        #another process published the same snapshot first
+        shutil.rmtree(staging_path, ignore_errors = True)
+
+
+#memory map the records (None when the snapshot has none), year index and bitmap index (None when the
+#snapshot has none) of a snapshot
+def attach_npdb_snapshot(snapshot_path):
+
+    npdb_index = NpdbYearIndex.from_arrays(*read_snapshot_arrays(snapshot_path))
+
+    bitmaps_path = os.path.join(snapshot_path, npdb_snapshot_bitmaps)
+    bitmap_index = NpdbBitmapIndex.from_arrays(*read_snapshot_arrays(bitmaps_path)) if os.path.isdir(bitmaps_path) else None
+
+    records_path = os.path.join(snapshot_path, npdb_snapshot_records)
+    npdb_table = feather.read_table(records_path, memory_map = True) if (feather is not None) and os.path.exists(records_path) else None
+
+    return npdb_table, npdb_index, bitmap_index
+
+
+#latest modification time of the source files a snapshot was built from, or None for snapshots without a
+#readable signature (written by an earlier snapshot version)
+def snapshot_source_mtime(snapshot_path):
+
+    try:
+        with open(os.path.join(snapshot_path, npdb_snapshot_signature)) as signature_file:
+            return max(part["mtime_ns"] for part in json.load(signature_file)["parts"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+#remove the snapshots of older versions of the source files than the one of snapshot_path; snapshots of the
+#same or newer files (e.g. published by a worker that already saw a later release) are kept.  called under
+#the snapshot lock; processes still attached to the removed snapshots keep their mapped pages until they exit
+def remove_stale_snapshots(snapshot_path):
+
+    snapshot_root = os.path.dirname(snapshot_path)
+    source_mtime = snapshot_source_mtime(snapshot_path)
+
+    for snapshot_name in os.listdir(snapshot_root):
+        other_path = os.path.join(snapshot_root, snapshot_name)
+        if (not snapshot_name.startswith("npdb_snapshot_")) or (other_path == snapshot_path):
+            continue
+
+        other_mtime = snapshot_source_mtime(other_path)
+        if (other_mtime is None) or ((source_mtime is not None) and (other_mtime < source_mtime)):
+            shutil.rmtree(other_path, ignore_errors = True)
+
+#******************************************************************************
+#SECTION III: SHARED LOADING
+#******************************************************************************
+
+#attach to the snapshot of the npdb csv file(s) under snapshot_root, building it first when there is none
+#for the current version of the files (loading through the feather cache, or streaming when a memory
+#budget is given); returns the memory mapped records (an arrow table, or None when streamed), the year
+#index, the bitmap index of the cross filters (None when streamed) and a load report
+def load_shared_npdb(npdb_filepath, snapshot_root, distinct_error = None, cache_dir = None, max_workers = None, stream_memory_bytes = None):
+
+    load_start = time.perf_counter()
+    signature = npdb_snapshot_source_signature(npdb_filepath, distinct_error)
+    snapshot_path = npdb_snapshot_path(npdb_filepath, snapshot_root, signature = signature)
+    load_report = {"source": "snapshot", "snapshot_path": snapshot_path, "built": False}
+
+    if not os.path.exists(snapshot_path):
+        os.makedirs(snapshot_root, exist_ok = True)
+
+        with open(os.path.join(snapshot_root, ".lock"), "w") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            #the snapshot may have been built while waiting for the lock
+            if not os.path.exists(snapshot_path):
+                if stream_memory_bytes is not None:
+                    npdb_df = bitmap_index = None
+                    npdb_index, _ = stream_npdb_index(npdb_filepath, stream_memory_bytes, distinct_error = distinct_error, spill_dir = cache_dir)
+                else:
+                    npdb_df, _ = load_npdb_df(npdb_filepath, cache_dir = cache_dir, max_workers = max_workers)
+                    npdb_index = NpdbYearIndex(npdb_df, distinct_error = distinct_error)
+                    bitmap_index = NpdbBitmapIndex(npdb_df)
+
+                write_npdb_snapshot(npdb_df, npdb_index, snapshot_path, bitmap_index = bitmap_index, signature = signature)
+                remove_stale_snapshots(snapshot_path)
+                load_report["built"] = True
+                del npdb_df, npdb_index, bitmap_index
+
+    npdb_table, npdb_index, bitmap_index = attach_npdb_snapshot(snapshot_path)
+    load_report["seconds"] = time.perf_counter() - load_start
+
+    return npdb_table, npdb_index, bitmap_index, load_report
+
+
+#one line summary of a shared load report for the console
+def format_shared_report(load_report):
+
+    return "NPDB snapshot {} {} in {:.3f}s".format("built and attached from" if load_report["built"] else "attached from",
+                                                   load_report["snapshot_path"], load_report["seconds"])
+
+
+#build the snapshot ahead of starting the workers: python npdb_shared.py <npdb csv file> <snapshot directory>
+#[relative error of approximate counts]
+if __name__ == "__main__":
+
+    _, _, _, shared_report = load_shared_npdb(sys.argv[1], sys.argv[2], distinct_error = float(sys.argv[3]) if len(sys.argv) > 3 else None)
+    print(format_shared_report(shared_report))
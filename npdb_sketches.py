@@ -0,0 +1,80 @@
+import math
+
+import numpy as np
+
+#******************************************************************************
+#SECTION I: HASHING
+#******************************************************************************
+
+#64-bit mix of integer ids (splitmix64 finalizer); uint64 arithmetic wraps around as intended
+def hash_ids(id_values):
+
+    hashed = np.asarray(id_values).astype(np.uint64)
+
+    with np.errstate(over = "ignore"):
+        hashed = hashed + np.uint64(0x9E3779B97F4A7C15)
+        hashed = (hashed ^ (hashed >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        hashed = (hashed ^ (hashed >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        hashed = hashed ^ (hashed >> np.uint64(31))
+
+    return hashed
+
+
+#number of bits needed to write each value (0 for 0), exact for the full uint64 range
+def bit_length(values):
+
+    high_bits = (values >> np.uint64(32)).astype(np.float64)
+    low_bits = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+
+    return np.where(high_bits > 0, np.frexp(high_bits)[1] + 32, np.frexp(low_bits)[1])
+
+#******************************************************************************
+#SECTION II: HYPERLOGLOG DISTINCT COUNTS
+#******************************************************************************
+
+#register index bits giving a relative standard error of about error (1.04 / sqrt(2 ** precision))
+def hll_precision(relative_error):
+
+    return min(max(math.ceil(math.log2((1.04 / relative_error) ** 2)), 4), 16)
+
+
+#relative standard error of a sketch with the given precision
+def hll_relative_error(precision):
+
+    return 1.04 / math.sqrt(2 ** precision)
+
+
+#register picked by each id and the value it offers that register: the leading bits of the hash pick the
+#register, the position of the first set bit in the remaining bits is the value
+def hll_register_ranks(id_values, precision):
+
+    hashed = hash_ids(np.asarray(id_values, dtype = np.int64))
+
+    register_codes = (hashed >> np.uint64(64 - precision)).astype(np.int64)
+    remaining_bits = hashed & np.uint64((1 << (64 - precision)) - 1)
+    ranks = (64 - precision - bit_length(remaining_bits) + 1).astype(np.uint8)
+
+    return register_codes, ranks
+
+
+#distinct count estimates from (merged) registers, one per leading index
+def hll_estimate(registers):
+
+    n_registers = registers.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / n_registers) if n_registers >= 128 else {16: 0.673, 32: 0.697, 64: 0.709}[n_registers]
+
+    raw_estimates = alpha * n_registers ** 2 / np.power(2.0, -registers.astype(np.float64)).sum(axis = -1)
+
+    #linear counting for small cardinalities
+    empty_registers = (registers == 0).sum(axis = -1)
+    with np.errstate(divide = "ignore"):
+        linear_estimates = n_registers * np.log(n_registers / np.maximum(empty_registers, 1))
+
+    return np.where((raw_estimates <= 2.5 * n_registers) & (empty_registers > 0), linear_estimates, raw_estimates)
+
+
+#estimated distinct counts per group over year codes s..e from (group, year, register) registers; the
+#registers of several years are merged by taking their maximum
+def query_hll_registers(registers, start_code, end_code):
+
+    return np.rint(hll_estimate(registers[:, start_code:end_code + 1].max(axis = 1))).astype(np.int64)
@@ -0,0 +1,403 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import contextlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from npdb_ingest import (resolve_npdb_sources, npdb_source_signature, npdb_part_column_names, npdb_cache_paths, npdb_stream_plan,
+                         read_npdb_csv_chunks, clean_npdb_df, NpdbLoadMemory)
+from npdb_index import NpdbYearIndex, RangeQuantiles, year_prefix, npdb_group_columns, npdb_distinct_keys, npdb_quantile_keys, npdb_sum_keys
+
+#duckdb is an optional engine; without it only the sqlite engine of the standard library is available
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+#******************************************************************************
+#SECTION I: SQL BACKEND SETTINGS
+#******************************************************************************
+
+#bump whenever the layout of the database changes so old databases are rebuilt
+npdb_sql_version = 1
+
+#embedded engines the records can be kept in
+npdb_sql_engines = ["sqlite", "duckdb"]
+
+#columns of the records table and their sql types; only the columns the summaries need are kept
+npdb_sql_columns = {"ORIGYEAR": "INTEGER",
+                    "WORKSTAT": "VARCHAR",
+                    "ALGNNATR": "INTEGER",
+                    "OUTCOME": "INTEGER",
+                    "RECTYPE": "VARCHAR",
+                    "SEQNO": "BIGINT",
+                    "PRACTNUM": "BIGINT",
+                    "TOTALPMT": "DOUBLE",
+                    "AALENGTH": "DOUBLE"}
+
+#memory budget of the chunks the csv file(s) are read in while building the database
+npdb_sql_build_memory_bytes = 256 * 1024 ** 2
+
+#largest share of the records a sqlite query seeks through the year index; wider year ranges are quicker to
+#answer by scanning the table
+npdb_sql_index_share = 0.25
+
+#******************************************************************************
+#SECTION II: BUILDING THE DATABASE
+#******************************************************************************
+
+#connection to a database file of the given engine
+def connect_npdb_sql(engine, db_path, read_only = False):
+
+    if engine == "duckdb":
+        if duckdb is None:
+            raise ImportError("the duckdb engine needs the duckdb package")
+        return duckdb.connect(db_path, read_only = read_only)
+
+    if read_only:
+        return sqlite3.connect("file:{}?mode=ro".format(db_path), uri = True, check_same_thread = False)
+
+    return sqlite3.connect(db_path)
+
+
+#version of the source files and settings the database is built from; sizes and modification times identify
+#the version of the source files (as for shared snapshots and result stores)
+def npdb_sql_signature(npdb_filepath, engine):
+
+    signature = npdb_source_signature(resolve_npdb_sources(npdb_filepath), with_hash = False)
+    signature["engine"] = engine
+    signature["sql_version"] = npdb_sql_version
+
+    return json.dumps(signature, sort_keys = True)
+
+
+#default location of the database: next to the feather cache of the input file(s)
+def npdb_database_path(npdb_filepath, engine, cache_dir = None):
+
+    cache_filepath, _ = npdb_cache_paths(npdb_filepath, resolve_npdb_sources(npdb_filepath), cache_dir)
+
+    return os.path.splitext(cache_filepath)[0] + "." + engine
+
+
+#add a chunk of cleaned records to the records table
+def insert_npdb_records(connection, engine, records_df):
+
+    records_df = records_df[list(npdb_sql_columns)]
+
+    if engine == "duckdb":
+        connection.register("npdb_chunk", records_df)
+        connection.execute("INSERT INTO npdb SELECT * FROM npdb_chunk")
+        connection.unregister("npdb_chunk")
+    else:
+        record_values = records_df.astype(object).where(records_df.notna(), None)
+        connection.executemany("INSERT INTO npdb VALUES ({})".format(", ".join("?" * len(npdb_sql_columns))),
+                               record_values.itertuples(index = False, name = None))
+
+
+#read the csv file(s) in chunks into a new database of the given engine, swapping it in atomically; the
+#records are never all held in memory.  the types of the group labels (which the year index takes from the
+#cleaned records) are kept with the signature, so the labels read back from the database match them
+def build_npdb_database(npdb_filepath, engine, db_path, signature, memory_budget_bytes = npdb_sql_build_memory_bytes):
+
+    npdb_sources = resolve_npdb_sources(npdb_filepath)
+    chunk_rows, _ = npdb_stream_plan(npdb_sources, memory_budget_bytes)
+
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok = True)
+    staging_path = "{}.{}.tmp".format(db_path, os.getpid())
+    if os.path.exists(staging_path):
+        os.remove(staging_path)
+
+    connection = connect_npdb_sql(engine, staging_path)
+    label_dtypes = {"ALL": "object"}
+    n_rows = 0
+
+    try:
+        connection.execute("CREATE TABLE store_info (signature VARCHAR, settings VARCHAR)")
+        connection.execute("CREATE TABLE npdb ({})".format(", ".join("{} {}".format(column, sql_type) for column, sql_type in npdb_sql_columns.items())))
+
+        for source, column_names in zip(npdb_sources, npdb_part_column_names(npdb_sources)):
+            for npdb_chunk in read_npdb_csv_chunks(source, chunk_rows, column_names):
+                records_df = clean_npdb_df(npdb_chunk)
+                del npdb_chunk
+                for group_column in npdb_group_columns[1:]:
+                    label_dtypes[group_column] = str(np.asarray(pd.factorize(records_df[group_column])[1]).dtype)
+                insert_npdb_records(connection, engine, records_df)
+                n_rows += len(records_df)
+
+        #duckdb skips blocks by their min/max statistics, sqlite needs an index to seek to a year range
+        if engine == "sqlite":
+            connection.execute("CREATE INDEX npdb_year ON npdb (ORIGYEAR)")
+        connection.execute("INSERT INTO store_info VALUES (?, ?)", (signature, json.dumps({"label_dtypes": label_dtypes, "rows": n_rows})))
+        connection.commit()
+        connection.close()
+    except BaseException:
+        #leave no half built database behind
+        connection.close()
+        os.remove(staging_path)
+        raise
+
+    os.replace(staging_path, db_path)
+
+
+#settings stored with a database built for the given signature, or None when there is no database, it
+#cannot be read or it was built from another version of the source files
+def read_npdb_database_settings(engine, db_path, signature):
+
+    if not os.path.exists(db_path):
+        return None
+
+    try:
+        connection = connect_npdb_sql(engine, db_path, read_only = True)
+    except Exception:
+        return None
+
+    try:
+        stored_info = connection.execute("SELECT signature, settings FROM store_info").fetchone()
+    except Exception:
+        return None
+    finally:
+        connection.close()
+
+    if (stored_info is None) or (stored_info[0] != signature):
+        return None
+
+    return json.loads(stored_info[1])
+
+#******************************************************************************
+#SECTION III: SQL YEAR INDEX
+#******************************************************************************
+
+#year index answering the dashboard's summaries from records kept in an embedded database file instead of in
+#memory, so the data is not limited by memory.  the additive aggregates (record counts and payment totals per
+#group and year) are read into prefix sums when the index is opened, and the distinct counts, medians and
+#percentiles of a year range are queried from the database: a summary issues its nine queries side by side on
+#max_workers threads (each with its own connection; both engines release the gil while a query runs), and
+#the summaries are then put together by the code of NpdbYearIndex, so they are the same as in memory.
+#distinct counts are always exact
+class NpdbSqlIndex(NpdbYearIndex):
+
+    def __init__(self, engine, db_path, settings, max_workers = None):
+
+        self.engine = engine
+        self.db_path = db_path
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers = max_workers or min(len(npdb_distinct_keys) + len(npdb_quantile_keys), os.cpu_count() or 1),
+                                           thread_name_prefix = "npdb-sql")
+        #duckdb shares one database between the cursors of every thread
+        self.database = connect_npdb_sql(engine, db_path, read_only = True) if engine == "duckdb" else None
+
+        self.approximate_counts = False
+        self.distinct_error = 0.0
+
+        first_year, last_year = self.query("SELECT MIN(ORIGYEAR), MAX(ORIGYEAR) FROM npdb")[0]
+        self.first_year, self.last_year = (int(first_year), int(last_year)) if first_year is not None else (0, -1)
+        self.n_years = self.last_year - self.first_year + 1
+
+        #group codes follow the sorted group labels, as in the year index
+        label_dtypes = settings["label_dtypes"]
+        self.group_labels = {"ALL": np.array(["ALL"] if self.n_years > 0 else [], dtype = object)}
+        for group_column in npdb_group_columns[1:]:
+            group_labels = sorted(label for (label,) in self.query("SELECT DISTINCT {0} FROM npdb WHERE {0} IS NOT NULL".format(group_column)))
+            self.group_labels[group_column] = np.array(group_labels, dtype = label_dtypes.get(group_column, "object"))
+        self.label_codes = {group_column: {label: group_code for group_code, label in enumerate(group_labels.tolist())}
+                            for group_column, group_labels in self.group_labels.items()}
+
+        self.row_count_prefix = {group_column: year_prefix(self.query_group_years(group_column, "COUNT(*)", np.int64))
+                                 for group_column in npdb_group_columns}
+        self.sum_prefix = {(group_column, value_column): year_prefix(self.query_group_years(group_column, "SUM({})".format(value_column), np.float64))
+                           for group_column, value_column in npdb_sum_keys}
+
+        self.state_year_df = self.build_state_year_df()
+
+
+    #connection of the running thread
+    def connection(self):
+
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.database.cursor() if self.database is not None else connect_npdb_sql(self.engine, self.db_path, read_only = True)
+
+        return connection
+
+
+    #rows of a query
+    def query(self, sql, parameters = ()):
+
+        return self.connection().execute(sql, parameters).fetchall()
+
+
+    #sql expression of the group of a group column, and the condition leaving out blank groups
+    def group_sql(self, group_column):
+
+        if group_column == "ALL":
+            return "'ALL'", "TRUE"
+
+        return group_column, "{} IS NOT NULL".format(group_column)
+
+
+    #groups x years array of an aggregate over the records of every group and year
+    def query_group_years(self, group_column, aggregate_sql, dtype):
+
+        group_sql, group_condition = self.group_sql(group_column)
+        group_years = np.zeros((len(self.group_labels[group_column]), max(self.n_years, 1)), dtype = dtype)
+
+        for label, year, value in self.query("SELECT {0}, ORIGYEAR, {1} FROM npdb WHERE {2} GROUP BY {0}, ORIGYEAR".format(group_sql, aggregate_sql, group_condition)):
+            group_years[self.label_codes[group_column][label], int(year) - self.first_year] = value if value is not None else 0
+
+        return group_years
+
+
+    #table the records of year codes s..e are read from
+    def records_sql(self, start_code, end_code):
+
+        if (self.engine == "sqlite") and (self.row_counts("ALL", (start_code, end_code))[0] > npdb_sql_index_share * self.row_counts("ALL", (0, self.n_years - 1))[0]):
+            return "npdb NOT INDEXED"
+
+        return "npdb"
+
+
+    #number of distinct ids per group over year codes s..e
+    def query_distinct_counts(self, group_column, id_column, start_code, end_code):
+
+        group_sql, group_condition = self.group_sql(group_column)
+        distinct_counts = np.zeros(len(self.group_labels[group_column]), dtype = np.int64)
+
+        for label, distinct_count in self.query("SELECT {0}, COUNT(DISTINCT {1}) FROM {3} WHERE ORIGYEAR BETWEEN ? AND ? AND {2} AND {1} IS NOT NULL "
+                                                "GROUP BY {0}".format(group_sql, id_column, group_condition, self.records_sql(start_code, end_code)),
+                                                (self.first_year + start_code, self.first_year + end_code)):
+            distinct_counts[self.label_codes[group_column][label]] = distinct_count
+
+        return distinct_counts
+
+
+    #medians and percentiles per group over year codes s..e, from the number of records with each value of
+    #each group; the values are combined by the same code as the year index
+    def query_quantiles(self, group_column, value_column, start_code, end_code):
+
+        group_sql, group_condition = self.group_sql(group_column)
+        value_counts = self.query("SELECT {0}, {1}, COUNT(*) FROM {3} WHERE ORIGYEAR BETWEEN ? AND ? AND {2} AND {1} IS NOT NULL "
+                                  "GROUP BY {0}, {1}".format(group_sql, value_column, group_condition, self.records_sql(start_code, end_code)),
+                                  (self.first_year + start_code, self.first_year + end_code))
+
+        group_codes = np.array([self.label_codes[group_column][label] for label, _, _ in value_counts], dtype = np.int64)
+        values = np.array([value for _, value, _ in value_counts], dtype = np.float64)
+        counts = np.array([count for _, _, count in value_counts], dtype = np.int64)
+
+        return RangeQuantiles(group_codes, np.zeros(len(group_codes), dtype = np.int64), values, counts, len(self.group_labels[group_column]), 1)
+
+
+    #result of a query of the running summary when it was issued ahead, or of the query run now
+    def fetch(self, query_function, *query_arguments):
+
+        prefetched = getattr(self.local, "prefetched", None)
+        if (prefetched is not None) and ((query_function.__name__,) + query_arguments in prefetched):
+            return prefetched[(query_function.__name__,) + query_arguments]
+
+        return query_function(*query_arguments)
+
+
+    #issue the distinct count and quantile queries of a year range side by side, and answer the queries of the
+    #block from their results
+    @contextlib.contextmanager
+    def prefetch(self, year_codes, distinct_keys = npdb_distinct_keys, quantile_keys = npdb_quantile_keys):
+
+        if (year_codes is None) or (getattr(self.local, "prefetched", None) is not None):
+            yield
+            return
+
+        futures = {("query_distinct_counts", group_column, id_column) + tuple(year_codes): self.executor.submit(self.query_distinct_counts, group_column, id_column, *year_codes)
+                   for group_column, id_column in distinct_keys}
+        futures.update({("query_quantiles", group_column, value_column) + tuple(year_codes): self.executor.submit(self.query_quantiles, group_column, value_column, *year_codes)
+                        for group_column, value_column in quantile_keys})
+
+        self.local.prefetched = {query_key: future.result() for query_key, future in futures.items()}
+        try:
+            yield
+        finally:
+            self.local.prefetched = None
+
+
+    def distinct_counts(self, group_column, id_column, year_codes):
+
+        return self.fetch(self.query_distinct_counts, group_column, id_column, *year_codes)
+
+
+    def group_medians(self, group_column, value_column, year_codes):
+
+        return self.fetch(self.query_quantiles, group_column, value_column, *year_codes).median(0, 0)
+
+
+    def group_percentiles(self, group_column, value_column, year_codes, percentiles):
+
+        return self.fetch(self.query_quantiles, group_column, value_column, *year_codes).percentiles(0, 0, percentiles).T
+
+
+    #the state summary of a year range (and of each year of the state by year table), with its queries issued
+    #side by side unless the summary it is part of issued them already
+    def summarize_states(self, start_year, end_year):
+
+        with self.prefetch(self.year_range_codes(start_year, end_year),
+                           distinct_keys = [key for key in npdb_distinct_keys if key[0] == "WORKSTAT"],
+                           quantile_keys = [key for key in npdb_quantile_keys if key[0] == "WORKSTAT"]):
+            return super().summarize_states(start_year, end_year)
+
+
+    def summarize(self, start_year, end_year):
+
+        with self.prefetch(self.year_range_codes(start_year, end_year)):
+            return super().summarize(start_year, end_year)
+
+#******************************************************************************
+#SECTION IV: LOADING
+#******************************************************************************
+
+#open the database of the npdb csv file(s), building it first when it is missing or the input files changed;
+#returns the index along with a load report
+def load_npdb_sql_index(npdb_filepath, engine, db_path = None, cache_dir = None, max_workers = None):
+
+    if engine not in npdb_sql_engines:
+        raise ValueError("unknown sql engine {} (engines: {})".format(engine, ", ".join(npdb_sql_engines)))
+
+    load_start = time.perf_counter()
+    load_memory = NpdbLoadMemory()
+    db_path = db_path or npdb_database_path(npdb_filepath, engine, cache_dir)
+    signature = npdb_sql_signature(npdb_filepath, engine)
+    load_report = {"source": "sql", "engine": engine, "db_path": db_path, "built": False}
+
+    settings = read_npdb_database_settings(engine, db_path, signature)
+    if settings is None:
+        build_npdb_database(npdb_filepath, engine, db_path, signature)
+        settings = read_npdb_database_settings(engine, db_path, signature)
+        load_report["built"] = True
+
+    npdb_index = NpdbSqlIndex(engine, db_path, settings, max_workers = max_workers)
+
+    load_report["parts"] = len(resolve_npdb_sources(npdb_filepath))
+    load_report["rows"] = settings["rows"]
+    load_report["load_memory_bytes"] = load_memory.finish()
+    load_report["seconds"] = time.perf_counter() - load_start
+
+    return npdb_index, load_report
+
+
+#one line summary of a load report for the console
+def format_sql_report(load_report):
+
+    return "NPDB {} database {} {} ({:,} records) in {:.2f}s".format(load_report["engine"], "built and opened from" if load_report["built"] else "opened from",
+                                                                     load_report["db_path"], load_report["rows"], load_report["seconds"])
+
+
+#build the database ahead of starting the dashboard: python npdb_sql.py <npdb csv file> <database file> [sqlite|duckdb]
+if __name__ == "__main__":
+
+    engine = sys.argv[3] if len(sys.argv) > 3 else "sqlite"
+    build_start = time.perf_counter()
+    build_npdb_database(sys.argv[1], engine, sys.argv[2], npdb_sql_signature(sys.argv[1], engine))
+    print("NPDB {} database written to {} in {:.2f}s".format(engine, sys.argv[2], time.perf_counter() - build_start))
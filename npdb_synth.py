@@ -0,0 +1,217 @@
+import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from npdb_schema import npdb_schema
+
+#******************************************************************************
+#SECTION I: GENERATOR SETTINGS
+#******************************************************************************
+
+#years covered by the synthetic records (see ORIGYEAR in PublicUseDataFile-Format.pdf)
+npdb_synth_first_year = 1990
+npdb_synth_last_year = 2020
+
+#records generated at a time; each chunk has its own random stream, so the output does not depend on how
+#the chunks are split into partition files or spread across processes
+npdb_synth_chunk_rows = 1000000
+
+#share of records that are malpractice payments (the rest are adverse actions)
+npdb_synth_payment_share = 0.4
+
+#average number of records per practitioner
+npdb_synth_records_per_practitioner = 3
+
+#relative weight of each work state, roughly following population; a small share of records has no state
+npdb_synth_state_weights = {"CA": 39.5, "TX": 29.1, "FL": 21.5, "NY": 20.2, "PA": 13.0, "IL": 12.8, "OH": 11.8, "GA": 10.7,
+                            "NC": 10.4, "MI": 10.1, "NJ": 9.3, "VA": 8.6, "WA": 7.7, "AZ": 7.2, "MA": 7.0, "TN": 6.9,
+                            "IN": 6.8, "MD": 6.2, "MO": 6.2, "WI": 5.9, "CO": 5.8, "MN": 5.7, "SC": 5.1, "AL": 5.0,
+                            "LA": 4.7, "KY": 4.5, "OR": 4.2, "OK": 4.0, "CT": 3.6, "UT": 3.3, "PR": 3.3, "IA": 3.2,
+                            "NV": 3.1, "AR": 3.0, "MS": 3.0, "KS": 2.9, "NM": 2.1, "NE": 2.0, "ID": 1.8, "WV": 1.8,
+                            "HI": 1.5, "NH": 1.4, "ME": 1.4, "RI": 1.1, "MT": 1.1, "DE": 1.0, "SD": 0.9, "ND": 0.8,
+                            "AK": 0.7, "DC": 0.7, "VT": 0.6, "WY": 0.6, "GU": 0.17, "VI": 0.1, "AS": 0.05, "MP": 0.05,
+                            "AA": 0.05, "AE": 0.05, "AP": 0.05, "FM": 0.01, "MH": 0.01, "PW": 0.01}
+npdb_synth_blank_state_share = 0.01
+
+#relative weight of each malpractice allegation group (ALGNNATR)
+npdb_synth_allegation_weights = {1: 32, 10: 3, 20: 27, 30: 5, 40: 1, 50: 8, 60: 17, 70: 2, 80: 1, 90: 3, 100: 1}
+
+#relative weight of each injury severity (OUTCOME)
+npdb_synth_outcome_weights = {1: 3, 2: 4, 3: 10, 4: 14, 5: 10, 6: 15, 7: 6, 8: 5, 9: 28, 10: 5}
+
+#payment amounts are drawn from a log-normal distribution with this median and spread before being coded
+npdb_synth_payment_median = 150000
+npdb_synth_payment_sigma = 1.4
+
+#share of adverse actions with a specified penalty length, and the median length in months
+npdb_synth_length_share = 0.3
+npdb_synth_length_median_months = 12
+
+#payment ranges coded to their midpoints, as (lower bound, upper bound, width of each range); payments
+#above the last range are coded as $105,000,000 (see PAYMENT in PublicUseDataFile-Format.pdf)
+npdb_payment_ranges = [(0, 100, 100),
+                       (100, 500, 400),
+                       (500, 1000, 500),
+                       (1000, 5000, 1000),
+                       (5000, 100000, 5000),
+                       (100000, 1000000, 10000),
+                       (1000000, 10000000, 100000),
+                       (10000000, 20000000, 1000000),
+                       (20000000, 50000000, 5000000),
+                       (50000000, 100000000, 10000000)]
+npdb_payment_top_code = 105000000
+
+#******************************************************************************
+#SECTION II: GENERATING RECORDS
+#******************************************************************************
+
+#code whole dollar payment amounts into the midpoints of their ranges
+def code_payments(amounts):
+
+    amounts = np.maximum(np.ceil(amounts), 1)
+    coded_amounts = np.full(len(amounts), npdb_payment_top_code, dtype = np.int64)
+
+    for lower_bound, upper_bound, width in reversed(npdb_payment_ranges):
+        in_range = amounts <= upper_bound
+        coded_amounts[in_range] = lower_bound + (amounts[in_range] - lower_bound - 1) // width * width + width // 2
+
+    return coded_amounts
+
+
+#uniform number in [0, 1) derived from each integer, so per-practitioner traits stay the same across chunks
+def hash_uniform(values, salt):
+
+    with np.errstate(over = "ignore"):
+        mixed = (values.astype(np.uint64) + np.uint64(salt)) * np.uint64(0x9E3779B97F4A7C15)
+        mixed = (mixed ^ (mixed >> np.uint64(31))) * np.uint64(0xBF58476D1CE4E5B9)
+        mixed = mixed ^ (mixed >> np.uint64(29))
+
+    return (mixed >> np.uint64(11)).astype(np.float64) / 2 ** 53
+
+
+#random choice among the keys of a weight dict, for uniform numbers in [0, 1)
+def weighted_choice(weights, uniforms):
+
+    cumulative_weights = np.cumsum(list(weights.values())) / sum(weights.values())
+
+    return np.array(list(weights))[np.minimum(np.searchsorted(cumulative_weights, uniforms, side = "right"), len(weights) - 1)]
+
+
+#one chunk of synthetic records, with the columns the dashboard uses filled in as they appear in the npdb
+#csv file and RECTYPE telling payments from adverse actions; fields that do not apply to a record type are
+#blank as in the real file
+def synth_npdb_chunk(seed, chunk_number, n_rows, n_total_rows, first_year = npdb_synth_first_year, last_year = npdb_synth_last_year):
+
+    rng = np.random.default_rng([seed, chunk_number])
+    first_seqno = chunk_number * npdb_synth_chunk_rows + 1
+
+    #the number of reports grows over the years
+    years = np.arange(first_year, last_year + 1)
+    record_years = rng.choice(years, size = n_rows, p = np.linspace(1, 2, len(years)) / np.linspace(1, 2, len(years)).sum())
+
+    #a few practitioners account for many reports; each practitioner works in one state
+    n_practitioners = max(n_total_rows // npdb_synth_records_per_practitioner, 1)
+    practnums = (n_practitioners * rng.random(n_rows) ** 2).astype(np.int64) + 1
+    practitioner_states = weighted_choice(npdb_synth_state_weights, hash_uniform(practnums, seed))
+    work_states = np.where(hash_uniform(practnums, seed + 1) < npdb_synth_blank_state_share, None, practitioner_states)
+
+    #payments switched to the new report format in 2004 and adverse actions in late 1999
+    is_payment = rng.random(n_rows) < npdb_synth_payment_share
+    record_types = np.where(is_payment, np.where(record_years >= 2004, "P", "M"), np.where(record_years >= 2000, "C", "A"))
+    is_new_payment = record_types == "P"
+
+    allegations = weighted_choice(npdb_synth_allegation_weights, rng.random(n_rows))
+    outcomes = weighted_choice(npdb_synth_outcome_weights, rng.random(n_rows))
+    payments = code_payments(npdb_synth_payment_median * np.exp(npdb_synth_payment_sigma * rng.standard_normal(n_rows)))
+    length_months = np.maximum(np.rint(npdb_synth_length_median_months * np.exp(rng.standard_normal(n_rows))), 1)
+    has_length = ~is_payment & (rng.random(n_rows) < npdb_synth_length_share)
+
+    return pd.DataFrame({"SEQNO": np.arange(first_seqno, first_seqno + n_rows),
+                         "RECTYPE": record_types,
+                         "ORIGYEAR": record_years,
+                         "WORKSTAT": work_states,
+                         "ALGNNATR": pd.arrays.IntegerArray(allegations.astype(np.int16), ~is_payment),
+                         "OUTCOME": pd.arrays.IntegerArray(outcomes.astype(np.int16), ~is_new_payment),
+                         "TOTALPMT": np.where(is_new_payment, np.char.add("$", payments.astype(str)), None),
+                         "AALENGTH": np.where(has_length, np.round(length_months / 12, 2), np.nan),
+                         "PRACTNUM": practnums})
+
+
+#csv lines of a chunk with the given columns, leaving the columns the chunk does not have blank; the runs of
+#blank columns are written as plain commas, which is much faster than having to_csv format empty fields
+def format_npdb_csv_lines(chunk_df, csv_columns):
+
+    csv_lines = ""
+    separators = ""
+
+    for column_position, column in enumerate(csv_columns):
+        if column_position > 0:
+            separators += ","
+        if column in chunk_df.columns:
+            csv_lines = csv_lines + separators + chunk_df[column].astype(str).where(chunk_df[column].notna(), "")
+            separators = ""
+
+    return "\n".join(csv_lines + separators) + "\n"
+
+
+#generate and write the chunks of one output file after the header
+def write_npdb_synth_part(part_filepath, seed, chunk_numbers, n_total_rows, full_layout):
+
+    with open(part_filepath, "w") as part_file:
+        for chunk_position, chunk_number in enumerate(chunk_numbers):
+            n_rows = min(npdb_synth_chunk_rows, n_total_rows - chunk_number * npdb_synth_chunk_rows)
+            chunk_df = synth_npdb_chunk(seed, chunk_number, n_rows, n_total_rows)
+            csv_columns = list(npdb_schema) if full_layout else list(chunk_df.columns)
+
+            if chunk_position == 0:
+                part_file.write(",".join(csv_columns) + "\n")
+            part_file.write(format_npdb_csv_lines(chunk_df, csv_columns))
+
+    return part_filepath
+
+
+#write n_rows synthetic npdb records to a csv file, or to a directory of parts numbered files when parts is
+#more than one (generated side by side in a process pool); the same seed always gives the same records
+def write_npdb_synth(output_path, n_rows, seed = 0, parts = 1, full_layout = True, max_workers = None):
+
+    n_chunks = -(-n_rows // npdb_synth_chunk_rows)
+    parts = max(min(parts, n_chunks), 1)
+    part_chunks = np.array_split(np.arange(n_chunks), parts)
+
+    if parts == 1:
+        return [write_npdb_synth_part(output_path, seed, part_chunks[0].tolist(), n_rows, full_layout)]
+
+    os.makedirs(output_path, exist_ok = True)
+    part_filepaths = [os.path.join(output_path, "NPDB_SYNTH_{}.csv".format(part_number + 1)) for part_number in range(parts)]
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, parts)
+
+    if max_workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context("fork")) as executor:
+            return list(executor.map(write_npdb_synth_part, part_filepaths, [seed] * parts, [chunks.tolist() for chunks in part_chunks],
+                                     [n_rows] * parts, [full_layout] * parts))
+
+    return [write_npdb_synth_part(part_filepath, seed, chunks.tolist(), n_rows, full_layout) for part_filepath, chunks in zip(part_filepaths, part_chunks)]
+
+
+#write a synthetic npdb file: python npdb_synth.py <output csv file or directory> --rows 1000000 [--parts 16]
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Generate synthetic NPDB public use data records")
+    parser.add_argument("output_path", help = "csv file to write, or directory of partition files when --parts is more than 1")
+    parser.add_argument("--rows", type = int, default = 100000, help = "number of records")
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed; the same seed always gives the same records")
+    parser.add_argument("--parts", type = int, default = 1, help = "number of partition files")
+    parser.add_argument("--workers", type = int, default = None, help = "processes writing partition files (defaults to the number of cpu cores)")
+    parser.add_argument("--dashboard-columns", action = "store_true", help = "only write the columns the dashboard uses instead of the full layout")
+    arguments = parser.parse_args()
+
+    written_filepaths = write_npdb_synth(arguments.output_path, arguments.rows, seed = arguments.seed, parts = arguments.parts,
+                                         full_layout = not arguments.dashboard_columns, max_workers = arguments.workers)
+    print("Wrote {:,} synthetic NPDB records to {} file(s)".format(arguments.rows, len(written_filepaths)))
@@ -0,0 +1,103 @@
+import re
+import math
+
+import numpy as np
+import pandas as pd
+
+#******************************************************************************
+#SECTION I: FILTER QUERIES
+#******************************************************************************
+
+#one condition of a dash DataTable filter query, e.g. {SEQNO} > 100 or {WORKSTAT} icontains "ca"; the s or
+#i in front of an operator makes it case sensitive or insensitive (the default is sensitive)
+npdb_filter_condition = re.compile(r"^\s*\{(?P<column>[^}]+)\}\s*(?P<case>[si]?)(?P<operator>>=|<=|!=|>|<|=|eq|ne|lt|le|gt|ge|contains|datestartswith)\s*(?P<value>.*?)\s*$")
+
+#comparison operators of filter queries by their symbol and word forms
+npdb_filter_comparisons = {">=": "ge", "<=": "le", "!=": "ne", ">": "gt", "<": "lt", "=": "eq",
+                           "ge": "ge", "le": "le", "ne": "ne", "gt": "gt", "lt": "lt", "eq": "eq"}
+
+
+#the value of a filter condition: quoted values are text, other values are numbers when they parse as one
+def parse_filter_value(value_text):
+
+    if len(value_text) >= 2 and value_text[0] == value_text[-1] and value_text[0] in "\"'`":
+        return value_text[1:-1].replace("\\" + value_text[0], value_text[0])
+
+    try:
+        return float(value_text)
+    except ValueError:
+        return value_text
+
+
+#(column, case sensitive, operator, value) of each condition joined by && in a filter query; conditions that
+#cannot be parsed are left out, so a half typed filter does not break the table
+def parse_filter_query(filter_query):
+
+    conditions = []
+
+    for condition_text in (filter_query or "").split("&&"):
+        condition_match = npdb_filter_condition.match(condition_text)
+        if condition_match is not None:
+            conditions.append((condition_match.group("column"), condition_match.group("case") != "i",
+                               npdb_filter_comparisons.get(condition_match.group("operator"), condition_match.group("operator")),
+                               parse_filter_value(condition_match.group("value"))))
+
+    return conditions
+
+
+#rows of a table meeting every condition of a filter query
+def filter_table(table_df, filter_query):
+
+    keep = np.ones(len(table_df), dtype = bool)
+
+    for column, case_sensitive, operator, value in parse_filter_query(filter_query):
+        if column not in table_df.columns:
+            continue
+        column_values = table_df[column]
+
+        if operator in ["contains", "datestartswith"]:
+            column_text = column_values.astype(str).where(column_values.notna(), "")
+            value_text = str(value).removesuffix(".0") if isinstance(value, float) else value
+            if not case_sensitive:
+                column_text, value_text = column_text.str.lower(), value_text.lower()
+            matches = column_text.str.contains(value_text, regex = False) if operator == "contains" else column_text.str.startswith(value_text)
+        else:
+            #numbers compare with numeric columns and text with text columns; anything else matches nothing
+            if pd.api.types.is_numeric_dtype(column_values) != isinstance(value, float):
+                keep[:] = False
+                continue
+            if isinstance(value, str) and not case_sensitive:
+                column_values, value = column_values.str.lower(), value.lower()
+            matches = getattr(column_values, operator)(value)
+
+        keep &= matches.to_numpy(dtype = object, na_value = False).astype(bool)
+
+    return table_df[keep]
+
+#******************************************************************************
+#SECTION II: SORTING AND PAGING
+#******************************************************************************
+
+#rows of a table ordered by the sort_by list of a dash DataTable ({"column_id", "direction"} in order of
+#priority); empty values go last whichever the direction
+def sort_table(table_df, sort_by):
+
+    sort_by = [sort_column for sort_column in (sort_by or []) if sort_column["column_id"] in table_df.columns]
+    if not sort_by:
+        return table_df
+
+    return table_df.sort_values(by = [sort_column["column_id"] for sort_column in sort_by],
+                                ascending = [sort_column["direction"] == "asc" for sort_column in sort_by],
+                                na_position = "last", kind = "stable")
+
+
+#one page of a table after filtering and sorting it, with the number of pages and the page returned (the
+#requested page, moved back to the last page when filtering left fewer pages)
+def query_table_page(table_df, page_current, page_size, sort_by = None, filter_query = ""):
+
+    table_df = sort_table(filter_table(table_df, filter_query), sort_by)
+
+    page_count = max(math.ceil(len(table_df) / page_size), 1)
+    page_current = min(max(page_current or 0, 0), page_count - 1)
+
+    return table_df.iloc[page_current * page_size:(page_current + 1) * page_size], page_count, page_current
@@ -0,0 +1,106 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+#the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from npdb_ingest import clean_npdb_df
+from npdb_index import npdb_percentiles
+
+#******************************************************************************
+#SECTION I: SYNTHETIC CSV FILES
+#******************************************************************************
+
+#raw records as they appear in the npdb csv file, for the columns the dashboard uses: payments are written
+#with a $ sign, and the fields that do not apply to a record type are blank
+def synth_npdb_raw(n_rows, seed = 0, first_seqno = 1, first_year = 1995, last_year = 2004):
+
+    rng = np.random.default_rng(seed)
+    is_payment = rng.random(n_rows) < 0.4
+    payments = (rng.integers(1, 400, n_rows) * 2500).astype(str)
+
+    return pd.DataFrame({"SEQNO": np.arange(first_seqno, first_seqno + n_rows),
+                         "RECTYPE": np.where(is_payment, "P", "C"),
+                         "ORIGYEAR": rng.integers(first_year, last_year + 1, n_rows),
+                         "WORKSTAT": np.where(rng.random(n_rows) < 0.02, None, rng.choice(["CA", "FL", "NY", "TX", "WA"], n_rows)),
+                         "ALGNNATR": pd.array(np.where(is_payment, rng.choice([1, 10, 20, 60], n_rows), None), dtype = "Int16"),
+                         "OUTCOME": pd.array(np.where(is_payment, rng.choice([1, 3, 6, 9], n_rows), None), dtype = "Int16"),
+                         "TOTALPMT": np.where(is_payment, np.char.add("$", payments), None),
+                         "AALENGTH": np.where(~is_payment & (rng.random(n_rows) < 0.5), rng.integers(1, 40, n_rows) / 4, np.nan),
+                         "PRACTNUM": rng.integers(1, max(n_rows // 3, 2), n_rows)})
+
+
+#write raw records to a csv file, leaving missing values blank
+def write_npdb_csv(csv_filepath, raw_df):
+
+    raw_df.to_csv(csv_filepath, index = False)
+
+    return str(csv_filepath)
+
+
+@pytest.fixture
+def npdb_csv(tmp_path):
+
+    return write_npdb_csv(tmp_path / "NPDB_TEST.csv", synth_npdb_raw(500))
+
+
+#cleaned records over a few years, with some claims reported again (in the same or another year) so that
+#SEQNO repeats, as it does in the real file
+def synth_npdb_records(n_rows, seed = 0, first_year = 1995, last_year = 2004, repeat_share = 0.2):
+
+    records_df = clean_npdb_df(synth_npdb_raw(n_rows, seed = seed, first_year = first_year, last_year = last_year))
+
+    rng = np.random.default_rng(seed)
+    repeated_df = records_df.sample(frac = repeat_share, random_state = seed).reset_index(drop = True)
+    moved = rng.random(len(repeated_df)) < 0.5
+    repeated_df.loc[moved, "ORIGYEAR"] = rng.integers(first_year, last_year + 1, size = int(moved.sum())).astype(np.int16)
+
+    return pd.concat([records_df, repeated_df], ignore_index = True)
+
+
+@pytest.fixture(scope = "session")
+def npdb_records():
+
+    return synth_npdb_records(4000)
+
+#******************************************************************************
+#SECTION II: REFERENCE SUMMARIES
+#******************************************************************************
+
+#the year range summaries computed the way the dashboard originally did, with pandas groupby on the records
+#of the year range
+def reference_summary(records_df, start_year, end_year):
+
+    range_df = records_df[records_df["ORIGYEAR"].between(start_year, end_year)]
+    state_groups = range_df.groupby(range_df["WORKSTAT"].astype(object))
+
+    state_df = state_groups.aggregate({"PRACTNUM": "nunique", "SEQNO": "nunique", "TOTALPMT": "median", "AALENGTH": "median"})
+    for value_column in ["TOTALPMT", "AALENGTH"]:
+        for percentile in npdb_percentiles:
+            state_df["{}_P{}".format(value_column, percentile)] = state_groups[value_column].quantile(percentile / 100)
+
+    return {"state": state_df.rename_axis("WORKSTAT").reset_index(),
+            "overall": {"SEQNO": range_df["SEQNO"].nunique(),
+                        "PRACTNUM": range_df["PRACTNUM"].nunique(),
+                        "TOTALPMT": range_df["TOTALPMT"].sum(),
+                        "AALENGTH": range_df["AALENGTH"].median()},
+            **{group_column: range_df.groupby(range_df[group_column].astype(object))["SEQNO"].nunique().rename_axis(group_column).reset_index()
+               for group_column in ["ALGNNATR", "OUTCOME"]}}
+
+
+#assert that the summary of a year index matches the reference summary
+def assert_summary_matches(npdb_summary, expected_summary):
+
+    for part in ["state", "ALGNNATR", "OUTCOME"]:
+        actual_df = npdb_summary[part].astype({part if part != "state" else "WORKSTAT": object})
+        pd.testing.assert_frame_equal(actual_df.reset_index(drop = True), expected_summary[part][actual_df.columns].reset_index(drop = True),
+                                      check_dtype = False)
+
+    assert npdb_summary["overall"]["SEQNO"] == expected_summary["overall"]["SEQNO"]
+    assert npdb_summary["overall"]["PRACTNUM"] == expected_summary["overall"]["PRACTNUM"]
+    assert npdb_summary["overall"]["TOTALPMT"] == pytest.approx(expected_summary["overall"]["TOTALPMT"])
+    np.testing.assert_equal(npdb_summary["overall"]["AALENGTH"], expected_summary["overall"]["AALENGTH"])
@@ -0,0 +1,187 @@
+import io
+import json
+
+import pandas as pd
+import pytest
+from flask import Flask
+
+import npdb_api
+from npdb_api import NpdbApi
+from npdb_index import NpdbYearIndex, summarize_npdb_records
+from npdb_bitmaps import NpdbBitmapIndex, npdb_cross_filter_columns
+from npdb_reload import NpdbDataset
+
+from conftest import synth_npdb_records
+
+#******************************************************************************
+#SECTION I: TEST SERVER
+#******************************************************************************
+
+#summaries answered the way the dashboard answers them, counting how many were computed
+class CountingSummaries:
+
+    def __init__(self):
+
+        self.computed = 0
+
+
+    def __call__(self, npdb_dataset, start_year, end_year, cross_filter):
+
+        self.computed += 1
+        if not cross_filter:
+            return npdb_dataset.index.summarize(start_year, end_year)
+
+        selected_rows = npdb_dataset.bitmap_index.select(start_year, end_year, cross_filter)
+        return summarize_npdb_records(npdb_dataset.take_records(selected_rows), start_year, end_year)
+
+
+@pytest.fixture(scope = "module")
+def npdb_dataset():
+
+    npdb_records = synth_npdb_records(2000).sort_values("ORIGYEAR", kind = "stable", ignore_index = True)
+    npdb_dataset = NpdbDataset(npdb_records, None, NpdbYearIndex(npdb_records), {})
+    npdb_dataset.bitmap_index = NpdbBitmapIndex(npdb_records)
+    npdb_dataset.data_tag = "data version"
+
+    return npdb_dataset
+
+
+@pytest.fixture
+def api_client(npdb_dataset):
+
+    server = Flask(__name__)
+    summaries = CountingSummaries()
+    NpdbApi(lambda: npdb_dataset, summaries, code_labels = {"ALGNNATR": {"ABBR": {1: "DIAG", 10: "ANES", 20: "SURG", 60: "TREAT"}}},
+            filter_columns = npdb_cross_filter_columns, max_age = 60).init_app(server)
+
+    return server.test_client(), summaries
+
+#******************************************************************************
+#SECTION II: RESPONSES
+#******************************************************************************
+
+def test_summary_json(api_client, npdb_dataset):
+
+    client, _ = api_client
+    response = client.get("/api/v1/summary?start=1997&end=2001")
+    response_json = response.get_json()
+
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "public, max-age=60"
+    assert {key: response_json[key] for key in ["part", "start_year", "end_year", "filters", "approximate_counts"]} == \
+        {"part": "summary", "start_year": 1997, "end_year": 2001, "filters": {}, "approximate_counts": False}
+    assert response_json["data"] == pytest.approx(npdb_dataset.index.summarize_overall(1997, 2001), nan_ok = True)
+
+
+#the years default to the years of the data
+def test_default_years(api_client, npdb_dataset):
+
+    client, _ = api_client
+    response_json = client.get("/api/v1/states").get_json()
+
+    assert (response_json["start_year"], response_json["end_year"]) == (npdb_dataset.index.first_year, npdb_dataset.index.last_year)
+
+
+#tables larger than a chunk of rows are streamed in several pieces and read back whole
+@pytest.mark.parametrize("response_format", ["json", "csv"])
+def test_streamed_tables(api_client, npdb_dataset, monkeypatch, response_format):
+
+    monkeypatch.setattr(npdb_api, "npdb_api_chunk_rows", 7)
+    client, _ = api_client
+
+    response = client.get("/api/v1/state-years?start=1996&end=2003&format={}".format(response_format))
+    expected_df = npdb_dataset.index.summarize_state_years(1996, 2003)
+
+    assert response.is_streamed
+    if response_format == "csv":
+        assert response.mimetype == "text/csv"
+        assert response.headers["Content-Disposition"] == "attachment; filename=npdb_state-years_1996_2003.csv"
+        table_df = pd.read_csv(io.StringIO(response.get_data(as_text = True)), keep_default_na = False, na_values = [""])
+    else:
+        table_df = pd.DataFrame(json.loads(response.get_data(as_text = True))["data"])
+    assert len(table_df) == len(expected_df) > 7
+    pd.testing.assert_frame_equal(table_df, expected_df.astype({"WORKSTAT": object}), check_dtype = False)
+
+
+def test_code_labels(api_client):
+
+    client, _ = api_client
+    allegation_records = client.get("/api/v1/allegations").get_json()["data"]
+
+    assert {(record["ALGNNATR"], record["ALGNNATR_ABBR"]) for record in allegation_records} == {(1, "DIAG"), (10, "ANES"), (20, "SURG"), (60, "TREAT")}
+
+
+def test_cross_filter(api_client, npdb_dataset):
+
+    client, _ = api_client
+    response_json = client.get("/api/v1/summary?start=1995&end=2004&WORKSTAT=NY,CA&RECTYPE=P&OUTCOME=9").get_json()
+
+    selected_records = npdb_dataset.npdb_df[npdb_dataset.npdb_df["WORKSTAT"].isin(["CA", "NY"]) & (npdb_dataset.npdb_df["RECTYPE"] == "P") &
+                                            (npdb_dataset.npdb_df["OUTCOME"] == 9)]
+    assert response_json["filters"] == {"OUTCOME": [9], "RECTYPE": ["P"], "WORKSTAT": ["CA", "NY"]}
+    assert response_json["data"]["SEQNO"] == selected_records["SEQNO"].nunique()
+
+#a repeated column adds its values to those of its other occurrences
+def test_repeated_cross_filter(api_client):
+
+    client, _ = api_client
+    repeated_json = client.get("/api/v1/summary?start=1995&end=2004&WORKSTAT=NY&WORKSTAT=CA,TX&OUTCOME=9&OUTCOME=1").get_json()
+    joined_json = client.get("/api/v1/summary?start=1995&end=2004&WORKSTAT=CA,NY,TX&OUTCOME=1,9").get_json()
+
+    assert repeated_json["filters"] == {"OUTCOME": [1, 9], "WORKSTAT": ["CA", "NY", "TX"]}
+    assert repeated_json["data"] == joined_json["data"]
+
+#******************************************************************************
+#SECTION III: CACHING AND ERRORS
+#******************************************************************************
+
+#a repeated query with the etag of the first response is answered with a 304 without computing anything
+def test_not_modified(api_client):
+
+    client, summaries = api_client
+    first_response = client.get("/api/v1/states?start=1998&end=2000")
+    etag = first_response.headers["ETag"]
+    computed = summaries.computed
+
+    repeated_response = client.get("/api/v1/states?start=1998&end=2000", headers = {"If-None-Match": etag})
+    other_response = client.get("/api/v1/states?start=1998&end=2001", headers = {"If-None-Match": etag})
+
+    assert repeated_response.status_code == 304
+    assert repeated_response.headers["ETag"] == etag
+    assert repeated_response.get_data() == b""
+    assert other_response.status_code == 200
+    assert other_response.headers["ETag"] != etag
+    assert summaries.computed == computed + 1
+
+
+#the etag follows the version of the data
+def test_etag_follows_data_version(api_client, npdb_dataset, monkeypatch):
+
+    client, _ = api_client
+    etag = client.get("/api/v1/summary").headers["ETag"]
+    monkeypatch.setattr(npdb_dataset, "data_tag", "new data version")
+
+    assert client.get("/api/v1/summary", headers = {"If-None-Match": etag}).status_code == 200
+
+
+@pytest.mark.parametrize("query, status, message", [("start=abc", 400, "start and end must be whole years"),
+                                                    ("format=xml", 400, "format must be json or csv"),
+                                                    ("PRACTNUM=5", 400, "unknown parameter PRACTNUM")])
+def test_bad_requests(api_client, query, status, message):
+
+    client, summaries = api_client
+    response = client.get("/api/v1/summary?" + query)
+
+    assert response.status_code == status
+    assert message in response.get_json()["error"]
+    assert summaries.computed == 0
+
+
+def test_unknown_part(api_client):
+
+    client, summaries = api_client
+    response = client.get("/api/v1/payments")
+
+    assert response.status_code == 404
+    assert response.get_json()["error"].startswith("unknown part payments")
+    assert summaries.computed == 0
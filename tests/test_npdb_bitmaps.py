@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from npdb_bitmaps import NpdbBitmapIndex, pack_bits, clip_bits, bit_positions
+
+from conftest import synth_npdb_records
+
+#******************************************************************************
+#SECTION I: BIT ARRAYS
+#******************************************************************************
+
+#every start and end bit over bitmaps of a few bytes, starting at the byte holding the start bit
+@pytest.mark.parametrize("n_bits", [1, 7, 8, 9, 24, 29])
+def test_clip_bits_matches_mask(n_bits):
+
+    for start in range(n_bits + 1):
+        for end in range(start, n_bits + 1):
+            byte_start, byte_end = start // 8, (end + 7) // 8
+            bitmap_bytes = np.full(byte_end - byte_start, 0xFF, dtype = np.uint8)
+
+            clipped = clip_bits(bitmap_bytes, byte_start, start, end)
+
+            expected_positions = np.arange(start, end)
+            np.testing.assert_array_equal(bit_positions(clipped, byte_start), expected_positions)
+
+
+def test_bit_positions_round_trip():
+
+    mask = np.random.default_rng(0).random(1001) < 0.1
+
+    np.testing.assert_array_equal(bit_positions(pack_bits(mask), 0), np.flatnonzero(mask))
+
+#******************************************************************************
+#SECTION II: BITMAP INDEX
+#******************************************************************************
+
+@pytest.mark.parametrize("start_year, end_year", [(1995, 2004), (1998, 1998), (1990, 1997), (2002, 2030), (1980, 1990), (2001, 1998)])
+@pytest.mark.parametrize("filters", [{}, {"WORKSTAT": ["CA", "NY"]}, {"RECTYPE": ["P"], "OUTCOME": [1, 9]},
+                                     {"ALGNNATR": [1, 20], "WORKSTAT": ["TX"]}, {"WORKSTAT": ["XX"]}])
+def test_select_matches_boolean_mask(npdb_records, start_year, end_year, filters):
+
+    bitmap_index = NpdbBitmapIndex(npdb_records)
+
+    expected_mask = npdb_records["ORIGYEAR"].between(start_year, end_year).to_numpy()
+    for column, column_values in filters.items():
+        expected_mask &= npdb_records[column].isin(column_values).to_numpy()
+
+    selected_rows = bitmap_index.select(start_year, end_year, filters)
+
+    np.testing.assert_array_equal(np.sort(selected_rows), np.flatnonzero(expected_mask))
+    assert bitmap_index.count(start_year, end_year, filters) == expected_mask.sum()
+
+
+def test_select_without_records():
+
+    bitmap_index = NpdbBitmapIndex(synth_npdb_records(10).iloc[0:0])
+
+    assert len(bitmap_index.select(1990, 2020, {"WORKSTAT": ["CA"]})) == 0
+
+
+#appended records get segments of their own, selected as if the index had been built over all the records,
+#also after a round trip through the arrays of a snapshot; the index appended to is left as it was
+@pytest.mark.parametrize("start_year, end_year", [(1995, 2004), (1998, 1998), (2002, 2030)])
+@pytest.mark.parametrize("filters", [{}, {"WORKSTAT": ["CA", "NY"]}, {"RECTYPE": ["P"], "OUTCOME": [1, 9]}, {"WORKSTAT": ["ZZ"]}])
+def test_appended_segments_match_whole(npdb_records, start_year, end_year, filters):
+
+    npdb_records = npdb_records.reset_index(drop = True)
+    npdb_records["WORKSTAT"] = npdb_records["WORKSTAT"].astype(object)
+    npdb_records.loc[len(npdb_records) - 5:, "WORKSTAT"] = "ZZ"
+    base_index = NpdbBitmapIndex(npdb_records.iloc[:1000])
+    bitmap_index = base_index.append(npdb_records.iloc[1000:1500]).append(npdb_records.iloc[1500:])
+    whole_index = NpdbBitmapIndex(npdb_records)
+
+    assert bitmap_index.values == whole_index.values
+    assert base_index.n_rows == 1000 and len(base_index.segments) == 1
+    for selecting_index in [bitmap_index, NpdbBitmapIndex.from_arrays(*bitmap_index.to_arrays())]:
+        np.testing.assert_array_equal(np.sort(selecting_index.select(start_year, end_year, filters)), np.sort(whole_index.select(start_year, end_year, filters)))
+        assert selecting_index.count(start_year, end_year, filters) == whole_index.count(start_year, end_year, filters)
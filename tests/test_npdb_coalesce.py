@@ -0,0 +1,178 @@
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from npdb_coalesce import NpdbSummaryCache, NpdbSessionGenerations, NpdbSuperseded
+
+#******************************************************************************
+#SECTION I: SESSION GENERATIONS
+#******************************************************************************
+
+def test_newer_request_supersedes_older():
+
+    generations = NpdbSessionGenerations()
+    first_is_stale = generations.advance(("session", "callback"))
+    other_is_stale = generations.advance(("other session", "callback"))
+    second_is_stale = generations.advance(("session", "callback"))
+
+    assert first_is_stale()
+    assert not second_is_stale()
+    assert not other_is_stale()
+
+#******************************************************************************
+#SECTION II: COALESCING SUMMARY CACHE
+#******************************************************************************
+
+#summary cache on one worker thread whose computations wait for release to be set, recording the keys computed
+class GatedCompute:
+
+    def __init__(self):
+
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.computed = []
+
+
+    def __call__(self, *key):
+
+        self.started.set()
+        self.release.wait(5)
+        self.computed.append(key)
+        if key == ("fail",):
+            raise ValueError("failed")
+        return sum(key)
+
+
+@pytest.fixture
+def gated_cache():
+
+    executor = ThreadPoolExecutor(max_workers = 1)
+    compute = GatedCompute()
+    yield NpdbSummaryCache(compute, 2, executor), compute
+    compute.release.set()
+    executor.shutdown(wait = True)
+
+
+#wait for a condition set by another thread, failing after a few seconds
+def wait_until(condition):
+
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+#call the cache from a thread, collecting the result or exception
+def call_in_thread(summary_cache, key, is_stale = None):
+
+    outcome = {}
+
+    def call():
+        try:
+            outcome["result"] = summary_cache(*key, is_stale = is_stale)
+        except Exception as error:
+            outcome["error"] = error
+
+    thread = threading.Thread(target = call)
+    thread.start()
+
+    return thread, outcome
+
+
+def test_concurrent_requests_share_one_computation(gated_cache):
+
+    summary_cache, compute = gated_cache
+    first_thread, first_outcome = call_in_thread(summary_cache, (1, 2))
+    compute.started.wait(5)
+    second_thread, second_outcome = call_in_thread(summary_cache, (1, 2))
+
+    #wait until the second request has joined the running computation
+    wait_until(lambda: summary_cache.cache_info().coalesced == 1)
+    compute.release.set()
+    first_thread.join(5)
+    second_thread.join(5)
+
+    assert first_outcome["result"] == second_outcome["result"] == 3
+    assert compute.computed == [(1, 2)]
+    assert summary_cache.cache_info().misses == 1 and summary_cache.cache_info().coalesced == 1
+
+    assert summary_cache(1, 2) == 3
+    assert summary_cache.cache_info().hits == 1
+
+
+def test_queued_computation_dropped_when_superseded(gated_cache):
+
+    summary_cache, compute = gated_cache
+    running_thread, running_outcome = call_in_thread(summary_cache, (1, 1))
+    compute.started.wait(5)
+
+    #queued behind the running computation; superseded before the worker gets to it
+    stale = threading.Event()
+    queued_thread, queued_outcome = call_in_thread(summary_cache, (5, 5), is_stale = stale.is_set)
+    wait_until(lambda: summary_cache.cache_info().misses == 2)
+    stale.set()
+    compute.release.set()
+    running_thread.join(5)
+    queued_thread.join(5)
+
+    assert running_outcome["result"] == 2
+    assert isinstance(queued_outcome["error"], NpdbSuperseded)
+    assert compute.computed == [(1, 1)]
+    assert summary_cache.cache_info().superseded == 1
+
+    #a later request for the dropped key computes it
+    assert summary_cache(5, 5) == 10
+
+
+def test_queued_computation_kept_while_one_request_wants_it(gated_cache):
+
+    summary_cache, compute = gated_cache
+    running_thread, _ = call_in_thread(summary_cache, (1, 1))
+    compute.started.wait(5)
+
+    stale_thread, stale_outcome = call_in_thread(summary_cache, (2, 2), is_stale = lambda: True)
+    wait_until(lambda: summary_cache.cache_info().misses == 2)
+    wanted_thread, wanted_outcome = call_in_thread(summary_cache, (2, 2), is_stale = lambda: False)
+    wait_until(lambda: summary_cache.cache_info().coalesced == 1)
+    compute.release.set()
+    for thread in [running_thread, stale_thread, wanted_thread]:
+        thread.join(5)
+
+    assert stale_outcome["result"] == wanted_outcome["result"] == 4
+    assert summary_cache.cache_info().superseded == 0
+
+
+def test_failed_computation_is_not_cached(gated_cache):
+
+    summary_cache, compute = gated_cache
+    compute.release.set()
+
+    with pytest.raises(ValueError):
+        summary_cache("fail")
+    with pytest.raises(ValueError):
+        summary_cache("fail")
+
+    assert compute.computed == [("fail",), ("fail",)]
+    assert summary_cache.cache_info().currsize == 0
+
+
+def test_least_recently_used_summary_evicted(gated_cache):
+
+    summary_cache, compute = gated_cache
+    compute.release.set()
+
+    summary_cache(1)
+    summary_cache(2)
+    summary_cache(1)
+    summary_cache(3)
+    summary_cache(1)
+    summary_cache(2)
+
+    assert compute.computed == [(1,), (2,), (3,), (2,)]
+    assert summary_cache.cache_info().currsize == 2
+
+    summary_cache.cache_clear()
+    assert summary_cache.cache_info().currsize == 0 and summary_cache.cache_info().hits == 0
@@ -0,0 +1,247 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import npdb_index
+from npdb_index import (NpdbYearIndex, NpdbIndexBuilder, RangeQuantiles, tally_distinct_years, distinct_counter_prefix,
+                        query_distinct_counter, summarize_npdb_records)
+
+from conftest import synth_npdb_records, reference_summary, assert_summary_matches
+
+#year ranges of the records (1995 to 2004): single years, spans, ranges reaching past either end, ranges outside
+#the records and reversed ranges
+npdb_test_ranges = [(1995, 2004), (1999, 1999), (1997, 2001), (1990, 1996), (2003, 2010), (1980, 2030),
+                    (1980, 1990), (2010, 2020), (2001, 1998), (2004, 1995)]
+
+#******************************************************************************
+#SECTION I: SUMMARIES
+#******************************************************************************
+
+@pytest.mark.parametrize("start_year, end_year", npdb_test_ranges)
+def test_summary_matches_groupby(npdb_records, start_year, end_year):
+
+    npdb_index = NpdbYearIndex(npdb_records)
+
+    assert_summary_matches(npdb_index.summarize(start_year, end_year), reference_summary(npdb_records, start_year, end_year))
+
+
+def test_state_years_match_single_years(npdb_records):
+
+    npdb_index = NpdbYearIndex(npdb_records)
+    state_year_df = npdb_index.summarize_state_years(1997, 2001)
+
+    assert sorted(state_year_df["ORIGYEAR"].unique()) == list(range(1997, 2002))
+    for year in range(1997, 2002):
+        year_df = state_year_df[state_year_df["ORIGYEAR"] == year].drop(columns = "ORIGYEAR").reset_index(drop = True)
+        pd.testing.assert_frame_equal(year_df, npdb_index.summarize_states(year, year))
+
+
+#the summary computed straight from the records (as for cross filter selections) is the same as the summary of
+#their year index, both with claims of several records and with one record per claim
+@pytest.mark.parametrize("repeat_share", [0.2, 0])
+def test_record_summary_matches_index(repeat_share):
+
+    records_df = synth_npdb_records(3000, seed = 1, repeat_share = repeat_share)
+    npdb_index = NpdbYearIndex(records_df)
+
+    for start_year, end_year in npdb_test_ranges:
+        index_summary = npdb_index.summarize(start_year, end_year)
+        range_records = records_df[records_df["ORIGYEAR"].between(start_year, end_year)]
+        for records_summary in [summarize_npdb_records(records_df, start_year, end_year), summarize_npdb_records(range_records, start_year, end_year)]:
+            for part in ["state_year", "state", "ALGNNATR", "OUTCOME"]:
+                pd.testing.assert_frame_equal(records_summary[part], index_summary[part], check_exact = True)
+            np.testing.assert_equal(records_summary["overall"], index_summary["overall"])
+
+
+#an index built from chunks (as when streaming or appending) is the same as one built from all records at once
+def test_chunked_build_matches_whole(npdb_records):
+
+    index_builder = NpdbIndexBuilder()
+    shuffled_records = npdb_records.sample(frac = 1, random_state = 0)
+    for chunk_rows in np.array_split(np.arange(len(shuffled_records)), 5):
+        index_builder.add_chunk(shuffled_records.iloc[chunk_rows])
+    chunked_index = index_builder.build()
+    whole_index = NpdbYearIndex(npdb_records)
+
+    for start_year, end_year in npdb_test_ranges:
+        chunked_summary = chunked_index.summarize(start_year, end_year)
+        whole_summary = whole_index.summarize(start_year, end_year)
+        for part in ["state_year", "state", "ALGNNATR", "OUTCOME"]:
+            pd.testing.assert_frame_equal(chunked_summary[part], whole_summary[part])
+        np.testing.assert_equal(chunked_summary["overall"], whole_summary["overall"])
+
+
+#a builder without kept appearances keeps the years of each (group, id) pair and a running distinct tally,
+#giving the same index as the records added so far after every chunk, also when a chunk brings earlier years,
+#new states or ids already seen
+@pytest.mark.parametrize("order", ["shuffled", "latest first"])
+def test_pair_tallies_match_whole(npdb_records, order):
+
+    if order == "shuffled":
+        ordered_records = npdb_records.sample(frac = 1, random_state = 0)
+    else:
+        ordered_records = npdb_records.sort_values("ORIGYEAR", ascending = False, kind = "stable")
+
+    chunk_rows = np.array_split(np.arange(len(ordered_records)), 4)
+    index_builder = NpdbIndexBuilder(keep_appearances = False)
+    for chunk_number, rows in enumerate(chunk_rows):
+        index_builder.add_chunk(ordered_records.iloc[rows])
+        built_index = index_builder.build()
+        whole_index = NpdbYearIndex(ordered_records.iloc[np.concatenate(chunk_rows[:chunk_number + 1])])
+
+        assert all(len(parts) == 0 for parts in index_builder.distinct_parts.values())
+        for start_year, end_year in npdb_test_ranges:
+            built_summary = built_index.summarize(start_year, end_year)
+            whole_summary = whole_index.summarize(start_year, end_year)
+            for part in ["state_year", "state", "ALGNNATR", "OUTCOME"]:
+                pd.testing.assert_frame_equal(built_summary[part], whole_summary[part])
+            np.testing.assert_equal(built_summary["overall"], whole_summary["overall"])
+
+
+def test_spilled_build_matches_whole(npdb_records, tmp_path):
+
+    index_builder = NpdbIndexBuilder(spill_dir = str(tmp_path), spill_buckets = 3)
+    for chunk_rows in np.array_split(np.arange(len(npdb_records)), 4):
+        index_builder.add_chunk(npdb_records.iloc[chunk_rows])
+    spilled_index = index_builder.build()
+    whole_index = NpdbYearIndex(npdb_records)
+
+    for start_year, end_year in npdb_test_ranges:
+        pd.testing.assert_frame_equal(spilled_index.summarize_states(start_year, end_year), whole_index.summarize_states(start_year, end_year))
+
+
+def test_empty_records():
+
+    npdb_index = NpdbYearIndex(synth_npdb_records(10).iloc[0:0])
+
+    assert npdb_index.summarize_overall(1990, 2020)["SEQNO"] == 0
+    assert len(npdb_index.summarize(1990, 2020)["state"]) == 0
+
+
+def test_approximate_counts_close(npdb_records):
+
+    npdb_index = NpdbYearIndex(npdb_records, distinct_error = 0.01)
+    expected_summary = reference_summary(npdb_records, 1995, 2004)
+
+    assert npdb_index.approximate_counts
+    assert npdb_index.summarize_overall(1995, 2004)["SEQNO"] == pytest.approx(expected_summary["overall"]["SEQNO"], rel = 0.05)
+    assert npdb_index.summarize_overall(1995, 2004)["PRACTNUM"] == pytest.approx(expected_summary["overall"]["PRACTNUM"], rel = 0.05)
+
+#******************************************************************************
+#SECTION II: DISTINCT COUNTS
+#******************************************************************************
+
+#distinct ids of each group over every year range, counted directly
+def brute_distinct_counts(group_codes, id_values, year_codes, n_groups, start_code, end_code):
+
+    in_range = (year_codes >= start_code) & (year_codes <= end_code)
+
+    return np.array([len(np.unique(id_values[in_range & (group_codes == group_code)])) for group_code in range(n_groups)])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_tally_distinct_years_matches_brute_force(seed):
+
+    rng = np.random.default_rng(seed)
+    n_groups, n_years, n_records = 3, 6, 300
+    group_codes = rng.integers(0, n_groups, n_records)
+    id_values = rng.integers(0, 40, n_records) * 1000003
+    year_codes = rng.integers(0, n_years, n_records)
+
+    prefix = distinct_counter_prefix(tally_distinct_years(group_codes, id_values, year_codes, n_groups, n_years))
+
+    for start_code in range(n_years):
+        for end_code in range(start_code, n_years):
+            np.testing.assert_array_equal(query_distinct_counter(prefix, start_code, end_code),
+                                          brute_distinct_counts(group_codes, id_values, year_codes, n_groups, start_code, end_code))
+
+
+#tallies of disjoint sets of ids add up, which is what lets the builder tally one spill partition at a time
+def test_tally_distinct_years_adds_over_id_partitions():
+
+    rng = np.random.default_rng(0)
+    group_codes = rng.integers(0, 2, 500)
+    id_values = rng.integers(0, 60, 500)
+    year_codes = rng.integers(0, 5, 500)
+
+    whole_tally = tally_distinct_years(group_codes, id_values, year_codes, 2, 5)
+    partition_tallies = [tally_distinct_years(group_codes[id_values % 3 == bucket], id_values[id_values % 3 == bucket],
+                                              year_codes[id_values % 3 == bucket], 2, 5) for bucket in range(3)]
+
+    np.testing.assert_array_equal(whole_tally, sum(partition_tallies))
+
+
+def test_tally_distinct_years_empty():
+
+    assert tally_distinct_years(np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64), 2, 3).sum() == 0
+
+#******************************************************************************
+#SECTION III: MEDIANS AND PERCENTILES
+#******************************************************************************
+
+#random (group, year, value) counts, with some groups left without values in some years
+def random_value_counts(seed, n_groups = 4, n_years = 5, n_values = 12):
+
+    rng = np.random.default_rng(seed)
+    n_cells = 60
+    group_codes = rng.integers(0, n_groups, n_cells)
+    year_codes = rng.integers(0, n_years, n_cells)
+    values = rng.choice(np.round(rng.normal(100, 50, n_values), 2), n_cells)
+    value_counts = rng.integers(1, 4, n_cells)
+
+    return group_codes, year_codes, values, value_counts, n_groups, n_years
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("sorted_path", [False, True])
+def test_range_quantiles_match_numpy(monkeypatch, seed, sorted_path):
+
+    if sorted_path:
+        monkeypatch.setattr(npdb_index, "npdb_histogram_cell_limit", 0)
+
+    group_codes, year_codes, values, value_counts, n_groups, n_years = random_value_counts(seed)
+    range_quantiles = RangeQuantiles(group_codes, year_codes, values, value_counts, n_groups, n_years)
+    assert (range_quantiles.sorted_values is not None) == sorted_path
+
+    percentiles = [0, 10, 25, 50, 75, 90, 99, 100]
+    for start_code in range(n_years):
+        for end_code in range(start_code, n_years):
+            medians = range_quantiles.median(start_code, end_code)
+            group_percentiles = range_quantiles.percentiles(start_code, end_code, percentiles)
+
+            for group_code in range(n_groups):
+                in_cells = (group_codes == group_code) & (year_codes >= start_code) & (year_codes <= end_code)
+                group_values = np.repeat(values[in_cells], value_counts[in_cells])
+                if len(group_values) == 0:
+                    assert np.isnan(medians[group_code]) and np.isnan(group_percentiles[group_code]).all()
+                else:
+                    assert medians[group_code] == np.median(group_values)
+                    np.testing.assert_array_equal(group_percentiles[group_code], np.percentile(group_values, percentiles))
+
+
+#the values bracketing each quantile position are the sorted values at the floor and ceiling of the position
+def test_bracketing_values():
+
+    group_codes, year_codes, values, value_counts, n_groups, n_years = random_value_counts(7)
+    range_quantiles = RangeQuantiles(group_codes, year_codes, values, value_counts, n_groups, n_years)
+    quantiles = np.array([0.0, 0.33, 0.5, 0.9, 1.0])
+
+    lower_values, upper_values, fractions, has_values = range_quantiles.bracketing_values(1, 3, quantiles)
+
+    for group_code in range(n_groups):
+        in_cells = (group_codes == group_code) & (year_codes >= 1) & (year_codes <= 3)
+        group_values = np.sort(np.repeat(values[in_cells], value_counts[in_cells]))
+        assert has_values[group_code] == (len(group_values) > 0)
+        if len(group_values):
+            positions = (len(group_values) - 1) * quantiles
+            np.testing.assert_array_equal(lower_values[group_code], group_values[np.floor(positions).astype(int)])
+            np.testing.assert_array_equal(upper_values[group_code], group_values[np.ceil(positions).astype(int)])
+            np.testing.assert_allclose(fractions[group_code], positions - np.floor(positions))
+
+
+def test_range_quantiles_without_values():
+
+    range_quantiles = RangeQuantiles(np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0), np.zeros(0, np.int64), 2, 3)
+
+    assert np.isnan(range_quantiles.median(0, 2)).all()
+    assert np.isnan(range_quantiles.percentiles(0, 2, [10, 90])).all()
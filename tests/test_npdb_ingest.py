@@ -0,0 +1,225 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import npdb_ingest
+from npdb_ingest import (read_npdb_csv, clean_npdb_df, sort_npdb_df, load_npdb_df, npdb_cache_paths, resolve_npdb_sources,
+                         npdb_source_signature, append_npdb_cache, write_npdb_cache, stream_npdb_index, npdb_stream_min_budget_bytes, NpdbLoadMemory)
+from npdb_index import NpdbYearIndex
+
+from conftest import synth_npdb_raw, write_npdb_csv
+
+#the feather cache needs pyarrow
+pytest.importorskip("pyarrow")
+
+#******************************************************************************
+#SECTION I: FEATHER CACHE
+#******************************************************************************
+
+
+#load the csv twice, returning the reports of the cold and the warm load
+def load_twice(npdb_csv, cache_dir):
+
+    cold_df, cold_report = load_npdb_df(npdb_csv, cache_dir = cache_dir)
+    warm_df, warm_report = load_npdb_df(npdb_csv, cache_dir = cache_dir)
+    assert warm_df.equals(cold_df)
+
+    return cold_report, warm_report
+
+
+def test_cache_matches_csv(npdb_csv, tmp_path):
+
+    cold_report, warm_report = load_twice(npdb_csv, str(tmp_path / "cache"))
+
+    assert (cold_report["source"], warm_report["source"]) == ("csv", "cache")
+    assert load_npdb_df(npdb_csv, cache_dir = str(tmp_path / "cache"))[0].equals(sort_npdb_df(clean_npdb_df(read_npdb_csv(npdb_csv))))
+
+
+def test_changed_size_invalidates_cache(npdb_csv, tmp_path):
+
+    cache_dir = str(tmp_path / "cache")
+    load_twice(npdb_csv, cache_dir)
+    write_npdb_csv(npdb_csv, synth_npdb_raw(600, seed = 1))
+
+    npdb_df, load_report = load_npdb_df(npdb_csv, cache_dir = cache_dir)
+
+    assert load_report["source"] == "csv"
+    assert len(npdb_df) == 600
+
+
+def test_changed_mtime_invalidates_cache(npdb_csv, tmp_path):
+
+    cache_dir = str(tmp_path / "cache")
+    load_twice(npdb_csv, cache_dir)
+    file_stat = os.stat(npdb_csv)
+    os.utime(npdb_csv, ns = (file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
+
+    assert load_npdb_df(npdb_csv, cache_dir = cache_dir)[1]["source"] == "csv"
+    assert load_npdb_df(npdb_csv, cache_dir = cache_dir)[1]["source"] == "cache"
+
+
+#a file rewritten with the same size and modification time is only told apart by its content hash
+def test_changed_content_invalidates_cache(npdb_csv, tmp_path):
+
+    cache_dir = str(tmp_path / "cache")
+    load_twice(npdb_csv, cache_dir)
+    file_stat = os.stat(npdb_csv)
+    with open(npdb_csv, "rb") as csv_file:
+        csv_bytes = csv_file.read()
+    with open(npdb_csv, "wb") as csv_file:
+        csv_file.write(csv_bytes.replace(b"$", b"$0", 1)[:-1])
+    os.utime(npdb_csv, ns = (file_stat.st_atime_ns, file_stat.st_mtime_ns))
+
+    assert os.path.getsize(npdb_csv) == file_stat.st_size
+    assert load_npdb_df(npdb_csv, cache_dir = cache_dir)[1]["source"] == "csv"
+
+
+def test_changed_cache_version_invalidates_cache(npdb_csv, tmp_path, monkeypatch):
+
+    cache_dir = str(tmp_path / "cache")
+    load_twice(npdb_csv, cache_dir)
+    monkeypatch.setattr(npdb_ingest, "npdb_cache_version", npdb_ingest.npdb_cache_version + 1)
+
+    assert load_npdb_df(npdb_csv, cache_dir = cache_dir)[1]["source"] == "csv"
+    with open(npdb_cache_paths(npdb_csv, [npdb_csv], cache_dir)[1]) as meta_file:
+        assert json.load(meta_file)["cache_version"] == npdb_ingest.npdb_cache_version
+
+#records appended to the source file are added to the cache as a file of their own, loaded along with the
+#cached records; rewriting the cache removes it, and a cache missing it is rebuilt from the csv
+def test_appended_cache_file(tmp_path):
+
+    cache_dir = str(tmp_path / "cache")
+    raw_df = synth_npdb_raw(600)
+    npdb_csv = write_npdb_csv(tmp_path / "NPDB_TEST.csv", raw_df.iloc[:500])
+    load_npdb_df(npdb_csv, cache_dir = cache_dir)
+    previous_signature = npdb_source_signature([npdb_csv])
+    write_npdb_csv(npdb_csv, raw_df)
+    signature = npdb_source_signature([npdb_csv])
+    csv_df = clean_npdb_df(read_npdb_csv(npdb_csv))
+    cache_paths = npdb_cache_paths(npdb_csv, [npdb_csv], cache_dir)
+
+    assert not append_npdb_cache(csv_df.iloc[500:], signature, signature, *cache_paths)
+    assert append_npdb_cache(csv_df.iloc[500:], previous_signature, signature, *cache_paths)
+    npdb_df, load_report = load_npdb_df(npdb_csv, cache_dir = cache_dir)
+    assert load_report["source"] == "cache"
+    pd.testing.assert_frame_equal(npdb_df, sort_npdb_df(csv_df))
+
+    appended_filepaths = set(os.listdir(cache_dir)) - {os.path.basename(cache_path) for cache_path in cache_paths}
+    assert len(appended_filepaths) == 1
+    os.remove(os.path.join(cache_dir, appended_filepaths.pop()))
+    assert load_npdb_df(npdb_csv, cache_dir = cache_dir)[1]["source"] == "csv"
+
+    assert append_npdb_cache(csv_df.iloc[500:], signature, signature, *cache_paths)
+    write_npdb_cache(sort_npdb_df(csv_df), signature, *cache_paths)
+    assert sorted(os.listdir(cache_dir)) == sorted(os.path.basename(cache_path) for cache_path in cache_paths)
+
+#******************************************************************************
+#SECTION II: PARTITION FILES
+#******************************************************************************
+
+#split raw records into partition files under parts_dir, the later ones without the header row
+def write_npdb_parts(parts_dir, raw_df, n_parts, headerless_parts = ()):
+
+    os.makedirs(parts_dir, exist_ok = True)
+
+    for part_number, part_rows in enumerate(np.array_split(np.arange(len(raw_df)), n_parts)):
+        raw_df.iloc[part_rows].to_csv(os.path.join(parts_dir, "NPDB_{}.csv".format(part_number + 1)), index = False,
+                                      header = part_number not in headerless_parts)
+
+    return str(parts_dir)
+
+
+def test_sources_in_natural_order(tmp_path):
+
+    for part_number in [10, 2, 1]:
+        (tmp_path / "NPDB_{}.csv".format(part_number)).write_text("SEQNO\n")
+
+    assert [os.path.basename(source) for source in resolve_npdb_sources(str(tmp_path))] == ["NPDB_1.csv", "NPDB_2.csv", "NPDB_10.csv"]
+    assert resolve_npdb_sources(str(tmp_path / "NPDB_1*.csv")) == [str(tmp_path / "NPDB_1.csv"), str(tmp_path / "NPDB_10.csv")]
+    with pytest.raises(FileNotFoundError):
+        resolve_npdb_sources(str(tmp_path / "missing_*.csv"))
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_parts_match_single_file(tmp_path, max_workers):
+
+    raw_df = synth_npdb_raw(900)
+    single_df, _ = load_npdb_df(write_npdb_csv(tmp_path / "NPDB_ALL.csv", raw_df), use_cache = False)
+    parts_dir = write_npdb_parts(tmp_path / "parts", raw_df, 3, headerless_parts = [2])
+
+    parts_df, load_report = load_npdb_df(parts_dir, use_cache = False, max_workers = max_workers)
+
+    assert load_report["parts"] == 3
+    assert parts_df.equals(single_df)
+
+
+def test_parts_cache(tmp_path):
+
+    parts_dir = write_npdb_parts(tmp_path / "parts", synth_npdb_raw(600), 2)
+    cold_report, warm_report = load_twice(parts_dir, str(tmp_path / "cache"))
+    write_npdb_parts(tmp_path / "parts", synth_npdb_raw(300, first_seqno = 601), 1)
+
+    assert (cold_report["source"], warm_report["source"]) == ("csv", "cache")
+    assert load_npdb_df(parts_dir, cache_dir = str(tmp_path / "cache"))[1]["source"] == "csv"
+
+
+#a practitioner number left blank turns the column of one partition into floats
+def test_partition_schema_mismatch(tmp_path):
+
+    raw_df = synth_npdb_raw(600)
+    raw_df["PRACTNUM"] = raw_df["PRACTNUM"].astype(object)
+    raw_df.loc[599, "PRACTNUM"] = None
+    parts_dir = write_npdb_parts(tmp_path / "parts", raw_df, 2)
+
+    with pytest.raises(ValueError, match = "does not match the schema"):
+        load_npdb_df(parts_dir, use_cache = False, max_workers = 1)
+
+#******************************************************************************
+#SECTION III: STREAMING
+#******************************************************************************
+
+#the smallest budget reads the records in chunks of 1000, and a large spill ratio spills the appearances
+#behind the distinct counts into several partitions
+@pytest.mark.parametrize("distinct_error", [None, 0.01])
+def test_streamed_index_matches_loaded(tmp_path, monkeypatch, distinct_error):
+
+    parts_dir = write_npdb_parts(tmp_path / "parts", synth_npdb_raw(3500), 2, headerless_parts = [1])
+    npdb_df, _ = load_npdb_df(parts_dir, use_cache = False, max_workers = 1)
+    loaded_index = NpdbYearIndex(npdb_df, distinct_error = distinct_error)
+
+    monkeypatch.setattr(npdb_ingest, "npdb_stream_spill_ratio", 50)
+    streamed_index, load_report = stream_npdb_index(parts_dir, npdb_stream_min_budget_bytes(), distinct_error = distinct_error,
+                                                    spill_dir = str(tmp_path / "spill"))
+
+    assert (load_report["rows"], load_report["chunks"]) == (3500, 4)
+    assert load_report["spill_buckets"] > 1
+    assert load_report["load_memory_bytes"] >= 0
+    for start_year, end_year in [(1995, 2004), (1998, 1998), (1990, 1999)]:
+        streamed_summary = streamed_index.summarize(start_year, end_year)
+        loaded_summary = loaded_index.summarize(start_year, end_year)
+        for part in ["state_year", "state", "ALGNNATR", "OUTCOME"]:
+            pd.testing.assert_frame_equal(streamed_summary[part], loaded_summary[part])
+        np.testing.assert_equal(streamed_summary["overall"], loaded_summary["overall"])
+
+
+def test_budget_below_minimum(npdb_csv):
+
+    with pytest.raises(ValueError, match = "below the minimum"):
+        stream_npdb_index(npdb_csv, npdb_stream_min_budget_bytes() - 1)
+
+
+#memory the process held at its peak before the load does not count towards the memory the load adds
+def test_load_memory_excludes_earlier_peak():
+
+    earlier_peak = np.ones(200 * 1024 ** 2 // 8)
+    del earlier_peak
+
+    load_memory = NpdbLoadMemory()
+    loaded = np.ones(40 * 1024 ** 2 // 8)
+    del loaded
+    load_memory_bytes = load_memory.finish()
+
+    assert 30 * 1024 ** 2 < load_memory_bytes < 120 * 1024 ** 2
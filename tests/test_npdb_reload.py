@@ -0,0 +1,171 @@
+import os
+
+import pandas as pd
+import pytest
+
+from npdb_schema import npdb_schema
+from npdb_synth import synth_npdb_chunk, format_npdb_csv_lines
+from npdb_ingest import resolve_npdb_sources, npdb_source_signature, load_npdb_df, clean_npdb_df
+from npdb_index import NpdbYearIndex
+from npdb_reload import NpdbDataset, NpdbReloader, appended_npdb_parts, read_npdb_tail
+
+#******************************************************************************
+#SECTION I: TEST FILES
+#******************************************************************************
+
+#csv lines of synthetic records; chunk_number keeps the SEQNOs of different files apart
+def synth_csv_lines(chunk_number, n_rows):
+
+    return format_npdb_csv_lines(synth_npdb_chunk(0, chunk_number, n_rows, n_rows, first_year = 1995, last_year = 2004), list(npdb_schema))
+
+
+def write_part(part_filepath, chunk_number, n_rows):
+
+    with open(part_filepath, "w") as part_file:
+        part_file.write(",".join(npdb_schema) + "\n" + synth_csv_lines(chunk_number, n_rows))
+
+
+def append_part(part_filepath, chunk_number, n_rows):
+
+    with open(part_filepath, "a") as part_file:
+        part_file.write(synth_csv_lines(chunk_number, n_rows))
+
+
+def hashed_signature(npdb_filepath):
+
+    return npdb_source_signature(resolve_npdb_sources(npdb_filepath), with_hash = True)
+
+
+@pytest.fixture
+def npdb_parts(tmp_path):
+
+    parts_dir = tmp_path / "parts"
+    parts_dir.mkdir()
+    write_part(parts_dir / "NPDB_1.csv", 0, 300)
+    write_part(parts_dir / "NPDB_2.csv", 1, 200)
+
+    return str(parts_dir)
+
+#******************************************************************************
+#SECTION II: APPENDED PARTS
+#******************************************************************************
+
+def test_unchanged_parts(npdb_parts):
+
+    assert appended_npdb_parts(hashed_signature(npdb_parts), hashed_signature(npdb_parts)) == []
+
+
+def test_appended_records(npdb_parts):
+
+    part_filepath = os.path.join(npdb_parts, "NPDB_2.csv")
+    old_signature = hashed_signature(npdb_parts)
+    old_size = os.path.getsize(part_filepath)
+    append_part(part_filepath, 2, 50)
+
+    assert appended_npdb_parts(old_signature, hashed_signature(npdb_parts)) == [(part_filepath, old_size)]
+
+    appended_df = read_npdb_tail(part_filepath, old_size, list(npdb_schema))
+    expected_df = synth_npdb_chunk(0, 2, 50, 50, first_year = 1995, last_year = 2004)
+    assert appended_df["SEQNO"].tolist() == expected_df["SEQNO"].tolist()
+
+
+def test_added_part(npdb_parts):
+
+    old_signature = hashed_signature(npdb_parts)
+    write_part(os.path.join(npdb_parts, "NPDB_3.csv"), 2, 20)
+
+    assert appended_npdb_parts(old_signature, hashed_signature(npdb_parts)) == [(os.path.join(npdb_parts, "NPDB_3.csv"), 0)]
+
+
+def test_rewritten_part(npdb_parts):
+
+    old_signature = hashed_signature(npdb_parts)
+    write_part(os.path.join(npdb_parts, "NPDB_1.csv"), 5, 400)
+
+    assert appended_npdb_parts(old_signature, hashed_signature(npdb_parts)) is None
+
+
+def test_truncated_part(npdb_parts):
+
+    old_signature = hashed_signature(npdb_parts)
+    write_part(os.path.join(npdb_parts, "NPDB_1.csv"), 0, 100)
+
+    assert appended_npdb_parts(old_signature, hashed_signature(npdb_parts)) is None
+
+
+def test_removed_part(npdb_parts):
+
+    old_signature = hashed_signature(npdb_parts)
+    os.remove(os.path.join(npdb_parts, "NPDB_2.csv"))
+
+    assert appended_npdb_parts(old_signature, hashed_signature(npdb_parts)) is None
+
+
+#records appended to a last line without its line break would be glued onto that line
+def test_append_after_unterminated_line(npdb_parts):
+
+    part_filepath = os.path.join(npdb_parts, "NPDB_2.csv")
+    with open(part_filepath, "rb+") as part_file:
+        part_file.truncate(os.path.getsize(part_filepath) - 1)
+    old_signature = hashed_signature(npdb_parts)
+    append_part(part_filepath, 2, 10)
+
+    assert appended_npdb_parts(old_signature, hashed_signature(npdb_parts)) is None
+
+#******************************************************************************
+#SECTION III: INCREMENTAL RELOADS
+#******************************************************************************
+
+#reload the parts after a change, returning the reloaded dataset
+def reload_parts(npdb_reloader):
+
+    reloaded = []
+    npdb_reloader.on_reload = reloaded.append
+    npdb_reloader.reload()
+
+    return reloaded[0]
+
+
+@pytest.mark.parametrize("change", ["append", "add part", "rewrite"])
+def test_reload_matches_fresh_load(npdb_parts, tmp_path, change):
+
+    cache_dir = str(tmp_path / "cache")
+    npdb_df, load_report = load_npdb_df(npdb_parts, cache_dir = cache_dir, max_workers = 1)
+    dataset = NpdbDataset(npdb_df, None, NpdbYearIndex(npdb_df), load_report)
+    built_from = []
+    npdb_reloader = NpdbReloader(npdb_parts, dataset, lambda new_dataset: built_from.append((new_dataset.previous, new_dataset.appended_df)) or new_dataset,
+                                 None, 0, cache_dir = cache_dir)
+    npdb_reloader.prepare()
+
+    if change == "append":
+        append_part(os.path.join(npdb_parts, "NPDB_1.csv"), 2, 120)
+    elif change == "add part":
+        write_part(os.path.join(npdb_parts, "NPDB_3.csv"), 2, 80)
+    else:
+        write_part(os.path.join(npdb_parts, "NPDB_2.csv"), 3, 90)
+
+    reloaded = reload_parts(npdb_reloader)
+    fresh_df, _ = load_npdb_df(npdb_parts, use_cache = False, max_workers = 1)
+    fresh_index = NpdbYearIndex(fresh_df)
+
+    assert reloaded.version == 2
+    assert reloaded.load_report["source"] == ("append" if change != "rewrite" else "csv")
+    pd.testing.assert_frame_equal(reloaded.npdb_df.sort_values("SEQNO", ignore_index = True), fresh_df.sort_values("SEQNO", ignore_index = True))
+    assert reloaded.previous is None and reloaded.appended_df is None
+    if change == "rewrite":
+        assert built_from == [(None, None)]
+    else:
+        assert built_from[0][0] is dataset and len(built_from[0][1]) == (120 if change == "append" else 80)
+
+    #the appended records are added to the feather cache, which loads the same records as the csv files, ordered
+    #by year (appended records following the others of their year)
+    cached_df, cached_report = load_npdb_df(npdb_parts, cache_dir = cache_dir, max_workers = 1)
+    assert cached_report["source"] == "cache"
+    assert cached_df["ORIGYEAR"].is_monotonic_increasing
+    pd.testing.assert_frame_equal(cached_df.sort_values("SEQNO", ignore_index = True), fresh_df.sort_values("SEQNO", ignore_index = True))
+    for start_year, end_year in [(1995, 2004), (1999, 2000)]:
+        reloaded_summary = reloaded.index.summarize(start_year, end_year)
+        fresh_summary = fresh_index.summarize(start_year, end_year)
+        for part in ["state_year", "state", "ALGNNATR", "OUTCOME"]:
+            pd.testing.assert_frame_equal(reloaded_summary[part], fresh_summary[part])
+        assert reloaded_summary["overall"] == pytest.approx(fresh_summary["overall"], nan_ok = True)
@@ -0,0 +1,155 @@
+import os
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from npdb_index import NpdbYearIndex
+from npdb_results import npdb_result_signature, build_result_store, load_result_store, update_result_store, warm_result_store, lookup_summary
+
+from conftest import synth_npdb_records, synth_npdb_raw, write_npdb_csv
+
+#******************************************************************************
+#SECTION I: BUILDING AND LOADING THE STORE
+#******************************************************************************
+
+@pytest.fixture(scope = "module")
+def npdb_index():
+
+    return NpdbYearIndex(synth_npdb_records(2000))
+
+
+#every stored summary is the summary of its year range
+def test_store_round_trip(npdb_index, tmp_path):
+
+    store_path = str(tmp_path / "results.sqlite")
+    build_result_store(npdb_index, store_path, "signature")
+
+    npdb_results = load_result_store(store_path, "signature")
+
+    assert len(npdb_results) == npdb_index.n_years * (npdb_index.n_years + 1) // 2
+    for (start_code, end_code), stored_summary in npdb_results.items():
+        npdb_summary = npdb_index.summarize(npdb_index.first_year + start_code, npdb_index.first_year + end_code)
+        for part in ["state", "ALGNNATR", "OUTCOME"]:
+            pd.testing.assert_frame_equal(stored_summary[part], npdb_summary[part])
+        np.testing.assert_equal(stored_summary["overall"], npdb_summary["overall"])
+
+
+#summaries are stored as json text rather than pickled objects
+def test_store_holds_json(npdb_index, tmp_path):
+
+    store_path = str(tmp_path / "results.sqlite")
+    build_result_store(npdb_index, store_path, "signature")
+
+    with sqlite3.connect(store_path) as store:
+        stored_summaries = [summary for summary, in store.execute("SELECT summary FROM summaries")]
+    store.close()
+
+    assert all(isinstance(summary, str) for summary in stored_summaries)
+    assert json.loads(stored_summaries[0])["state"]["dtypes"]["WORKSTAT"] == "object"
+
+
+def test_store_signature_mismatch(npdb_index, tmp_path):
+
+    store_path = str(tmp_path / "results.sqlite")
+    build_result_store(npdb_index, store_path, "signature")
+
+    assert load_result_store(store_path, "other signature") is None
+    assert load_result_store(str(tmp_path / "missing.sqlite"), "signature") is None
+
+
+def test_unreadable_store(tmp_path):
+
+    store_path = tmp_path / "results.sqlite"
+    store_path.write_bytes(b"not a sqlite file")
+
+    assert load_result_store(str(store_path), "signature") is None
+
+
+#after appending records from 1999 on, updating the store recomputes the ranges ending in or after 1999 and
+#gives the summaries of a store built over all the records; a store holding another signature is left alone
+def test_update_matches_build(tmp_path):
+
+    records_df = synth_npdb_records(2000)
+    appended = (records_df["ORIGYEAR"] >= 1999).to_numpy() & (np.arange(len(records_df)) % 2 == 0)
+    previous_index = NpdbYearIndex(records_df[~appended])
+    npdb_index = NpdbYearIndex(records_df)
+    assert previous_index.first_year == npdb_index.first_year == 1995
+
+    store_path, rebuilt_path = str(tmp_path / "results.sqlite"), str(tmp_path / "rebuilt.sqlite")
+    build_result_store(previous_index, store_path, "previous")
+    build_result_store(npdb_index, rebuilt_path, "signature")
+    previous_results = load_result_store(store_path, "previous")
+
+    updated_results = update_result_store(previous_results, npdb_index, store_path, "previous", "signature", 1999)
+    rebuilt_results = load_result_store(rebuilt_path, "signature")
+
+    assert sum(updated_results[year_codes] is previous_results[year_codes] for year_codes in previous_results) == 4 * 5 // 2
+    for stored_results in [updated_results, load_result_store(store_path, "signature")]:
+        assert stored_results.keys() == rebuilt_results.keys()
+        for year_codes, rebuilt_summary in rebuilt_results.items():
+            for part in ["state", "ALGNNATR", "OUTCOME"]:
+                pd.testing.assert_frame_equal(stored_results[year_codes][part], rebuilt_summary[part])
+            np.testing.assert_equal(stored_results[year_codes]["overall"], rebuilt_summary["overall"])
+
+    assert update_result_store(previous_results, npdb_index, rebuilt_path, "previous", "other signature", 1999) is None
+    assert load_result_store(rebuilt_path, "signature") is not None
+
+
+#the signature follows the version of the source file and the counting mode
+def test_result_signature(npdb_csv):
+
+    signature = npdb_result_signature(npdb_csv)
+
+    assert npdb_result_signature(npdb_csv, distinct_error = 0.01) != signature
+    write_npdb_csv(npdb_csv, synth_npdb_raw(600, seed = 1))
+    assert npdb_result_signature(npdb_csv) != signature
+
+#******************************************************************************
+#SECTION II: WARMING AND LOOKUPS
+#******************************************************************************
+
+def test_warm_builds_once(npdb_csv, npdb_index, tmp_path):
+
+    store_path = str(tmp_path / "results.sqlite")
+
+    _, first_report = warm_result_store(npdb_csv, npdb_index, store_path)
+    _, second_report = warm_result_store(npdb_csv, npdb_index, store_path)
+    file_stat = os.stat(npdb_csv)
+    os.utime(npdb_csv, ns = (file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
+    _, changed_report = warm_result_store(npdb_csv, npdb_index, store_path)
+
+    assert (first_report["built"], second_report["built"], changed_report["built"]) == (True, False, True)
+    assert second_report["ranges"] == npdb_index.n_years * (npdb_index.n_years + 1) // 2
+
+
+#warming with the summaries of the store before an append updates the store in place rather than rebuilding it
+def test_warm_updates_after_append(npdb_csv, npdb_index, tmp_path):
+
+    store_path = str(tmp_path / "results.sqlite")
+
+    npdb_results, first_report = warm_result_store(npdb_csv, npdb_index, store_path)
+    file_stat = os.stat(npdb_csv)
+    os.utime(npdb_csv, ns = (file_stat.st_atime_ns, file_stat.st_mtime_ns + 10 ** 9))
+    _, updated_report = warm_result_store(npdb_csv, npdb_index, store_path, previous_results = (npdb_results, first_report["signature"], npdb_index.first_year),
+                                          first_changed_year = npdb_index.last_year)
+
+    assert (updated_report["built"], updated_report["updated"]) == (False, npdb_index.n_years)
+    assert load_result_store(store_path, updated_report["signature"]) is not None
+
+
+#lookups give the summaries of the year index, including clamped and reversed year ranges
+@pytest.mark.parametrize("start_year, end_year", [(1995, 2004), (1999, 1999), (1990, 1997), (2002, 2030), (2001, 1998)])
+def test_lookup_matches_summary(npdb_csv, npdb_index, tmp_path, start_year, end_year):
+
+    npdb_results, _ = warm_result_store(npdb_csv, npdb_index, str(tmp_path / "results.sqlite"))
+
+    looked_up_summary = lookup_summary(npdb_results, npdb_index, start_year, end_year)
+    npdb_summary = npdb_index.summarize(start_year, end_year)
+
+    assert sorted(looked_up_summary) == sorted(npdb_summary)
+    for part in ["state_year", "state", "ALGNNATR", "OUTCOME"]:
+        pd.testing.assert_frame_equal(looked_up_summary[part], npdb_summary[part])
+    np.testing.assert_equal(looked_up_summary["overall"], npdb_summary["overall"])
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from npdb_schema import npdb_state_codes
+from npdb_ingest import read_npdb_csv, read_npdb_csv_chunks, clean_npdb_df
+
+from conftest import synth_npdb_raw, write_npdb_csv
+
+#data types of the loaded columns after cleaning
+npdb_cleaned_dtypes = {"SEQNO": "int32",
+                       "RECTYPE": "category",
+                       "ORIGYEAR": "int16",
+                       "WORKSTAT": "category",
+                       "ALGNNATR": "Int8",
+                       "OUTCOME": "Int8",
+                       "TOTALPMT": "float64",
+                       "AALENGTH": "float64",
+                       "PRACTNUM": "int32"}
+
+#******************************************************************************
+#SECTION I: CLEANED DATA TYPES
+#******************************************************************************
+
+def test_cleaned_dtypes(tmp_path):
+
+    raw_df = synth_npdb_raw(800)
+    raw_df["REPTYPE"] = 1
+
+    npdb_df = clean_npdb_df(read_npdb_csv(write_npdb_csv(tmp_path / "NPDB_TEST.csv", raw_df)))
+
+    assert npdb_df.dtypes.astype(str).to_dict() == npdb_cleaned_dtypes
+    assert set(npdb_state_codes) <= set(npdb_df["WORKSTAT"].cat.categories)
+
+
+#the cleaned values are those of the raw file, with the $ sign stripped from payments
+def test_cleaned_values(tmp_path):
+
+    raw_df = synth_npdb_raw(800)
+
+    npdb_df = clean_npdb_df(read_npdb_csv(write_npdb_csv(tmp_path / "NPDB_TEST.csv", raw_df)))
+
+    np.testing.assert_array_equal(npdb_df["TOTALPMT"], raw_df["TOTALPMT"].str.lstrip("$").astype(float))
+    for column in ["SEQNO", "ORIGYEAR", "PRACTNUM", "AALENGTH"]:
+        np.testing.assert_array_equal(npdb_df[column], raw_df[column])
+    for column in ["WORKSTAT", "ALGNNATR", "OUTCOME"]:
+        assert npdb_df[column].astype(object).where(npdb_df[column].notna(), None).tolist() == \
+            raw_df[column].astype(object).where(raw_df[column].notna(), None).tolist()
+
+
+#a file with blanks in a column that should always be present is read again with that column as floats, and
+#the column is cleaned to its nullable type
+def test_blank_required_column(tmp_path):
+
+    raw_df = synth_npdb_raw(800)
+    raw_df["PRACTNUM"] = raw_df["PRACTNUM"].astype(object)
+    raw_df.loc[[3, 700], "PRACTNUM"] = None
+
+    npdb_df = clean_npdb_df(read_npdb_csv(write_npdb_csv(tmp_path / "NPDB_TEST.csv", raw_df)))
+
+    assert npdb_df["PRACTNUM"].dtype == "Int32"
+    assert npdb_df["PRACTNUM"].isna().sum() == 2
+    assert npdb_df["PRACTNUM"].dropna().tolist() == raw_df["PRACTNUM"].dropna().tolist()
+    assert npdb_df["SEQNO"].dtype == "int32"
+
+
+#the blanks are only in the last chunk, yet every chunk is read and cleaned with the same data types
+def test_blank_required_column_chunks(tmp_path):
+
+    raw_df = synth_npdb_raw(800)
+    raw_df["PRACTNUM"] = raw_df["PRACTNUM"].astype(object)
+    raw_df.loc[[790], "PRACTNUM"] = None
+
+    npdb_chunks = [clean_npdb_df(npdb_chunk) for npdb_chunk in read_npdb_csv_chunks(write_npdb_csv(tmp_path / "NPDB_TEST.csv", raw_df), 300)]
+
+    assert [len(npdb_chunk) for npdb_chunk in npdb_chunks] == [300, 300, 200]
+    assert [str(npdb_chunk["PRACTNUM"].dtype) for npdb_chunk in npdb_chunks] == ["Int32"] * 3
+    assert [str(npdb_chunk["SEQNO"].dtype) for npdb_chunk in npdb_chunks] == ["int32"] * 3
+    assert pd.concat(npdb_chunks)["PRACTNUM"].isna().sum() == 1
+
+
+#other parse errors are raised rather than read again as floats
+def test_malformed_required_column(tmp_path):
+
+    raw_df = synth_npdb_raw(50)
+    raw_df["SEQNO"] = raw_df["SEQNO"].astype(object)
+    raw_df.loc[10, "SEQNO"] = "A12"
+
+    with pytest.raises(ValueError, match = "invalid literal"):
+        read_npdb_csv(write_npdb_csv(tmp_path / "NPDB_TEST.csv", raw_df))
+
+
+def test_missing_column(tmp_path):
+
+    npdb_csv = write_npdb_csv(tmp_path / "NPDB_TEST.csv", synth_npdb_raw(50).drop(columns = "OUTCOME"))
+
+    with pytest.raises(ValueError, match = "missing columns \\['OUTCOME'\\]"):
+        read_npdb_csv(npdb_csv)
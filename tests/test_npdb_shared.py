@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from npdb_ingest import load_npdb_df, npdb_stream_min_budget_bytes
+from npdb_index import NpdbYearIndex
+from npdb_bitmaps import NpdbBitmapIndex
+from npdb_shared import (npdb_snapshot_path, write_npdb_snapshot, attach_npdb_snapshot, load_shared_npdb, npdb_snapshot_source_signature,
+                         remove_stale_snapshots)
+
+from conftest import synth_npdb_raw, write_npdb_csv
+
+#snapshots of the records need pyarrow
+pytest.importorskip("pyarrow")
+
+#******************************************************************************
+#SECTION I: SNAPSHOTS
+#******************************************************************************
+
+#assert that two year indexes give the same summaries
+def assert_same_summaries(npdb_index, expected_index):
+
+    for start_year, end_year in [(1995, 2004), (1998, 1998), (1990, 1999), (2003, 1996)]:
+        npdb_summary = npdb_index.summarize(start_year, end_year)
+        expected_summary = expected_index.summarize(start_year, end_year)
+        for part in ["state_year", "state", "ALGNNATR", "OUTCOME"]:
+            pd.testing.assert_frame_equal(npdb_summary[part], expected_summary[part])
+        np.testing.assert_equal(npdb_summary["overall"], expected_summary["overall"])
+
+
+@pytest.mark.parametrize("distinct_error", [None, 0.01])
+def test_snapshot_round_trip(npdb_csv, tmp_path, distinct_error):
+
+    npdb_df, _ = load_npdb_df(npdb_csv, use_cache = False)
+    npdb_index = NpdbYearIndex(npdb_df, distinct_error = distinct_error)
+    snapshot_path = npdb_snapshot_path(npdb_csv, str(tmp_path / "shared"), distinct_error)
+
+    bitmap_index = NpdbBitmapIndex(npdb_df)
+
+    write_npdb_snapshot(npdb_df, npdb_index, snapshot_path, bitmap_index = bitmap_index)
+    npdb_table, attached_index, attached_bitmaps = attach_npdb_snapshot(snapshot_path)
+
+    pd.testing.assert_frame_equal(npdb_table.to_pandas(), npdb_df)
+    assert attached_index.approximate_counts == (distinct_error is not None)
+    assert_same_summaries(attached_index, npdb_index)
+
+    #the bitmaps are memory mapped rather than read in
+    assert attached_bitmaps.values == bitmap_index.values
+    assert all(isinstance(bitmaps, np.memmap) for bitmaps in attached_bitmaps.segments[0].bitmaps.values())
+    for filters in [{}, {"WORKSTAT": ["CA", "TX"]}, {"RECTYPE": ["P"], "OUTCOME": [1, 9]}]:
+        np.testing.assert_array_equal(attached_bitmaps.select(1997, 2002, filters), bitmap_index.select(1997, 2002, filters))
+
+
+def test_streamed_snapshot_has_no_records(npdb_csv, tmp_path):
+
+    npdb_table, npdb_index, bitmap_index, load_report = load_shared_npdb(npdb_csv, str(tmp_path / "shared"), stream_memory_bytes = npdb_stream_min_budget_bytes())
+
+    assert load_report["built"]
+    assert npdb_table is None and bitmap_index is None
+    assert_same_summaries(npdb_index, NpdbYearIndex(load_npdb_df(npdb_csv, use_cache = False)[0]))
+
+#******************************************************************************
+#SECTION II: SHARED LOADING
+#******************************************************************************
+
+#the first load builds the snapshot and later loads attach to it, until the source file changes
+def test_shared_load_builds_once(npdb_csv, tmp_path):
+
+    snapshot_root = str(tmp_path / "shared")
+    cache_dir = str(tmp_path / "cache")
+
+    _, _, _, first_report = load_shared_npdb(npdb_csv, snapshot_root, cache_dir = cache_dir)
+    _, _, _, second_report = load_shared_npdb(npdb_csv, snapshot_root, cache_dir = cache_dir)
+    write_npdb_csv(npdb_csv, synth_npdb_raw(700, seed = 1))
+    npdb_table, _, _, changed_report = load_shared_npdb(npdb_csv, snapshot_root, cache_dir = cache_dir)
+
+    assert (first_report["built"], second_report["built"], changed_report["built"]) == (True, False, True)
+    assert second_report["snapshot_path"] == first_report["snapshot_path"] != changed_report["snapshot_path"]
+    assert npdb_table.num_rows == 700
+    assert [name for name in os.listdir(snapshot_root) if name.startswith("npdb_snapshot_")] == [os.path.basename(changed_report["snapshot_path"])]
+
+
+#a worker still seeing an older version of the source files does not remove the snapshot of a newer one
+def test_older_snapshot_keeps_newer(npdb_csv, tmp_path):
+
+    snapshot_root = str(tmp_path / "shared")
+    npdb_df, _ = load_npdb_df(npdb_csv, use_cache = False)
+    old_signature = npdb_snapshot_source_signature(npdb_csv)
+    old_snapshot_path = npdb_snapshot_path(npdb_csv, snapshot_root)
+
+    write_npdb_csv(npdb_csv, synth_npdb_raw(700, seed = 1))
+    os.utime(npdb_csv, ns = (old_signature["parts"][0]["mtime_ns"] + 10 ** 9,) * 2)
+    _, _, _, new_report = load_shared_npdb(npdb_csv, snapshot_root)
+
+    #the older worker publishes its snapshot after the newer one
+    write_npdb_snapshot(npdb_df, NpdbYearIndex(npdb_df), old_snapshot_path, signature = old_signature)
+    remove_stale_snapshots(old_snapshot_path)
+    assert os.path.isdir(new_report["snapshot_path"])
+
+    #the newer one removes it again when it next publishes
+    remove_stale_snapshots(new_report["snapshot_path"])
+    assert not os.path.exists(old_snapshot_path)
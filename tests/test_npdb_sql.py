@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import npdb_sql
+from npdb_ingest import load_npdb_df
+from npdb_index import NpdbYearIndex
+from npdb_sql import load_npdb_sql_index
+
+from conftest import synth_npdb_raw, write_npdb_csv
+
+#******************************************************************************
+#SECTION I: SQL BACKEND
+#******************************************************************************
+
+#csv file of raw records in which some claims are reported again in another year, so that SEQNO repeats
+@pytest.fixture(scope = "module")
+def npdb_repeats_csv(tmp_path_factory):
+
+    raw_df = synth_npdb_raw(1500)
+    repeated_df = raw_df.sample(frac = 0.2, random_state = 0)
+    repeated_df["ORIGYEAR"] = np.random.default_rng(0).integers(1995, 2005, len(repeated_df))
+
+    return write_npdb_csv(tmp_path_factory.mktemp("sql") / "NPDB_TEST.csv", pd.concat([raw_df, repeated_df], ignore_index = True))
+
+
+#the summaries of the database match those of the year index built in memory over every year range
+@pytest.mark.parametrize("engine", ["sqlite", pytest.param("duckdb", marks = pytest.mark.skipif(npdb_sql.duckdb is None, reason = "duckdb is not installed"))])
+def test_sql_summaries_match_pandas(npdb_repeats_csv, tmp_path, engine):
+
+    sql_index, load_report = load_npdb_sql_index(npdb_repeats_csv, engine, db_path = str(tmp_path / ("npdb." + engine)), max_workers = 4)
+    npdb_df, _ = load_npdb_df(npdb_repeats_csv, use_cache = False)
+    pandas_index = NpdbYearIndex(npdb_df)
+
+    assert load_report["built"] and (load_report["rows"] == len(npdb_df))
+    assert (sql_index.first_year, sql_index.last_year) == (pandas_index.first_year, pandas_index.last_year)
+    for start_year in range(pandas_index.first_year - 1, pandas_index.last_year + 2):
+        for end_year in range(start_year, pandas_index.last_year + 2):
+            sql_summary = sql_index.summarize(start_year, end_year)
+            pandas_summary = pandas_index.summarize(start_year, end_year)
+            for part in ["state_year", "state", "ALGNNATR", "OUTCOME"]:
+                pd.testing.assert_frame_equal(sql_summary[part], pandas_summary[part])
+            assert sql_summary["overall"] == pytest.approx(pandas_summary["overall"], nan_ok = True)
+
+
+#the database is built once and rebuilt when the input file changes
+def test_sqlite_database_rebuilt_on_change(tmp_path):
+
+    npdb_csv = write_npdb_csv(tmp_path / "NPDB_TEST.csv", synth_npdb_raw(300))
+    cache_dir = str(tmp_path / "cache")
+
+    _, first_report = load_npdb_sql_index(npdb_csv, "sqlite", cache_dir = cache_dir)
+    _, second_report = load_npdb_sql_index(npdb_csv, "sqlite", cache_dir = cache_dir)
+    write_npdb_csv(npdb_csv, synth_npdb_raw(400, seed = 1))
+    sql_index, changed_report = load_npdb_sql_index(npdb_csv, "sqlite", cache_dir = cache_dir)
+
+    assert (first_report["built"], second_report["built"], changed_report["built"]) == (True, False, True)
+    assert os.path.dirname(changed_report["db_path"]) == cache_dir
+    assert sql_index.summarize_overall(1990, 2020)["SEQNO"] == 400
+
+
+def test_unknown_engine(npdb_csv):
+
+    with pytest.raises(ValueError, match = "unknown sql engine"):
+        load_npdb_sql_index(npdb_csv, "postgres")
+
+
+@pytest.mark.skipif(npdb_sql.duckdb is not None, reason = "duckdb is installed")
+def test_duckdb_needs_package(npdb_csv, tmp_path):
+
+    with pytest.raises(ImportError, match = "duckdb package"):
+        load_npdb_sql_index(npdb_csv, "duckdb", db_path = str(tmp_path / "npdb.duckdb"))
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from npdb_table import parse_filter_value, parse_filter_query, filter_table, sort_table, query_table_page
+
+#state by year table with a blank state, a blank median and values of several magnitudes
+@pytest.fixture
+def table_df():
+
+    return pd.DataFrame({"ORIGYEAR": [1995, 1995, 1996, 1996, 1997, 1997, 1998],
+                         "WORKSTAT": ["CA", "NY", "CA", "ca", None, "TX", "NY"],
+                         "SEQNO": [10, 250, 30, 4, 70, 100, 250],
+                         "TOTALPMT": [1000.0, np.nan, 250000.0, 75.5, 1e6, 2500.0, 5000.0]})
+
+#******************************************************************************
+#SECTION I: FILTER QUERIES
+#******************************************************************************
+
+@pytest.mark.parametrize("value_text, value", [("100", 100.0), ("2.5", 2.5), ("CA", "CA"), ('"100"', "100"),
+                                               ("'a b'", "a b"), ('"say \\"hi\\""', 'say "hi"')])
+def test_parse_filter_value(value_text, value):
+
+    assert parse_filter_value(value_text) == value
+
+
+def test_parse_filter_query():
+
+    assert parse_filter_query('{SEQNO} > 100 && {WORKSTAT} icontains "ca" && {TOTALPMT} le 5000') == \
+        [("SEQNO", True, "gt", 100.0), ("WORKSTAT", False, "contains", "ca"), ("TOTALPMT", True, "le", 5000.0)]
+    assert parse_filter_query("{SEQNO} s= 4") == [("SEQNO", True, "eq", 4.0)]
+
+
+#conditions that cannot be parsed, such as a half typed filter, are left out
+@pytest.mark.parametrize("filter_query", ["", None, "{SEQNO", "SEQNO > 1", "{SEQNO} between 1"])
+def test_unparsed_filter_queries(filter_query):
+
+    assert parse_filter_query(filter_query) == []
+
+
+@pytest.mark.parametrize("filter_query, expected_rows", [("{SEQNO} > 100", [1, 6]),
+                                                         ("{SEQNO} >= 100 && {WORKSTAT} = NY", [1, 6]),
+                                                         ("{TOTALPMT} < 2500", [0, 3]),
+                                                         ("{WORKSTAT} = CA", [0, 2]),
+                                                         ("{WORKSTAT} ieq ca", [0, 2, 3]),
+                                                         ("{WORKSTAT} contains C", [0, 2]),
+                                                         ("{WORKSTAT} icontains c", [0, 2, 3]),
+                                                         ("{SEQNO} contains 25", [1, 6]),
+                                                         ("{ORIGYEAR} datestartswith 199", [0, 1, 2, 3, 4, 5, 6]),
+                                                         ("{WORKSTAT} > 5", []),
+                                                         ("{SEQNO} = CA", []),
+                                                         ("{MISSING} = 1", [0, 1, 2, 3, 4, 5, 6])])
+def test_filter_table(table_df, filter_query, expected_rows):
+
+    assert filter_table(table_df, filter_query).index.tolist() == expected_rows
+
+#******************************************************************************
+#SECTION II: SORTING AND PAGING
+#******************************************************************************
+
+#blanks go last in either direction, and ties keep the order of the next sort column
+def test_sort_table(table_df):
+
+    assert sort_table(table_df, [{"column_id": "TOTALPMT", "direction": "desc"}]).index.tolist() == [4, 2, 6, 5, 0, 3, 1]
+    assert sort_table(table_df, [{"column_id": "TOTALPMT", "direction": "asc"}]).index.tolist() == [3, 0, 5, 6, 2, 4, 1]
+    assert sort_table(table_df, [{"column_id": "SEQNO", "direction": "desc"},
+                                 {"column_id": "ORIGYEAR", "direction": "asc"}]).index.tolist() == [1, 6, 5, 4, 2, 0, 3]
+    assert sort_table(table_df, [{"column_id": "MISSING", "direction": "asc"}]).index.tolist() == list(range(7))
+    assert sort_table(table_df, None) is table_df
+
+
+def test_query_table_page(table_df):
+
+    page_df, page_count, page_current = query_table_page(table_df, 1, 3, [{"column_id": "SEQNO", "direction": "asc"}])
+
+    assert (page_count, page_current) == (3, 1)
+    assert page_df["SEQNO"].tolist() == [70, 100, 250]
+
+
+#a page past the end of the filtered table is moved back to its last page
+def test_query_table_page_past_filtered_end(table_df):
+
+    page_df, page_count, page_current = query_table_page(table_df, 5, 2, filter_query = "{WORKSTAT} icontains c")
+
+    assert (page_count, page_current) == (2, 1)
+    assert page_df.index.tolist() == [3]
+
+
+def test_query_empty_table(table_df):
+
+    page_df, page_count, page_current = query_table_page(table_df, 2, 5, filter_query = "{SEQNO} > 1000")
+
+    assert (len(page_df), page_count, page_current) == (0, 1, 0)